@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Measures the startup time of Scavenger with -X importtime")
+    parser.add_argument("--repeat", "-n",
+                        dest="repeat",
+                        default=5,
+                        type=int,
+                        help="Number of runs, the fastest run is reported (Default: %(default)s)")
+    parser.add_argument("--top",
+                        dest="top",
+                        default=15,
+                        type=int,
+                        help="Number of top-level imports listed (Default: %(default)s)")
+    parser.add_argument("--script",
+                        dest="script",
+                        default=os.path.join(ROOT_DIR, "scavenger.py"),
+                        help="Script to be started with --help (Default: scavenger.py)")
+    parser_result = parser.parse_args()
+
+    runs = [measure_startup(parser_result.script) for _ in range(parser_result.repeat)]
+    wall_time, import_times = min(runs, key=lambda run: run[0])
+    total_import_time = sum(cumulative for cumulative, _ in import_times)
+
+    print("Script: %s" % parser_result.script)
+    print("Startup wall time: %.1f ms (fastest of %d runs)" % (wall_time * 1000, parser_result.repeat))
+    print("Top-level import time: %.1f ms" % (total_import_time / 1000))
+    print()
+    print("%12s  %s" % ("cumulative", "top-level import"))
+
+    for cumulative, name in sorted(import_times, reverse=True)[:parser_result.top]:
+        print("%9.1f ms  %s" % (cumulative / 1000, name))
+
+
+# Runs the script with --help under -X importtime
+# Returns the wall time and the cumulative import time in microseconds of each top-level import
+def measure_startup(script):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, "-X", "importtime", script, "--help"],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, cwd=ROOT_DIR)
+    wall_time = time.perf_counter() - start
+
+    if process.returncode != 0:
+        raise RuntimeError("%s failed to start:\n%s" % (script, process.stderr.decode("utf8")))
+
+    import_times = []
+    for line in process.stderr.decode("utf8").splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+
+        # Nested imports are indented below the import that triggered them
+        if match and len(match.group(3)) == 1:
+            import_times.append((int(match.group(2)), match.group(4)))
+
+    return wall_time, import_times
+
+
+if __name__ == "__main__":
+    main()
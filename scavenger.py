@@ -1,64 +1,210 @@
 #!/usr/bin/env python3
 
 import argparse
-import copy
+import functools
 import gzip
 import itertools
 import logging
-import math
 import multiprocessing as mp
 import os
-import pysam
 import random
 import re
 import shlex
 import shutil
 import string
 import sys
-import tempfile
+import time
 
-from Bio import SeqIO
-from collections import defaultdict
-from intervaltree import IntervalTree
+from collections import defaultdict, deque
 from subprocess import Popen, PIPE
 
-from utils import run_aligner, build_aligner_index
+from utils import aligner_backends, run_aligner, build_aligner_index, profiling, read_filter, read_names, \
+    region_scan, rescue_cache, spill_store, worker_pool, governor
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel("INFO")
+LOG_FORMATTER = logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %I:%M:%S %p")
 
 BIN_SIZE = 500
 NUM_READ_PER_CHR = 1000
+NUM_FASTQ_READS_PER_BATCH = 100000
+# Number of unmapped reads sent to a worker of the pool at a time for the consensus
+NUM_CONSENSUS_READS_PER_CHUNK = 256
+# Number of bases added to each side of the location of a mapped read to make a rescue window
+WINDOW_EXTEND_LEN = 100
+# Largest gap between two rescue windows that are merged, about the length of a read
+MAX_WINDOW_GAP = 100
+NUM_REPEAT_SEQS_PER_CHUNK = 5000
+
+# Creates the intermediate tables, which are spilled to disk when --max_memory is given
+TABLES = spill_store.TableFactory()
+# Parsed genome records by genome files, only kept in batch mode where they are reused by the following samples
+GENOME_CACHE = None
+# Regions of the source alignment files scanned by region, as (region, first read id, number of read ids)
+SOURCE_LAYOUTS = {}
 
 
 # Main function
-def main(mp_fork, mp_spawn):
+def main(mp_fork):
+    parser = make_parser()
+    parser_result = parser.parse_args()
+
+    set_up_sample(parser, parser_result)
+    check_tools(parser_result)
+    set_up_run(parser_result)
+    run_sample(mp_fork, parser_result)
+    finish_run(parser_result)
+
+
+# Batch command, runs the samples of a manifest one after another with the shared reference work done once
+# Tools are checked once, the genome index built for the first sample and the parsed genome are reused,
+# And all samples share the warm worker pool, so the samples never use more than --threads workers together
+def batch_main(mp_fork, args):
+    batch_parser = argparse.ArgumentParser(prog="scavenger.py batch",
+                                           description="Runs Scavenger on the samples of a manifest. All the other\n"
+                                                       "options are Scavenger options shared by the samples, except\n"
+                                                       "--input, --output_prefix and --source_align_file",
+                                           formatter_class=argparse.RawTextHelpFormatter)
+    batch_parser.add_argument("--manifest", "-m",
+                              dest="manifest",
+                              required=True,
+                              help="Tab-separated file with one sample per line: the sample name, used as the\n"
+                                   "output prefix, the input reads and optionally the source alignment file")
+    batch_result, shared_args = batch_parser.parse_known_args(args)
+
+    global GENOME_CACHE
+    GENOME_CACHE = {}
+    parser = make_parser()
+    samples = read_manifest(batch_result.manifest)
+    genome_index = None
+    start_time = time.time()
+
+    for i, (sample, input_files, source_align_file) in enumerate(samples):
+        sample_args = shared_args + ["--input"] + input_files + ["--output_prefix", sample]
+        if source_align_file is not None:
+            sample_args += ["--source_align_file", source_align_file]
+
+        parser_result = parser.parse_args(sample_args)
+        set_up_sample(parser, parser_result)
+
+        if i == 0:
+            check_tools(parser_result)
+            set_up_run(parser_result)
+
+        if parser_result.genome_index is None:
+            parser_result.genome_index = genome_index
+
+        LOGGER.info("Sample %d of %d: %s" % (i + 1, len(samples), sample))
+        run_sample(mp_fork, parser_result)
+        genome_index = parser_result.genome_index
+
+    elapsed_time = time.time() - start_time
+    LOGGER.info("Completed %d samples in %.1f s (%.1f samples per hour)" %
+                (len(samples), elapsed_time, len(samples) / elapsed_time * 3600 if elapsed_time > 0 else 0))
+    if samples:
+        finish_run(parser_result)
+
+
+# Returns the samples of a manifest as (sample, input files, source alignment file or None)
+# Lines are tab-separated, empty lines and lines starting with # are skipped
+def read_manifest(manifest_file):
+    samples = []
+
+    with open(manifest_file) as f:
+        for line in f:
+            if not line.strip() or line.startswith("#"):
+                continue
+
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 2:
+                raise ValueError("Invalid manifest line, expected <sample> <input> [<source_align_file>]: %s" %
+                                 line.strip())
+
+            source_align_file = fields[2] if len(fields) > 2 and fields[2] else None
+            samples.append((fields[0], fields[1].split(), source_align_file))
+
+    return samples
+
+
+# Returns the argument parser of Scavenger
+def make_parser():
     parser = argparse.ArgumentParser(description="Scavenger", formatter_class=argparse.RawTextHelpFormatter)
     required_args = parser.add_argument_group("required arguments")
     add_args(parser, required_args)
     run_aligner.add_args(parser, required_args)
-    parser_result = parser.parse_args()
 
+    return parser
+
+
+# Fills in the defaults of a sample that depend on other arguments
+def set_up_sample(parser, parser_result):
+    source_genome_files = parser_result.genome_file.split(",")
+    parser_result.output_dir = parser_result.output_dir.rstrip("/")
+
+    if parser_result.profile_dir is not None:
+        parser_result.profile_dir = os.path.abspath(parser_result.profile_dir)
+
+    if parser_result.follow_up_aligner is None:
+        parser_result.follow_up_aligner = parser_result.aligner.lower()
+
+    # CRAM files are decoded and encoded with the reference, which defaults to the genome file if it is not gzipped
+    uses_cram = parser_result.cram_output or (parser_result.source_align_file or "").endswith(".cram")
+    if uses_cram and parser_result.reference is None:
+        if len(source_genome_files) == 1 and not source_genome_files[0].endswith(".gz"):
+            parser_result.reference = source_genome_files[0]
+        else:
+            parser.error("--reference is required for CRAM files when the genome file is gzipped or split")
+
+
+# Checks for the tools of the run
+def check_tools(parser_result):
     aligner = parser_result.aligner.lower()
+    build_aligner_index.check_tools(aligner)
+    run_aligner.check_tools(aligner)
+    follow_up_backend = aligner_backends.get_backend(parser_result.follow_up_aligner)
+    follow_up_backend.check_tools()
+
+    # BLASTN is only used for the rescue when the follow-up aligner is not in-process
+    if not follow_up_backend.in_process or parser_result.repeat_db:
+        try:
+            blast = Popen("blastn", stdout=PIPE, stderr=PIPE)
+            blast.communicate()
+        except Exception as e:
+            print("[blastn] Error encountered when being called. Script will not run")
+            print(e)
+            sys.exit(1)
+
+
+# Sets up the console logger and the profile directory of the run
+def set_up_run(parser_result):
+    global LOGGER
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(LOG_FORMATTER)
+    LOGGER.addHandler(console_handler)
+
+    if parser_result.profile_dir is not None:
+        parser_result.profile_dir = profiling.prepare_profile_dir(parser_result.profile_dir)
+
+
+# Shuts down the worker pool and merges the profiles of the run
+def finish_run(parser_result):
+    global LOGGER
+    worker_pool.shutdown_pool()
+
+    if parser_result.profile_dir is not None:
+        summary_files = profiling.merge_stage_profiles(parser_result.profile_dir, parser_result.profile_top)
+        LOGGER.info("Profile summaries written to %s" % ", ".join(summary_files))
+
+
+# Rescues the unmapped reads of a sample
+def run_sample(mp_fork, parser_result):
     bam_output = parser_result.bam_output
     input_files = parser_result.input
     source_genome_files = parser_result.genome_file.split(",")
     genome_index = parser_result.genome_index
-    parser_result.output_dir = parser_result.output_dir.rstrip("/")
     output_dir = parser_result.output_dir
     source_align_file = parser_result.source_align_file
 
-    build_aligner_index.check_tools(aligner)
-    run_aligner.check_tools(aligner)
-
-    try:
-        blast = Popen("blastn", stdout=PIPE, stderr=PIPE)
-        blast.communicate()
-    except Exception as e:
-        print("[blastn] Error encountered when being called. Script will not run")
-        print(e)
-        sys.exit(1)
-
     if parser_result.prefix is None:
         prefix = os.path.splitext(os.path.basename(input_files[0]))[0].rstrip(".fastq").rstrip(".fq")
     else:
@@ -94,31 +240,68 @@ def main(mp_fork, mp_spawn):
         except FileExistsError:
             pass
 
+    if parser_result.max_memory is not None:
+        TABLES.configure(parser_result.max_memory, "%s/rescue_tmp/spill" % (output_dir or "."))
+
     # Loggger file handler
     global LOGGER
-    log_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", datefmt="%Y-%m-%d %I:%M:%S %p")
     log_file_handler = logging.FileHandler("%s.log" % output_prefix, mode="w")
-    log_file_handler.setFormatter(log_formatter)
+    log_file_handler.setFormatter(LOG_FORMATTER)
     LOGGER.addHandler(log_file_handler)
 
-    # Logger console handler
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(log_formatter)
-    LOGGER.addHandler(console_handler)
+    unmapped_filter = read_filter.ReadFilter(parser_result.min_length, parser_result.max_n_fraction,
+                                             parser_result.min_mean_quality, parser_result.max_dust)
+    if not unmapped_filter.enabled:
+        unmapped_filter = None
+    prefilter_file = "%s_prefiltered.txt" % output_prefix
 
     # Source execution
+    extraction = None
     if source_align_file is None:
         LOGGER.info("Source execution...")
         if genome_index is None:
             parser_result.genome_index = build_aligner_index.build_index(parser_result)
 
-        source_align_file = run_aligner.run_aligner(parser_result)
+        stream_command = None
+        if parser_result.stream_source:
+            stream_command = aligner_backends.get_backend(parser_result.aligner).stream_command(
+                parser_result.genome_index, parser_result.input, output_prefix, parser_result.threads,
+                parser_result.aligner_extra_args or "")
+
+        # The extraction runs on the aligner output while the aligner runs, if the aligner can write SAM to stdout
+        if stream_command is not None and len(parser_result.input) == 1:
+            with profiling.profile_stage(parser_result.profile_dir, "extract"):
+                source_align_file, extraction = align_and_extract_source(parser_result, stream_command, output_prefix,
+                                                                         unmapped_filter, prefilter_file)
+        else:
+            source_backend = aligner_backends.get_backend(parser_result.aligner)
+            unmapped_args = source_backend.unmapped_reads_args() if parser_result.unmapped_fastx else None
+
+            if unmapped_args is not None:
+                parser_result.aligner_extra_args = ("%s %s" % (parser_result.aligner_extra_args or "",
+                                                               unmapped_args)).strip()
+            source_align_file = run_aligner.run_aligner(parser_result)
+
+            # The unmapped reads are taken from the FASTQ file written next to the source alignment file
+            if unmapped_args is not None and len(parser_result.input) == 1:
+                unmapped_fastq = source_backend.unmapped_reads_file(
+                    "%s/%s" % (os.path.dirname(source_align_file) or ".",
+                               run_aligner.get_prefix(parser_result.prefix, parser_result.input)))
+
+                with profiling.profile_stage(parser_result.profile_dir, "extract"):
+                    extraction = get_mapped_and_fastq_unmapped_reads(source_align_file, unmapped_fastq,
+                                                                     parser_result.reference, unmapped_filter,
+                                                                     prefilter_file)
         LOGGER.info("Completed source execution")
 
     if len(parser_result.input) == 2:
         raise NotImplementedError("Paired-end read recovery not yet supported.")
 
-    mapped_reads, unmapped_reads, count_summary = get_mapped_and_unmapped_reads(source_align_file)
+    if extraction is None:
+        with profiling.profile_stage(parser_result.profile_dir, "extract"):
+            extraction = get_mapped_and_unmapped_reads(source_align_file, parser_result.reference, unmapped_filter,
+                                                       prefilter_file, get_region_scan_threads(parser_result))
+    mapped_reads, unmapped_reads, read_name_table, count_summary = extraction
 
     num_mapped_reads, num_unmapped_reads, num_total_reads = \
         count_summary["mapped"], count_summary["unmapped"], count_summary["total"]
@@ -131,8 +314,8 @@ def main(mp_fork, mp_spawn):
     # Gets new alignments and some counting values
     LOGGER.info("Running follow-up execution for rescuing...")
     new_alignments, count_mapped_unmapped, count_unique, count_all = \
-        get_new_alignments(mp_fork, mp_spawn, mapped_reads, source_genome_files, parser_result, output_prefix,
-                           source_align_file, unmapped_reads)
+        get_new_alignments(mp_fork, mapped_reads, source_genome_files, parser_result, output_prefix,
+                           source_align_file, unmapped_reads, read_name_table)
     LOGGER.info("Completed follow-up execution")
 
     log_rescued_info(num_unmapped_reads, count_mapped_unmapped, count_unique, count_all)
@@ -145,33 +328,135 @@ def main(mp_fork, mp_spawn):
     LOGGER.info("Total number of mapped reads after rescue: %s" % format(new_total_mapped_reads, ",d"))
     LOGGER.info("Percentage of new mappability: %f" % (new_total_mapped_reads / num_total_reads * 100))
 
-    if bam_output:
+    if parser_result.cram_output:
+        new_align_file = "%s_rescued.cram" % output_prefix
+        rescued_only_file = "%s_rescued_only.cram" % output_prefix
+    elif bam_output:
         new_align_file = "%s_rescued.bam" % output_prefix
+        rescued_only_file = "%s_rescued_only.bam" % output_prefix
     else:
         new_align_file = "%s_rescued.sam" % output_prefix
+        rescued_only_file = "%s_rescued_only.bam" % output_prefix
+
+    if parser_result.delta_output:
+        # Only the rescued alignments and the ids of the reads they replace are written
+        # The new alignment file can be made later with "scavenger.py merge"
+        replaced_ids_file = "%s_replaced_ids.txt" % output_prefix
+        LOGGER.info("Writing rescued alignment file (%s) and replaced read ids (%s)..." %
+                    (rescued_only_file, replaced_ids_file))
+        with profiling.profile_stage(parser_result.profile_dir, "write"), \
+                open_alignment_file(source_align_file, parser_result.reference) as f:
+            h = open_output_alignment_file(rescued_only_file, f, parser_result.reference)
+            for read_id, alignments in new_alignments.items():
+                for alignment in alignments:
+                    h.write(make_aligned_segment(alignment, read_name_table[read_id]))
+            h.close()
+
+            with open(replaced_ids_file, "w") as g:
+                for read_id in sorted(new_alignments.keys()):
+                    g.write("%d\n" % read_id)
+        LOGGER.info("Completed writing rescued alignment file")
+    else:
+        LOGGER.info("Writing new alignment file (%s)..." % new_align_file)
+        with profiling.profile_stage(parser_result.profile_dir, "write"), \
+                open_alignment_file(source_align_file, parser_result.reference) as f:
+            g = open_output_alignment_file(new_align_file, f, parser_result.reference)
+            h = open_output_alignment_file(rescued_only_file, f, parser_result.reference)
+            for read_id, r in iterate_read_ids(f):
+                if read_id is None or read_id not in new_alignments:
+                    g.write(r)
+
+            for read_id, alignments in new_alignments.items():
+                for alignment in alignments:
+                    aligned_segment = make_aligned_segment(alignment, read_name_table[read_id])
+                    g.write(aligned_segment)
+                    h.write(aligned_segment)
+
+            g.close()
+            h.close()
+        LOGGER.info("Completed writing new alignment file")
+
+    if TABLES.spill_dir is not None:
+        shutil.rmtree(TABLES.spill_dir, ignore_errors=True)
 
-    LOGGER.info("Writing new alignment file (%s)..." % new_align_file)
-    with pysam.AlignmentFile(source_align_file) as f:
-        if bam_output:
-            g = pysam.AlignmentFile(new_align_file, "wb", template=f)
-        else:
-            g = pysam.AlignmentFile(new_align_file, "wh", template=f)
+    LOGGER.info("Rescue mission finished!")
+    LOGGER.removeHandler(log_file_handler)
+    log_file_handler.close()
 
-        h = pysam.AlignmentFile("%s_rescued_only.bam" % output_prefix, "wb", template=f)
-        for r in f:
-            if r.query_name not in new_alignments:
-                g.write(r)
 
-        for query_name in new_alignments.keys():
-            for alignment in new_alignments[query_name]:
-                g.write(alignment)
-                h.write(alignment)
+# Merge command, applies the output of a --delta run to the source alignment file
+# Writes the source records except the primary records of the replaced reads, followed by the rescued records
+# The source file is streamed once and the output can be written to stdout for downstream tools
+def merge_main(args):
+    parser = argparse.ArgumentParser(prog="scavenger.py merge",
+                                     description="Applies the output of a --delta run to the source alignment file",
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    required_args = parser.add_argument_group("required arguments")
+    required_args.add_argument("--source_align_file", "-sf",
+                               dest="source_align_file",
+                               required=True,
+                               help="The source SAM, BAM or CRAM file of the --delta run")
+    required_args.add_argument("--rescued", "-d",
+                               dest="rescued_file",
+                               required=True,
+                               help="The _rescued_only file of the --delta run")
+    required_args.add_argument("--replaced_ids",
+                               dest="replaced_ids_file",
+                               required=True,
+                               help="The _replaced_ids.txt file of the --delta run")
+    parser.add_argument("--output", "-o",
+                        dest="output_file",
+                        default="-",
+                        help="The merged SAM, BAM or CRAM file, by extension (Default: SAM to stdout)")
+    parser.add_argument("--reference",
+                        dest="reference",
+                        help="Reference FASTA to decode and encode CRAM files")
+    parser_result = parser.parse_args(args)
+
+    merge_delta(parser_result.source_align_file, parser_result.rescued_file, parser_result.replaced_ids_file,
+                parser_result.output_file, parser_result.reference)
+
+
+# Writes the source records that are not replaced and then the rescued records
+# The replaced read ids are sorted, so they are read alongside the source records without being loaded
+def merge_delta(source_align_file, rescued_file, replaced_ids_file, output_file, reference=None):
+    with open_alignment_file(source_align_file, reference) as f, open(replaced_ids_file) as ids, \
+            open_alignment_file(rescued_file, reference) as rescued:
+        g = open_output_alignment_file(output_file, f, reference)
+        next_replaced_id = read_next_id(ids)
+
+        for read_id, r in iterate_read_ids(f):
+            if read_id is not None and read_id == next_replaced_id:
+                next_replaced_id = read_next_id(ids)
+                continue
+
+            g.write(r)
+
+        for r in rescued:
+            g.write(r)
 
         g.close()
-        h.close()
-    LOGGER.info("Completed writing new alignment file")
 
-    LOGGER.info("Rescue mission finished!")
+
+# Returns the next read id of a sorted read id file, or None at the end of the file
+def read_next_id(f):
+    line = f.readline()
+
+    return int(line) if line else None
+
+
+# Converts a count that must be at least 1, used as an argparse type
+def positive_int(s):
+    try:
+        value = int(s)
+    except ValueError:
+        value = 0
+
+    if value < 1:
+        error = "Invalid value: %s (Must be an integer of at least 1)" % s
+        raise argparse.ArgumentTypeError(error)
+
+    return value
 
 
 def add_args(parser, required_args):
@@ -190,11 +475,56 @@ def add_args(parser, required_args):
                         default="",
                         nargs="?",
                         help="Extra argument to be passed to aligner index build")
+    parser.add_argument("--follow_up_aligner_tool", "-fat",
+                        dest="follow_up_aligner",
+                        type=run_aligner.aligner_string,
+                        help="Aligner to be used for the follow-up and rescue alignments (%s)\n"
+                             "(Default: same as --aligner_tool)" % aligner_backends.backend_names())
+    parser.add_argument("--follow_up_engine",
+                        dest="follow_up_engine",
+                        default="aligner",
+                        choices=["aligner", "native"],
+                        help="Engine to find the mapped reads that overlap the unmapped reads. \"native\" matches\n"
+                             "them in-process with a minimizer index instead of building an index of the unmapped\n"
+                             "reads and running the follow-up aligner (Default: %(default)s)")
     parser.add_argument("--consensus_threshold", "-c",
                         dest="consensus_threshold",
                         default=0.6,
                         type=float,
                         help="Consensus threshold (Default: %(default)s)")
+    parser.add_argument("--no_region_scan",
+                        action="store_true",
+                        dest="no_region_scan",
+                        help="Reads coordinate-sorted and indexed source alignment files sequentially instead of\n"
+                             "scanning their regions, in parallel in the worker pool with more than one thread.\n"
+                             "Region scans skip the empty contigs and let the info extraction read only the\n"
+                             "regions with wanted reads")
+    parser.add_argument("--unmapped_fastx",
+                        action="store_true",
+                        dest="unmapped_fastx",
+                        help="Also asks the source aligner for a FASTQ file of the unmapped reads (STAR\n"
+                             "--outReadsUnmapped Fastx) and takes the unmapped reads from it, so the source\n"
+                             "alignment file is only read for the names, flags and NH tags. Only used without\n"
+                             "--source_align_file and --stream_source, with aligners that can write the file")
+    parser.add_argument("--stream_source",
+                        action="store_true",
+                        dest="stream_source",
+                        help="Streams the SAM output of the source aligner (e.g. STAR --outStd SAM) into the\n"
+                             "extraction of mapped and unmapped reads while the source alignment file is written\n"
+                             "from the same stream. Only used without --source_align_file, aligners that cannot\n"
+                             "write SAM to stdout fall back to extracting from the written file")
+    parser.add_argument("--stream_follow_up",
+                        action="store_true",
+                        dest="stream_follow_up",
+                        help="Streams the SAM output of the follow-up aligner (e.g. STAR --outStd SAM) into the\n"
+                             "follow-up step while the aligner runs, instead of writing and reading back a BAM\n"
+                             "file. Aligners that cannot write SAM to stdout fall back to the BAM file")
+    parser.add_argument("--max_fan_in",
+                        dest="max_fan_in",
+                        type=positive_int,
+                        help="Maximum number of mapped reads used in the consensus of an unmapped read. Unmapped\n"
+                             "reads linked to more mapped reads use a deterministic sample stratified by reference\n"
+                             "(Default: all mapped reads are used)")
     parser.add_argument("--blast_perc_identity",
                         dest="blast_identity",
                         default=84,
@@ -205,79 +535,432 @@ def add_args(parser, required_args):
                         default=65,
                         type=int,
                         help="The minimum percentage of query coverage for BLASTN (Default: %(default)s)")
+    parser.add_argument("--max_window_length",
+                        dest="max_window_length",
+                        default=0,
+                        type=int,
+                        help="Merges overlapping rescue windows on the same reference into shared targets of up to\n"
+                             "this length, so that dense loci need fewer rescue alignments (Default: %(default)s,\n"
+                             "windows are not merged)")
+    parser.add_argument("--max_window_gap",
+                        dest="max_window_gap",
+                        default=MAX_WINDOW_GAP,
+                        type=int,
+                        help="Largest gap between two rescue windows merged by --max_window_length\n"
+                             "(Default: %(default)s)")
+    parser.add_argument("--tool_concurrency",
+                        dest="tool_concurrency",
+                        type=positive_int,
+                        help="Runs the rescue tool calls as asyncio subprocesses from the main process, with at most\n"
+                             "this many tools running at once, independently of --threads. The alignment files are\n"
+                             "parsed in a pool of --threads processes (Default: each of the --threads rescue\n"
+                             "processes runs one tool at a time)")
+    parser.add_argument("--adaptive_concurrency",
+                        action="store_true",
+                        dest="adaptive_concurrency",
+                        help="Adapts the number of tasks and tools in flight in each stage to the idle CPUs and\n"
+                             "the available memory of the node while the stage runs, up to the usual limits.\n"
+                             "Meant for shared nodes (Default: the limits are fixed by --threads)")
+    parser.add_argument("--rescue_cache",
+                        dest="rescue_cache",
+                        help="SQLite file to cache the rescue outcomes of unmapped reads across samples and runs,\n"
+                             "keyed by the read sequence, the target genome and the rescue settings. Cached reads\n"
+                             "are not aligned again (Default: no cache)")
+    parser.add_argument("--min_length",
+                        dest="min_length",
+                        type=int,
+                        help="Prefilter: drops unmapped reads shorter than this length (Default: not checked)")
+    parser.add_argument("--max_n_fraction",
+                        dest="max_n_fraction",
+                        type=float,
+                        help="Prefilter: drops unmapped reads with a larger fraction of N bases\n"
+                             "(Default: not checked)")
+    parser.add_argument("--min_mean_quality",
+                        dest="min_mean_quality",
+                        type=float,
+                        help="Prefilter: drops unmapped sequences whose best read has a lower mean Phred\n"
+                             "quality (Default: not checked)")
+    parser.add_argument("--max_dust",
+                        dest="max_dust",
+                        type=float,
+                        help="Prefilter: drops low-complexity unmapped reads with a higher DUST score, e.g. 7.\n"
+                             "Homopolymers score about half their length (Default: not checked)")
     parser.add_argument("--repeat_db", "-r",
                         help="Location of index file for tandem repeat database, e.g. from RepBase")
+    parser.add_argument("--early_repeat_filter",
+                        action="store_true",
+                        dest="early_repeat_filter",
+                        help="Screens the unique unmapped sequences against the repeat database before the\n"
+                             "follow-up alignment, so repeat reads are left out of the artificial genome.\n"
+                             "Ignored with --new_align_file")
+    parser.add_argument("--repeat_threads",
+                        dest="repeat_threads",
+                        type=int,
+                        default=1,
+                        help="Number of BLAST threads of each repeat filter chunk, chunks run in parallel on\n"
+                             "the remaining threads (Default: 1)")
+    parser.add_argument("--repeat_cache",
+                        dest="repeat_cache",
+                        help="SQLite file to cache the repeat verdict of each unmapped sequence across samples\n"
+                             "and runs, keyed by the checksum of the repeat database (Default: no cache)")
     parser.add_argument("--source_align_file", "-sf",
                         dest="source_align_file",
-                        help="The source SAM file")
+                        help="The source SAM, BAM or CRAM file")
+    parser.add_argument("--reference",
+                        dest="reference",
+                        help="Reference FASTA to decode and encode CRAM files (Default: the genome file if it is\n"
+                             "a single uncompressed FASTA)")
+    parser.add_argument("--cram",
+                        action="store_true",
+                        dest="cram_output",
+                        help="CRAM output file format for the rescued alignment files (Default: --bam or SAM)")
+    parser.add_argument("--delta",
+                        action="store_true",
+                        dest="delta_output",
+                        help="Writes only the rescued alignments and a sorted list of the ids of the reads they\n"
+                             "replace instead of the new alignment file, which can be made with\n"
+                             "\"scavenger.py merge\"")
+    parser.add_argument("--max_memory",
+                        dest="max_memory",
+                        type=spill_store.memory_size,
+                        help="Memory budget for the intermediate read tables, e.g. 16G. Tables are spilled to\n"
+                             "disk-backed stores with bounded in-memory caches once the budget is reached\n"
+                             "(Default: all tables are kept in memory)")
+    parser.add_argument("--profile",
+                        dest="profile_dir",
+                        help="Directory to store cProfile stats of each stage and worker process, merged per stage\n"
+                             "into <stage>.prof and a <stage>.txt summary")
+    parser.add_argument("--profile_top",
+                        dest="profile_top",
+                        default=30,
+                        type=int,
+                        help="Number of functions listed in each profile summary (Default: %(default)s)")
     parser.add_argument("--new_align_file", "-nf",
                         dest="new_align_file",
                         help=argparse.SUPPRESS)
+    parser.add_argument("--new_align_read_ids",
+                        action="store_true",
+                        dest="new_align_read_ids",
+                        help=argparse.SUPPRESS)
     parser.add_argument("--new_input", "-ni",
                         dest="new_input",
                         help=argparse.SUPPRESS)
 
 
-# Returns a dict of unmapped reads and a set of mapped reads
-def get_mapped_and_unmapped_reads(source_align_file):
+# Returns a dict of unmapped read ids by sequence, a hashed index of uniquely mapped reads
+# And a table of the names of the unmapped reads
+# Read ids are the positions of the primary records in the source alignment file
+# Unmapped sequences that fail the unmapped filter are left out and their reads are written to the prefilter file
+# Coordinate-sorted and indexed files are scanned by region if pool threads are given, in the worker pool if there
+# is more than one, so that later passes can skip the regions without wanted reads
+def get_mapped_and_unmapped_reads(source_align_file, reference=None, unmapped_filter=None, prefilter_file=None,
+                                  pool_threads=None):
     global LOGGER
     LOGGER.info("Extracting mapped and unmapped reads from source alignment file (%s)..." % source_align_file)
 
-    mapped_reads = set()
-    unmapped_reads = defaultdict(list)
-    best_unmapped_read = {}
-    count_summary = defaultdict(int)
+    extractor = ReadExtractor()
+    with open_alignment_file(source_align_file, reference) as f:
+        scan_by_region = pool_threads is not None and region_scan.is_region_scannable(f)
+        regions = region_scan.get_regions(f) if scan_by_region else None
 
-    with pysam.AlignmentFile(source_align_file) as f:
-        for r in f:
-            if r.is_secondary or r.is_supplementary:
+        if not scan_by_region:
+            for read_id, r in iterate_read_ids(f):
+                extractor.add(read_id, r)
+
+    if scan_by_region:
+        import numpy as np
+
+        LOGGER.info("Scanning %d regions of the indexed source alignment file" % len(regions))
+
+        # Read ids of each region start after the read ids of the regions before it, as in the file order
+        layout = []
+        first_read_id = 0
+        region_results = map_regions(functools.partial(extract_regions, source_align_file, reference), regions,
+                                     pool_threads)
+
+        for region, (num_read_ids, num_mapped, mapped_hashes, mapped_ids, unmapped_records) in \
+                zip(regions, region_results):
+            extractor.add_mapped_hashes(num_mapped, mapped_hashes, np.frombuffer(mapped_ids, dtype=np.uint64) +
+                                        np.uint64(first_read_id))
+            for read_id, query_name, query_sequence, quality_score in unmapped_records:
+                extractor.add_unmapped(first_read_id + read_id, query_name, query_sequence, quality_score)
+
+            layout.append((region, first_read_id, num_read_ids))
+            first_read_id += num_read_ids
+
+        SOURCE_LAYOUTS[source_align_file] = layout
+
+    return extractor.finish(unmapped_filter, prefilter_file)
+
+
+# Returns the same tables as get_mapped_and_unmapped_reads, with the unmapped reads taken from a FASTQ file of the
+# aligner (e.g. STAR Unmapped.out.mate1) that holds the same reads as the unmapped records of the alignment file
+# The alignment file is only read for the names, flags and NH tags, and the unmapped reads get the read ids of their
+# unmapped records
+def get_mapped_and_fastq_unmapped_reads(source_align_file, unmapped_fastq, reference=None, unmapped_filter=None,
+                                        prefilter_file=None):
+    global LOGGER
+    LOGGER.info("Extracting mapped reads from source alignment file (%s) and unmapped reads from %s..." %
+                (source_align_file, unmapped_fastq))
+
+    extractor = ReadExtractor()
+    unmapped_read_ids = {}
+    with open_alignment_file(source_align_file, reference) as f:
+        for read_id, r in iterate_read_ids(f):
+            if read_id is None:
                 continue
 
             if r.is_unmapped:
-                count_summary["unmapped"] += 1
-                current_quality_score = sum(r.query_qualities)
-
-                best_query_name, best_query_quality_score = best_unmapped_read.get(r.query_sequence, (None, -1))
-                if current_quality_score > best_query_quality_score:
-                    best_unmapped_read[r.query_sequence] = (r.query_name, current_quality_score)
+                unmapped_read_ids[r.query_name] = read_id
+            else:
+                extractor.add(read_id, r)
+
+    unmapped_records = []
+    with open(unmapped_fastq) as f:
+        for header in f:
+            sequence = f.readline().rstrip()
+            f.readline()
+            quality = f.readline().rstrip()
+            query_name = header[1:].split()[0]
+
+            read_id = unmapped_read_ids.pop(query_name, None)
+            if read_id is not None:
+                unmapped_records.append((read_id, query_name, sequence, sum(quality.encode()) - 33 * len(quality)))
+
+    if unmapped_read_ids:
+        raise RuntimeError("%d unmapped reads of %s are missing from %s" %
+                           (len(unmapped_read_ids), source_align_file, unmapped_fastq))
+
+    # Unmapped reads are added in the order of the alignment file, as in get_mapped_and_unmapped_reads
+    unmapped_records.sort()
+    for read_id, query_name, sequence, quality_score in unmapped_records:
+        extractor.add_unmapped(read_id, query_name, sequence, quality_score)
+
+    return extractor.finish(unmapped_filter, prefilter_file)
+
+
+# Calls func on chunks of one item in the worker pool, or in the current process with a single thread
+# And yields the results in order
+def map_regions(func, items, pool_threads):
+    if pool_threads > 1:
+        return worker_pool.map_chunks(worker_pool.get_pool(pool_threads), func, items, 1, 2 * pool_threads)
+
+    return itertools.chain.from_iterable(func([item]) for item in items)
+
+
+# Extracts the mapped and unmapped reads of a chunk of regions of a coordinate-sorted file
+# Returns for each region the number of read ids, the number of mapped reads, the name hashes and the read ids of
+# the uniquely mapped reads and the read id, name, sequence and quality score of each unmapped read
+# Read ids are local to each region
+def extract_regions(source_align_file, reference, regions):
+    from array import array
+
+    results = []
+    with open_alignment_file(source_align_file, reference) as f:
+        for region in regions:
+            read_id = 0
+            num_mapped = 0
+            mapped_hashes = array("Q")
+            mapped_ids = array("Q")
+            unmapped_records = []
+
+            for r in region_scan.fetch_region(f, region):
+                if r.is_secondary or r.is_supplementary:
+                    continue
 
-                    if best_query_name:
-                        unmapped_reads[r.query_sequence].append(best_query_name)
+                if r.is_unmapped:
+                    unmapped_records.append((read_id, r.query_name, r.query_sequence, sum(r.query_qualities)))
                 else:
-                    unmapped_reads[r.query_sequence].append(r.query_name)
-            else:
-                count_summary["mapped"] += 1
-                if r.get_tag("NH") == 1:
-                    mapped_reads.add(r.query_name)
+                    num_mapped += 1
+                    if r.get_tag("NH") == 1:
+                        mapped_hashes.append(read_names.hash_name(r.query_name))
+                        mapped_ids.append(read_id)
+                read_id += 1
+
+            results.append((read_id, num_mapped, mapped_hashes.tobytes(), mapped_ids.tobytes(), unmapped_records))
+
+    return results
+
+
+# Returns the number of pool threads scanning indexed source files by region, or None if region scans are disabled
+def get_region_scan_threads(parser_result):
+    return None if parser_result.no_region_scan else parser_result.threads
+
+
+# Accumulates the tables of get_mapped_and_unmapped_reads from the records of the source alignment, in file order
+# So that they can be built from a file or from the stream of the source aligner
+class ReadExtractor(object):
+    def __init__(self):
+        self.mapped_reads = read_names.HashedNameIndex()
+        self.unmapped_reads = TABLES.dict("unmapped_reads", list)
+        self.read_name_table = read_names.NameTable()
+        self.best_unmapped_read = TABLES.dict("best_unmapped_read")
+        self.count_summary = defaultdict(int)
+
+    # Adds a record with its read id, records without a read id are skipped
+    def add(self, read_id, r):
+        if read_id is None:
+            return
 
-    for sequence, best_query in best_unmapped_read.items():
-        unmapped_reads[sequence].append(best_query[0])
+        if r.is_unmapped:
+            self.add_unmapped(read_id, r.query_name, r.query_sequence, sum(r.query_qualities))
+        else:
+            self.count_summary["mapped"] += 1
+            if r.get_tag("NH") == 1:
+                self.mapped_reads.add(r.query_name, read_id)
+
+    # Adds an unmapped read, the quality score is the sum of its base qualities
+    def add_unmapped(self, read_id, query_name, query_sequence, quality_score):
+        self.count_summary["unmapped"] += 1
+        self.read_name_table.add(read_id, query_name)
+
+        best_read_id, best_query_quality_score = self.best_unmapped_read.get(query_sequence, (None, -1))
+        if quality_score > best_query_quality_score:
+            self.best_unmapped_read[query_sequence] = (read_id, quality_score)
+
+            if best_read_id is not None:
+                self.unmapped_reads[query_sequence].append(best_read_id)
+        else:
+            self.unmapped_reads[query_sequence].append(read_id)
+
+    # Adds a number of mapped reads and the name hashes and the read ids of the uniquely mapped ones
+    def add_mapped_hashes(self, num_mapped, mapped_hashes, mapped_ids):
+        import numpy as np
+
+        self.count_summary["mapped"] += num_mapped
+        self.mapped_reads.add_hashes(np.frombuffer(mapped_hashes, dtype=np.uint64), mapped_ids)
+
+    # Returns the tables once all the records have been added
+    def finish(self, unmapped_filter=None, prefilter_file=None):
+        global LOGGER
+
+        for sequence, best_query in self.best_unmapped_read.items():
+            self.unmapped_reads[sequence].append(best_query[0])
+
+        if unmapped_filter is not None:
+            prefilter_unmapped_reads(self.unmapped_reads, self.best_unmapped_read, unmapped_filter,
+                                     self.read_name_table, prefilter_file)
+
+        self.best_unmapped_read.clear()
+        self.mapped_reads.freeze()
+        self.count_summary["total"] = self.count_summary["mapped"] + self.count_summary["unmapped"]
+        LOGGER.info("Completed extracting required info")
+
+        return self.mapped_reads, self.unmapped_reads, self.read_name_table, self.count_summary
+
+
+# Runs the source alignment with its SAM output piped into the extraction
+# The records are written to the source alignment file as they are read, so the file is not read back
+# Returns the source alignment file and the tables of get_mapped_and_unmapped_reads
+def align_and_extract_source(parser_result, command, output_prefix, unmapped_filter=None, prefilter_file=None):
+    global LOGGER
+
+    backend = aligner_backends.get_backend(parser_result.aligner)
+    _, source_align_file = backend.align_command(parser_result.genome_index, parser_result.input, output_prefix,
+                                                 parser_result.threads, parser_result.aligner_extra_args or "",
+                                                 parser_result.bam_output)
+
+    # The aligner messages are also written to the aligner log file, as with run_aligner
+    if not parser_result.quiet:
+        log_file_handler = logging.FileHandler("%s_aligner.log" % output_prefix)
+        log_file_handler.setFormatter(LOG_FORMATTER)
+        LOGGER.addHandler(log_file_handler)
+
+    LOGGER.info("Aligning reads using %s and extracting mapped and unmapped reads from its output..." %
+                backend.display_name)
+
+    extractor = ReadExtractor()
+    try:
+        with aligner_backends.open_sam_stream(backend.display_name, command, LOGGER) as f, \
+                open_output_alignment_file(source_align_file, f, parser_result.reference) as g:
+            for read_id, r in iterate_read_ids(f):
+                g.write(r)
+                extractor.add(read_id, r)
+
+        if parser_result.clean_files:
+            backend.clean_up(output_prefix)
+
+        LOGGER.info("Source alignment file written (%s)" % source_align_file)
+    finally:
+        if not parser_result.quiet:
+            LOGGER.removeHandler(log_file_handler)
+            log_file_handler.close()
+
+    return source_align_file, extractor.finish(unmapped_filter, prefilter_file)
 
-    best_unmapped_read.clear()
-    count_summary["total"] = count_summary["mapped"] + count_summary["unmapped"]
-    LOGGER.info("Completed extracting required info")
 
-    return mapped_reads, unmapped_reads, count_summary
+# Removes the unmapped sequences that fail the filter and writes the names of their reads and the reasons to a file
+# The mean quality of a sequence is the mean quality of its best read
+def prefilter_unmapped_reads(unmapped_reads, best_unmapped_read, unmapped_filter, read_name_table, prefilter_file):
+    global LOGGER
+
+    num_seqs = len(best_unmapped_read)
+    seq_counts = defaultdict(int)
+    read_counts = defaultdict(int)
+    best_reads = iter(best_unmapped_read.items())
+
+    with open(prefilter_file, "w") as f:
+        while True:
+            batch = list(itertools.islice(best_reads, read_filter.NUM_SEQS_PER_BATCH))
+            if not batch:
+                break
+
+            sequences = [sequence for sequence, _ in batch]
+            mean_qualities = [quality_sum / max(len(sequence), 1) for sequence, (_, quality_sum) in batch]
+
+            for sequence, reason in zip(sequences, unmapped_filter.get_reasons(sequences, mean_qualities)):
+                if reason is None:
+                    continue
+
+                read_ids = unmapped_reads.pop(sequence)
+                seq_counts[reason] += 1
+                read_counts[reason] += len(read_ids)
+                for read_id in sorted(read_ids):
+                    f.write("%s\t%s\n" % (read_name_table[read_id], reason))
+
+    for reason in read_filter.REASONS:
+        if reason in seq_counts:
+            LOGGER.info("Prefilter (%s): %s unique seqs, %s unmapped reads" %
+                        (reason, format(seq_counts[reason], ",d"), format(read_counts[reason], ",d")))
+    LOGGER.info("Prefilter: %s of %s unique seqs of unmapped reads removed" %
+                (format(sum(seq_counts.values()), ",d"), format(num_seqs, ",d")))
 
 
 # Returns a dict of new alignments for the unmapped reads and some counting values
-def get_new_alignments(mp_fork, mp_spawn, mapped_reads, source_genome_files, parser_result,
-                       output_prefix, source_align_file, unmapped_reads):
+def get_new_alignments(mp_fork, mapped_reads, source_genome_files, parser_result,
+                       output_prefix, source_align_file, unmapped_reads, read_name_table):
+    global LOGGER
+
+    # The early filter changes the artificial genome, so it cannot be used with a given follow-up alignment
+    early_repeat_filter = parser_result.repeat_db and parser_result.early_repeat_filter and \
+        parser_result.new_align_file is None
+    if early_repeat_filter:
+        with profiling.profile_stage(parser_result.profile_dir, "repeat_filter"):
+            remove_repeat_reads(unmapped_reads, parser_result, output_prefix, read_name_table)
+
     if parser_result.new_align_file is None:
         # Rebuilds aligner index and rerun alignment with new input and genome
+        spill_store.flush(unmapped_reads)
         results = mp_fork.Queue()
         procs = []
+        num_ref, new_aligner_index = None, None
 
         # Starts a process to write the new genome file and build the new aligner index
-        proc = mp_fork.Process(target=build_follow_up_index,
-                               args=(unmapped_reads, parser_result, len(unmapped_reads) * BIN_SIZE, results))
-        proc.start()
-        procs.append(proc)
+        # The native engine matches against the unmapped reads directly and needs neither
+        if parser_result.follow_up_engine != "native":
+            target, args = profiling.worker_target(parser_result.profile_dir, "follow_up_index",
+                                                   build_follow_up_index,
+                                                   (unmapped_reads, parser_result, len(unmapped_reads) * BIN_SIZE,
+                                                    results))
+            proc = mp_fork.Process(target=target, args=args)
+            proc.start()
+            procs.append(proc)
 
         # Starts a process to write the new input file
-        proc = mp_fork.Process(target=make_new_input,
-                               args=(parser_result.input[0].split(","), mapped_reads, parser_result.output_dir,
-                                     results))
+        target, args = profiling.worker_target(parser_result.profile_dir, "follow_up_input", make_new_input,
+                                               (parser_result.input[0].split(","), mapped_reads,
+                                                parser_result.output_dir, results))
+        proc = mp_fork.Process(target=target, args=args)
         proc.start()
         procs.append(proc)
 
@@ -287,53 +970,73 @@ def get_new_alignments(mp_fork, mp_spawn, mapped_reads, source_genome_files, par
             while not results.empty():
                 result = results.get()
 
-                if len(result) == 1:
-                    new_input = result
+                if result[0] == "input":
+                    _, new_input, mapped_duplicates = result
                 else:
-                    num_ref, new_aligner_index = result
+                    _, num_ref, new_aligner_index = result
 
             if not running:
                 break
 
         mapped_reads.clear()
-        new_align_file = run_follow_up_alignment(parser_result, new_aligner_index, new_input, num_ref)
     else:
-        new_align_file = parser_result.new_align_file
+        mapped_duplicates = {}
 
     # Extracts mapped and unmapped reads that have alignment with each other
-    art_aligned_mapped_reads, art_aligned_unmapped_reads = get_art_aligned_reads(new_align_file, unmapped_reads)
+    with profiling.profile_stage(parser_result.profile_dir, "follow_up"):
+        if parser_result.new_align_file is not None:
+            new_alignment_hits = get_read_id_hits(aligner_backends.read_alignment_hits(parser_result.new_align_file),
+                                                  mapped_reads, parser_result.new_align_read_ids)
+        elif parser_result.follow_up_engine == "native":
+            from utils import follow_up_matcher
+
+            LOGGER.info("Matching mapped reads to unmapped reads using the native engine...")
+            new_alignment_hits = follow_up_matcher.match_reads(sorted(unmapped_reads.keys()), new_input, BIN_SIZE,
+                                                               NUM_READ_PER_CHR)
+        else:
+            new_alignment_hits = run_follow_up_alignment(parser_result, new_aligner_index, new_input, num_ref)
+
+        art_aligned_mapped_reads, art_aligned_unmapped_reads = \
+            get_art_aligned_reads(new_alignment_hits, unmapped_reads, mapped_duplicates)
+    mapped_reads.clear()
+    mapped_duplicates.clear()
     count_mapped_unmapped = len(art_aligned_unmapped_reads)
-    global LOGGER
     LOGGER.info("Total unmapped reads have alignment: %s" % format(count_mapped_unmapped, ",d"))
 
-    unmapped_names = {}
-    for seq in unmapped_reads.keys():
-        unmapped_names[unmapped_reads[seq][-1]] = unmapped_reads[seq]
+    unmapped_names = TABLES.dict("unmapped_names")
+    for seq, names in unmapped_reads.items():
+        unmapped_names[names[-1]] = names
     unmapped_reads.clear()
 
     # Stores mapped and unmapped reads info from the source sam file
-    mapped_reads_info, unmapped_reads_info = \
-        make_read_info(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads)
-
-    grouped_unmapped_reads = get_consensus_reads(mp_fork, parser_result, art_aligned_unmapped_reads, mapped_reads_info)
+    with profiling.profile_stage(parser_result.profile_dir, "read_info"):
+        mapped_reads_info, unmapped_reads_info = \
+            make_read_info(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads,
+                           parser_result.reference, get_region_scan_threads(parser_result))
+
+    with profiling.profile_stage(parser_result.profile_dir, "consensus"):
+        grouped_unmapped_reads = get_consensus_reads(parser_result, art_aligned_unmapped_reads,
+                                                     mapped_reads_info)
     mapped_reads_info.clear()
 
-    if parser_result.repeat_db:
-        new_grouped_unmapped_reads = get_new_unmapped_reads(grouped_unmapped_reads, unmapped_reads_info,
-                                                            parser_result.repeat_db, output_prefix)
+    if parser_result.repeat_db and not early_repeat_filter:
+        with profiling.profile_stage(parser_result.profile_dir, "repeat_filter"):
+            new_grouped_unmapped_reads = get_new_unmapped_reads(grouped_unmapped_reads, unmapped_reads_info,
+                                                                parser_result, output_prefix, read_name_table)
     else:
         new_grouped_unmapped_reads = grouped_unmapped_reads
 
-    new_alignments, count_unique, count_all, failed_unmapped = \
-        get_rescued_reads(mp_spawn, source_genome_files, new_grouped_unmapped_reads, unmapped_reads_info, parser_result,
-                          source_align_file, unmapped_names)
+    with profiling.profile_stage(parser_result.profile_dir, "rescue"):
+        new_alignments, count_unique, count_all, failed_unmapped = \
+            get_rescued_reads(source_genome_files, new_grouped_unmapped_reads, unmapped_reads_info,
+                              parser_result, source_align_file, unmapped_names)
 
     if failed_unmapped:
         failed_unmapped_file = "%s_failed.txt" % output_prefix
 
         with open(failed_unmapped_file, "w") as f:
-            for query_name in failed_unmapped.keys():
-                f.write("%s\t%s\n" % (query_name, failed_unmapped[query_name]))
+            for read_id in failed_unmapped.keys():
+                f.write("%s\t%s\n" % (read_name_table[read_id], failed_unmapped[read_id]))
         LOGGER.warning("%d out of the %d reads failed to be rescued due to failure in tool" %
                        (len(failed_unmapped), count_mapped_unmapped))
         LOGGER.warning("These reads' query names and sequences are stored in %s" % failed_unmapped_file)
@@ -343,22 +1046,28 @@ def get_new_alignments(mp_fork, mp_spawn, mapped_reads, source_genome_files, par
 
 # Builds the follow up aligner index
 def build_follow_up_index(unmapped_reads, parser_result, genome_length, results):
-    aligner = parser_result.aligner.lower()
+    backend = aligner_backends.get_backend(parser_result.follow_up_aligner)
     output_dir = parser_result.output_dir
     new_genome, num_ref = make_new_genome(unmapped_reads, output_dir, "unmapped_genome")
 
-    if aligner == "star":
-        parser_result.builder_extra_args = "--genomeChrBinNbits %d --genomeSAindexNbases %d" % \
-                                           (min(18, int(math.log(genome_length / num_ref, 2))),
-                                            min(14, int(math.log(genome_length, 2) / 2) - 1))
-    parser_result.genome_file = "/".join(new_genome.split("/")[:-1]) if aligner == "bismark" else new_genome
+    # The index is named after the new genome file, so that it does not replace the index of the source genome
+    parser_result = argparse.Namespace(**vars(parser_result))
+    parser_result.prefix = None
+    parser_result.aligner = backend.name
+    parser_result.builder_extra_args = backend.follow_up_index_args(genome_length, num_ref)
+
+    # With adaptive concurrency, make_new_input keeps a CPU and the index uses the idle CPUs left
+    if parser_result.adaptive_concurrency:
+        parser_result.threads = max(min(parser_result.threads - 1, int(governor.read_idle_cpus())), 1)
+
+    parser_result.genome_file = new_genome
     parser_result.annotation = None
     new_genome_index = build_aligner_index.build_index(parser_result)
 
     global LOGGER
     LOGGER.info("Waiting for new input files...")
 
-    results.put((num_ref, new_genome_index))
+    results.put(("index", num_ref, new_genome_index))
 
 
 # Creates a new genome file with unmapped reads, returns the file"s name and the genome"s length
@@ -386,12 +1095,17 @@ def make_new_genome(unmapped_reads, output_dir, filename):
     return new_genome, chr_num + 1
 
 
-# Creates new input files with mapped reads only and returns the names of the files
+# Creates new input files with mapped reads only, named by their read ids, and returns the names of the files
+# Mapped reads with identical sequences are collapsed into the first of them, the representative
+# Also returns a dict of the read ids of the other reads of each collapsed sequence by representative
 def make_new_input(input_files, mapped_reads, output_dir, results):
     global LOGGER
     LOGGER.info("Making new input files with mapped reads only...")
 
     new_input = ""
+    representatives = {}
+    mapped_duplicates = defaultdict(list)
+    num_mapped_reads = 0
 
     for input_file in input_files:
         if input_file.endswith(".gz"):
@@ -403,16 +1117,34 @@ def make_new_input(input_files, mapped_reads, output_dir, results):
         new_input += ",%s" % new_input_file
         fq_reads = []
 
+        # Looks up the reads in batches against the hashed set of mapped reads
         while True:
-            fq_read = list(itertools.islice(f, 4))
+            fq_batch = []
+            query_names = []
+
+            for fq_read in iter(lambda: list(itertools.islice(f, 4)), []):
+                fq_batch.append(fq_read)
+                query_names.append(fq_read[0].split("@")[-1].split(" ")[0].strip())
+
+                if len(fq_batch) == NUM_FASTQ_READS_PER_BATCH:
+                    break
 
-            if not fq_read:
+            if not fq_batch:
                 break
 
-            query_name = fq_read[0].split("@")[-1].split(" ")[0].strip()
+            # Reads are renamed with their read ids
+            for fq_read, read_id in zip(fq_batch, mapped_reads.lookup_many(query_names)):
+                if read_id < 0:
+                    continue
+
+                read_id = int(read_id)
+                num_mapped_reads += 1
+                representative = representatives.setdefault(fq_read[1], read_id)
 
-            if query_name in mapped_reads:
-                fq_reads.append("".join(fq_read))
+                if representative == read_id:
+                    fq_reads.append("@%d\n%s" % (read_id, "".join(fq_read[1:])))
+                else:
+                    mapped_duplicates[representative].append(read_id)
 
         f.close()
 
@@ -424,169 +1156,268 @@ def make_new_input(input_files, mapped_reads, output_dir, results):
     new_input = re.sub(" ,", " ", new_input, 1)
     new_input = new_input.strip().split(" ")
 
+    LOGGER.info("Collapsed %s mapped reads into %s unique sequences" %
+                (format(num_mapped_reads, ",d"), format(len(representatives), ",d")))
     LOGGER.info("Completed making new input files")
 
-    results.put(new_input)
+    results.put(("input", new_input, dict(mapped_duplicates)))
 
 
-# Builds new index and aligns with new input and new genome and returns the name of the new sam file
+# Aligns the new input to the new genome and returns an iterator of the new alignments
+# In-process backends stream their alignments directly, the others are read back from the new alignment file
 def run_follow_up_alignment(parser_result, new_genome_index, new_input, num_ref):
-    aligner = parser_result.aligner.lower()
-    old_bam_output = parser_result.bam_output
+    global LOGGER
+    backend = aligner_backends.get_backend(parser_result.follow_up_aligner)
+
+    if backend.in_process:
+        LOGGER.info("Aligning reads in-process using %s..." % backend.display_name)
 
-    if aligner == "star":
-        parser_result.aligner_extra_args = "--outFilterMultimapNmax %d --alignIntronMax 1 --seedSearchStartLmax 30" % \
-                                           num_ref
+        return backend.align_stream(new_genome_index, new_input, None, threads=parser_result.threads,
+                                    extra_args=backend.follow_up_align_args(num_ref), logger=LOGGER)
+
+    # The follow-up alignment is named after the new input files, so that it does not replace the source alignment
+    # The options of the follow-up alignment are set on a copy, the genome index and the input of the sample are kept
+    parser_result = argparse.Namespace(**vars(parser_result))
+    parser_result.prefix = None
+
+    # The aligner writes SAM to stdout and the hits are read while it runs, without an alignment file
+    if parser_result.stream_follow_up:
+        prefix = run_aligner.get_prefix(parser_result.prefix, new_input)
+        output_prefix = prefix if parser_result.output_dir is None else "%s/%s" % (parser_result.output_dir, prefix)
+
+        return backend.align_piped(new_genome_index, new_input, output_prefix, threads=parser_result.threads,
+                                   extra_args=backend.follow_up_align_args(num_ref), logger=LOGGER)
+
+    parser_result.aligner = backend.name
+    parser_result.aligner_extra_args = backend.follow_up_align_args(num_ref)
     parser_result.genome_index = new_genome_index
     parser_result.input = new_input
     parser_result.bam_output = True
     new_align_file = run_aligner.run_aligner(parser_result)
-    parser_result.bam_output = old_bam_output
 
-    return new_align_file
+    return aligner_backends.read_alignment_hits(new_align_file)
+
+
+# Yields the hits of a given follow-up alignment with their query names replaced by read ids
+# If the aligned reads are named with read ids (see make_new_input), the names are taken as they are
+# Otherwise, query names are looked up in the hashed index of uniquely mapped reads in batches
+# Hits whose read id is not found are skipped
+def get_read_id_hits(alignment_hits, mapped_reads, named_by_read_ids=False):
+    global LOGGER
+    alignment_hits = iter(alignment_hits)
+
+    while True:
+        hits = list(itertools.islice(alignment_hits, NUM_FASTQ_READS_PER_BATCH))
+        if not hits:
+            break
+
+        if named_by_read_ids:
+            read_ids = [int(hit.query_name) if hit.query_name.isdigit() else -1 for hit in hits]
+        else:
+            read_ids = mapped_reads.lookup_many([hit.query_name for hit in hits])
+
+        for hit, read_id in zip(hits, read_ids):
+            if read_id >= 0:
+                yield hit._replace(query_name=int(read_id))
+            else:
+                LOGGER.debug("Skipping the alignment of %s, which is not a uniquely mapped read" % hit.query_name)
 
 
 # Returns a dict of list of unmapped reads that are aligned with mapped reads
 # And their corresponded list of mapped reads
 # And returns a set of mapped reads that have alignment with unmapped reads
-def get_art_aligned_reads(new_align_file, unmapped_reads):
+# Alignments of collapsed representatives are expanded to all the mapped reads with the same sequence
+def get_art_aligned_reads(new_alignment_hits, unmapped_reads, mapped_duplicates):
     global BIN_SIZE, NUM_READ_PER_CHR, LOGGER
 
-    LOGGER.info("Reading new alignment file (%s)..." % new_align_file)
+    LOGGER.info("Reading new alignments...")
 
-    art_aligned_unmapped_reads = defaultdict(list)
-    art_aligned_mapped_reads = set()
+    art_aligned_unmapped_reads = TABLES.dict("art_aligned_unmapped_reads", list)
+    art_aligned_mapped_reads = TABLES.set("art_aligned_mapped_reads")
 
     unmapped_reads_list = sorted(list(unmapped_reads.keys()))
-    with pysam.AlignmentFile(new_align_file) as f:
-        for r in f:
-            if r.is_unmapped:
-                continue
+    for hit in new_alignment_hits:
+        query_name = int(hit.query_name)
+        chr_num = int(hit.reference_name.split("_")[-1])
 
-            query_name = r.query_name
-            chr_num = int(r.reference_name.split("_")[-1])
-            ref_alignment_loc = r.get_reference_positions()
+        if hit.reference_end - hit.reference_start < 2:
+            LOGGER.debug("Skipping the alignment of read %s shorter than 2 bases (%d-%d)" %
+                         (query_name, hit.reference_start, hit.reference_end))
+            continue
 
-            if len(ref_alignment_loc) < 2:
-                print("Being passed due to position < 2?", query_name, ref_alignment_loc)
-                continue
+        ref_start_bin = hit.reference_start // BIN_SIZE
+        ref_end_bin = (hit.reference_end - 1) // BIN_SIZE
 
-            ref_start_bin = ref_alignment_loc[0] // BIN_SIZE
-            ref_end_bin = ref_alignment_loc[-1] // BIN_SIZE
+        if ref_start_bin != ref_end_bin:  # Reads with unintended new junction
+            continue
 
-            if ref_start_bin != ref_end_bin:  # Reads with unintended new junction
-                continue
+        reference_name = unmapped_reads[unmapped_reads_list[chr_num * NUM_READ_PER_CHR + ref_start_bin]][-1]
+        art_aligned_unmapped_reads[reference_name].append(query_name)
+        art_aligned_mapped_reads.add(query_name)
 
-            reference_name = unmapped_reads[unmapped_reads_list[chr_num * NUM_READ_PER_CHR + ref_start_bin]][-1]
-            art_aligned_unmapped_reads[reference_name].append(query_name)
-            art_aligned_mapped_reads.add(query_name)
+        if query_name in mapped_duplicates:
+            art_aligned_unmapped_reads[reference_name].extend(mapped_duplicates[query_name])
+            art_aligned_mapped_reads.update(mapped_duplicates[query_name])
 
-    LOGGER.info("Completed reading new alignment file")
+    LOGGER.info("Completed reading new alignments")
 
     return art_aligned_mapped_reads, art_aligned_unmapped_reads
 
 
 # Creates an index of the source sam file
-def make_read_info(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads):
+def make_read_info(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads, reference=None,
+                   pool_threads=None):
+    import pysam
+
     global LOGGER
     LOGGER.info("Extracting info from source SAM file (%s)..." % source_align_file)
 
-    mapped_reads_info = {}
-    unmapped_reads_info = {}
+    mapped_reads_info = TABLES.dict("mapped_reads_info")
+    unmapped_reads_info = TABLES.dict("unmapped_reads_info")
 
-    with pysam.AlignmentFile(source_align_file) as f:
-        for r in f:
-            if r.is_secondary or r.is_supplementary:
+    # Files scanned by region during the extraction are read by region again
+    if pool_threads is not None and source_align_file in SOURCE_LAYOUTS:
+        make_read_info_by_region(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads, reference,
+                                 pool_threads, mapped_reads_info, unmapped_reads_info)
+        LOGGER.info("Completed info extraction")
+
+        return mapped_reads_info, unmapped_reads_info
+
+    with open_alignment_file(source_align_file, reference) as f:
+        for read_id, r in iterate_read_ids(f):
+            if read_id is None:
                 continue
 
-            query_name = r.query_name
-            sequence = r.query_sequence
             is_spliced = False
 
             if not r.is_unmapped:
-                if query_name in art_aligned_mapped_reads:
+                if read_id in art_aligned_mapped_reads:
                     if "N" in r.cigarstring:
                         is_spliced = True
 
-                    mapped_reads_info[query_name] = (r.reference_id, r.reference_start, r.reference_end,
-                                                     r.mapping_quality, is_spliced)
+                    mapped_reads_info[read_id] = (r.reference_id, r.reference_start, r.reference_end,
+                                                  r.mapping_quality, is_spliced)
             else:
-                if query_name in art_aligned_unmapped_reads:
-                    unmapped_reads_info[query_name] = (sequence, pysam.qualities_to_qualitystring(r.query_qualities))
+                if read_id in art_aligned_unmapped_reads:
+                    unmapped_reads_info[read_id] = (r.query_sequence,
+                                                    pysam.qualities_to_qualitystring(r.query_qualities))
 
     LOGGER.info("Completed info extraction")
 
     return mapped_reads_info, unmapped_reads_info
 
 
+# Adds the info of the wanted reads to the tables, with the regions of the source file read in the worker pool
+# Only the regions that hold wanted reads are read
+def make_read_info_by_region(source_align_file, art_aligned_mapped_reads, art_aligned_unmapped_reads, reference,
+                             pool_threads, mapped_reads_info, unmapped_reads_info):
+    import numpy as np
+
+    wanted_mapped = np.sort(np.fromiter(art_aligned_mapped_reads, dtype=np.int64))
+    wanted_unmapped = np.sort(np.fromiter(art_aligned_unmapped_reads.keys(), dtype=np.int64))
+
+    tasks = []
+    for region, first_read_id, num_read_ids in SOURCE_LAYOUTS[source_align_file]:
+        end_read_id = first_read_id + num_read_ids
+        region_mapped = wanted_mapped[np.searchsorted(wanted_mapped, first_read_id):
+                                      np.searchsorted(wanted_mapped, end_read_id)]
+        region_unmapped = wanted_unmapped[np.searchsorted(wanted_unmapped, first_read_id):
+                                          np.searchsorted(wanted_unmapped, end_read_id)]
+
+        if len(region_mapped) or len(region_unmapped):
+            tasks.append((region, first_read_id, region_mapped - first_read_id, region_unmapped - first_read_id))
+
+    global LOGGER
+    LOGGER.info("Reading %d of %d regions with wanted reads" % (len(tasks), len(SOURCE_LAYOUTS[source_align_file])))
+
+    task = functools.partial(get_region_read_info, source_align_file, reference)
+    for first_read_id, region_mapped_info, region_unmapped_info in map_regions(task, tasks, pool_threads):
+        for read_id, info in region_mapped_info:
+            mapped_reads_info[first_read_id + read_id] = info
+        for read_id, info in region_unmapped_info:
+            unmapped_reads_info[first_read_id + read_id] = info
+
+
+# Returns the info of the wanted reads of a chunk of regions, with the read ids local to each region
+# Items are the region, its first read id and the sorted local read ids of the wanted mapped and unmapped reads
+def get_region_read_info(source_align_file, reference, items):
+    import pysam
+
+    results = []
+    with open_alignment_file(source_align_file, reference) as f:
+        for region, first_read_id, mapped_ids, unmapped_ids in items:
+            mapped_ids, unmapped_ids = set(mapped_ids.tolist()), set(unmapped_ids.tolist())
+            region_mapped_info, region_unmapped_info = [], []
+            read_id = 0
+
+            for r in region_scan.fetch_region(f, region):
+                if r.is_secondary or r.is_supplementary:
+                    continue
+
+                if not r.is_unmapped:
+                    if read_id in mapped_ids:
+                        region_mapped_info.append((read_id, (r.reference_id, r.reference_start, r.reference_end,
+                                                             r.mapping_quality, "N" in r.cigarstring)))
+                elif read_id in unmapped_ids:
+                    region_unmapped_info.append((read_id, (r.query_sequence,
+                                                           pysam.qualities_to_qualitystring(r.query_qualities))))
+                read_id += 1
+
+            results.append((first_read_id, region_mapped_info, region_unmapped_info))
+
+    return results
+
+
 # Returns a dict using reference name as the key and store the unmapped reads that passed consensus check
-def get_consensus_reads(mp_fork, parser_result, art_aligned_unmapped_reads, mapped_reads_info):
+def get_consensus_reads(parser_result, art_aligned_unmapped_reads, mapped_reads_info):
     global LOGGER
     LOGGER.info("Grouping consensus reads...")
 
     consensus_threshold = parser_result.consensus_threshold
-    output_dir = parser_result.output_dir
     threads = parser_result.threads
     grouped_unmapped_reads = defaultdict(dict)
     count_passed_consensus = 0
-    procs = []
+    count_capped = 0
 
-    tasks = mp_fork.JoinableQueue()
-    results = mp_fork.Queue()
+    tasks = (make_consensus_task(unmapped_name, unmapped_read_mapped_list, mapped_reads_info, parser_result.max_fan_in)
+             for unmapped_name, unmapped_read_mapped_list in art_aligned_unmapped_reads.items())
+    task = profiling.pool_task(parser_result.profile_dir, "consensus",
+                               functools.partial(check_reads_consensus, consensus_threshold))
 
-    # Starts processing the tasks
-    for _ in range(threads):
-        proc = mp_fork.Process(target=check_reads_consensus,
-                               args=(mapped_reads_info, consensus_threshold, tasks, results))
-        proc.start()
-        procs.append(proc)
+    for unmapped_name, target_list, is_capped in \
+            worker_pool.map_chunks(worker_pool.get_pool(threads), task, tasks, NUM_CONSENSUS_READS_PER_CHUNK,
+                                   2 * threads, make_pool_governor(parser_result, 2 * threads)):
+        count_capped += is_capped
 
-    for item in art_aligned_unmapped_reads.items():
-        tasks.put(item)
+        if target_list:
+            count_passed_consensus += 1
 
-    for _ in range(threads):
-        tasks.put(None)
+            for ref_id, start, end, is_spliced in target_list:
+                key = (start, end, is_spliced)
+                if key in grouped_unmapped_reads[ref_id]:
+                    grouped_unmapped_reads[ref_id][key].append(unmapped_name)
+                else:
+                    grouped_unmapped_reads[ref_id][key] = [unmapped_name]
 
     art_aligned_unmapped_reads.clear()
 
-    # Waits for all processes to join
-    tasks.join()
-
-    while True:
-        running = any(proc.is_alive() for proc in procs)
-
-        while not results.empty():
-            unmapped_name, target_list = results.get()
-
-            if target_list:
-                count_passed_consensus += 1
-
-                for ref_id, start, end, is_spliced in target_list:
-                    key = (start, end, is_spliced)
-                    if key in grouped_unmapped_reads[ref_id]:
-                        grouped_unmapped_reads[ref_id][key].append(unmapped_name)
-                    else:
-                        grouped_unmapped_reads[ref_id][key] = [unmapped_name]
-
-        if not running:
-            break
-
     LOGGER.info("Completed grouping consensus reads")
     LOGGER.info("Total unmapped aligned with mapped passed consensus: %s" % format(count_passed_consensus, ",d"))
+    if parser_result.max_fan_in is not None:
+        LOGGER.info("Total unmapped with consensus capped at %s mapped reads: %s" %
+                    (format(parser_result.max_fan_in, ",d"), format(count_capped, ",d")))
 
     return grouped_unmapped_reads
 
 
 # Checks for consensus info for potential rescue locations
-def check_reads_consensus(mapped_reads_info, consensus_threshold, tasks, results):
-    while True:
-        item = tasks.get()
+# Takes a chunk of unmapped reads with the info of their mapped reads and returns a result for each of them
+def check_reads_consensus(consensus_threshold, items):
+    from intervaltree import IntervalTree
 
-        if item is None:
-            tasks.task_done()
-            break
+    results = []
 
-        unmapped_name, unmapped_read_mapped_list = item
+    for unmapped_name, unmapped_read_mapped_list, mapped_reads_info, is_capped in items:
         grouped_reads = defaultdict(list)
         mapped_locs = defaultdict(IntervalTree)
         ref_id_count = defaultdict(int)
@@ -612,8 +1443,7 @@ def check_reads_consensus(mapped_reads_info, consensus_threshold, tasks, results
                 potential_ref_id.append(ref_id)
 
         if len(potential_ref_id) == 0:
-            results.put((unmapped_name, target_reads))
-            tasks.task_done()
+            results.append((unmapped_name, target_reads, is_capped))
             continue
 
         # Merges identical intervals
@@ -634,97 +1464,108 @@ def check_reads_consensus(mapped_reads_info, consensus_threshold, tasks, results
 
             target_reads = target_scores[max(target_scores.keys())]
 
-        results.put((unmapped_name, target_reads))
-        tasks.task_done()
+        results.append((unmapped_name, target_reads, is_capped))
+
+    return results
+
+
+# Returns the consensus task of an unmapped read, which carries the info of its mapped reads so the workers need no
+# tables, and whether its mapped reads have been capped
+# Mapped reads above max_fan_in are sampled here, so only the sampled reads are looked up and sent to the workers
+def make_consensus_task(unmapped_name, unmapped_read_mapped_list, mapped_reads_info, max_fan_in):
+    is_capped = max_fan_in is not None and len(unmapped_read_mapped_list) > max_fan_in
+    if is_capped:
+        unmapped_read_mapped_list = sample_mapped_reads(unmapped_name, unmapped_read_mapped_list,
+                                                        mapped_reads_info, max_fan_in)
+
+    return (unmapped_name, unmapped_read_mapped_list,
+            {mapped_name: mapped_reads_info[mapped_name] for mapped_name in unmapped_read_mapped_list}, is_capped)
+
+
+# Returns a sample of max_fan_in mapped reads stratified by reference
+# Each reference keeps its share of the mapped reads (largest remainder rounding), so the consensus fractions
+# Are preserved, and the sample is seeded by the unmapped read id so reruns give the same result
+def sample_mapped_reads(unmapped_name, unmapped_read_mapped_list, mapped_reads_info, max_fan_in):
+    strata = defaultdict(list)
+    for mapped_name in unmapped_read_mapped_list:
+        strata[mapped_reads_info[mapped_name][0]].append(mapped_name)
+
+    total = len(unmapped_read_mapped_list)
+    quotas = {ref_id: len(names) * max_fan_in // total for ref_id, names in strata.items()}
+    remainders = sorted(strata.keys(), key=lambda ref_id: (-(len(strata[ref_id]) * max_fan_in % total), ref_id))
+    for ref_id in remainders[:max_fan_in - sum(quotas.values())]:
+        quotas[ref_id] += 1
+
+    rng = random.Random(unmapped_name)
+    sampled = []
+    for ref_id in sorted(strata.keys()):
+        sampled.extend(rng.sample(strata[ref_id], quotas[ref_id]))
+
+    return sampled
 
 
 # Gets rescued reads' alignments
-def get_rescued_reads(mp_spawn, source_genome_files, grouped_unmapped_reads, unmapped_reads_info, parser_result,
+def get_rescued_reads(source_genome_files, grouped_unmapped_reads, unmapped_reads_info, parser_result,
                       source_align_file, unmapped_names):
+    import asyncio
+
     global LOGGER
     LOGGER.info("Rescuing unmapped reads...")
 
     threads = parser_result.threads
-    tasks = mp_spawn.JoinableQueue()
-    results = mp_spawn.Queue()
-    procs = []
+    pool = worker_pool.get_pool(threads)
     new_aligned_names = defaultdict(list)
     failed_unmapped = {}
-    new_alignments = defaultdict(list)
-
-    # Starts the processes
-    for _ in range(threads):
-        proc = mp_spawn.Process(target=rescue_reads,
-                                args=(tasks, results, parser_result))
-        proc.start()
-        procs.append(proc)
+    new_alignments = TABLES.dict("new_alignments", list)
+    window_counts = defaultdict(int)
+    backend = aligner_backends.get_backend(parser_result.follow_up_aligner)
+    use_async = parser_result.tool_concurrency is not None and not backend.in_process
 
-    with pysam.AlignmentFile(source_align_file) as f:
+    with open_alignment_file(source_align_file, parser_result.reference) as f:
         all_references = list(f.references)
 
-    # Fills the tasks queue
-    for genome_file in source_genome_files:
-        if genome_file.endswith(".gz"):
-            f = gzip.open(genome_file, "rt")
-        else:
-            f = open(genome_file, "r")
-
-        for record in SeqIO.parse(f, "fasta"):
-            genome_ref_id = all_references.index(record.id)
-
-            if genome_ref_id in grouped_unmapped_reads:
-                genome_seq = record.seq
-
-                # Stores a target genome for each unmapped read
-                for key in grouped_unmapped_reads[genome_ref_id]:
-                    start, end, is_spliced = key
-                    # unmapped_seq, unmapped_qual = unmapped_reads_info[unmapped_name]
-                    # extend_len = len(unmapped_seq)
-                    extend_len = 100
+    rescue_tasks = iterate_rescue_tasks(source_genome_files, grouped_unmapped_reads, unmapped_reads_info,
+                                        all_references, parser_result.max_window_length,
+                                        parser_result.max_window_gap, window_counts)
+
+    # Reads with a cached outcome are resolved here, the other reads are dispatched and their outcomes stored
+    cache = None
+    if parser_result.rescue_cache is not None:
+        cache = rescue_cache.RescueCache(parser_result.rescue_cache)
+        cached_results = []
+        dispatched_keys = deque()
+        rescue_tasks = apply_rescue_cache(rescue_tasks, cache, get_rescue_settings(parser_result), all_references,
+                                          cached_results, dispatched_keys)
+
+    # Results are lists of the results of each task, in the order of the tasks
+    if use_async:
+        task_results = asyncio.run(rescue_reads_async(pool, rescue_tasks, backend, parser_result))
+    else:
+        task = profiling.pool_task(parser_result.profile_dir, "rescue", functools.partial(rescue_reads, parser_result))
+        task_results = worker_pool.map_chunks(pool, task, rescue_tasks, 1, 2 * threads,
+                                              make_pool_governor(parser_result, 2 * threads))
 
-                    # Extracts a target genome with the info of where the mapped read was mapped
-                    start -= extend_len
-                    start = 0 if start < 0 else start
-                    end += extend_len
-                    end = len(genome_seq) if end > len(genome_seq) else end
-                    target_genome_seq = genome_seq[start:end]
+    for results in task_results:
+        if cache is not None:
+            store_rescue_results(cache, dispatched_keys.popleft(), results)
 
-                    unmapped_info = {}
-                    for unmapped_name in grouped_unmapped_reads[genome_ref_id][key]:
-                        unmapped_seq, unmapped_qual = unmapped_reads_info[unmapped_name]
-                        unmapped_info[unmapped_name] = unmapped_seq, unmapped_qual
+        for result in results:
+            add_rescue_result(result, new_aligned_names, failed_unmapped)
 
-                    tasks.put((unmapped_info, genome_ref_id, start, is_spliced, target_genome_seq))
+    if cache is not None:
+        for result in cached_results:
+            add_rescue_result(result, new_aligned_names, failed_unmapped)
 
-        f.close()
+        LOGGER.info("Rescue cache hits: %s of %s reads in targets" %
+                    (format(cache.hits, ",d"), format(cache.hits + cache.misses, ",d")))
+        cache.close()
 
-    for _ in range(threads):
-        tasks.put(None)
+    if window_counts["targets"] < window_counts["windows"]:
+        LOGGER.info("Merged %s rescue windows into %s targets" % (format(window_counts["windows"], ",d"),
+                                                                  format(window_counts["targets"], ",d")))
 
     grouped_unmapped_reads.clear()
     unmapped_reads_info.clear()
-    tasks.join()
-
-    while True:
-        running = any(proc.is_alive() for proc in procs)
-
-        while not results.empty():
-            result = results.get()
-
-            if len(result) == 2:
-                unmapped_name, unmapped_seq = result
-                failed_unmapped[unmapped_name] = unmapped_seq
-            else:
-                aligned_segment = pysam.AlignedSegment()
-                aligned_segment.query_name, aligned_segment.flag, aligned_segment.reference_id, \
-                    aligned_segment.reference_start, aligned_segment.mapping_quality, aligned_segment.cigarstring, \
-                    aligned_segment.next_reference_id, aligned_segment.next_reference_start, \
-                    aligned_segment.template_length, aligned_segment.query_sequence, aligned_segment.query_qualities, \
-                    aligned_segment.tags = result
-                new_aligned_names[aligned_segment.query_name].append(aligned_segment)
-
-        if not running:
-            break
 
     new_new_alignments = {}
     for new_name in new_aligned_names.keys():
@@ -732,13 +1573,11 @@ def get_rescued_reads(mp_spawn, source_genome_files, grouped_unmapped_reads, unm
         if num_mapping == 1:
             new_new_alignments[new_name] = new_aligned_names[new_name]
 
+    # Alignments are kept as tuples of their fields and only made into AlignedSegment when written
     for new_name in new_new_alignments.keys():
         for query_name in unmapped_names[new_name]:
             for alignment in new_new_alignments[new_name]:
-                new_alignment = copy.deepcopy(alignment)
-                new_alignment.query_name = query_name
-
-                new_alignments[query_name].append(new_alignment)
+                new_alignments[query_name].append(alignment)
 
     count_unique = len(new_new_alignments)
     count_all = len(new_alignments)
@@ -748,153 +1587,425 @@ def get_rescued_reads(mp_spawn, source_genome_files, grouped_unmapped_reads, unm
     return new_alignments, count_unique, count_all, failed_unmapped
 
 
-# Rescues unmapped reads, returns some counting info and a list of the info of the new alignment
-# New alignment will be length of 1 if no consensus, and length of 2 if the tools have failed to finish
-def rescue_reads(tasks, results, parser_result):
-    aligner = parser_result.aligner.lower()
+# Yields a rescue task for each target genome, made of a rescue window or of a group of merged windows
+# Counts the windows and the targets in window_counts
+def iterate_rescue_tasks(source_genome_files, grouped_unmapped_reads, unmapped_reads_info, all_references,
+                         max_window_length, max_window_gap, window_counts):
+    for record_id, genome_seq in iterate_genome_records(source_genome_files):
+        genome_ref_id = all_references.index(record_id)
+
+        if genome_ref_id in grouped_unmapped_reads:
+            for start, end, is_spliced, windows in merge_windows(grouped_unmapped_reads[genome_ref_id],
+                                                                 len(genome_seq), max_window_length,
+                                                                 max_window_gap):
+                window_counts["windows"] += len(windows)
+                window_counts["targets"] += 1
+                target_genome_seq = genome_seq[start:end]
+
+                # Windows of each unmapped read relative to the target genome
+                unmapped_info = {}
+                read_windows = defaultdict(list)
+                for window_start, window_end, unmapped_names_list in windows:
+                    for unmapped_name in unmapped_names_list:
+                        unmapped_info[unmapped_name] = unmapped_reads_info[unmapped_name]
+                        read_windows[unmapped_name].append((window_start - start, window_end - start))
+
+                yield unmapped_info, genome_ref_id, start, is_spliced, target_genome_seq, read_windows
+
+
+# Returns the governor of the chunks in flight in the worker pool, which is fixed to max_pending by default
+def make_pool_governor(parser_result, max_pending):
+    return governor.Governor(max_pending, parser_result.adaptive_concurrency, get_pids=worker_pool.get_worker_pids)
+
+
+# Returns the settings that affect the rescue outcomes, which are part of the rescue cache keys
+def get_rescue_settings(parser_result):
+    return (parser_result.follow_up_aligner, parser_result.blast_identity, parser_result.blast_query_coverage)
+
+
+# Yields the rescue tasks with only the reads that have no cached outcome, tasks without such reads are skipped
+# The results of the cached outcomes are added to cached_results
+# And the cache keys of the reads of each dispatched task are added to dispatched_keys, in the order of the tasks
+def apply_rescue_cache(rescue_tasks, cache, settings, all_references, cached_results, dispatched_keys):
+    for unmapped_info, ref_id, start, is_spliced, genome_seq, read_windows in rescue_tasks:
+        target_hash = rescue_cache.hash_sequence(genome_seq)
+        keys = {}
+        for unmapped_name, (unmapped_seq, _) in unmapped_info.items():
+            keys[unmapped_name] = rescue_cache.make_key(rescue_cache.hash_sequence(unmapped_seq), target_hash,
+                                                        all_references[ref_id], start, start + len(genome_seq),
+                                                        is_spliced, read_windows[unmapped_name], settings)
+
+        outcomes = cache.get_many(keys.values())
+        uncached_info = {}
+        for unmapped_name, key in keys.items():
+            if key in outcomes:
+                for cached_result in outcomes[key]:
+                    cached_results.append(make_cached_rescue_result(unmapped_name, cached_result,
+                                                                    unmapped_info[unmapped_name][1], ref_id, start))
+            else:
+                uncached_info[unmapped_name] = unmapped_info[unmapped_name]
+
+        if uncached_info:
+            dispatched_keys.append((start, {unmapped_name: keys[unmapped_name] for unmapped_name in uncached_info}))
+            yield uncached_info, ref_id, start, is_spliced, genome_seq, read_windows
+
+
+# Stores the outcomes of the reads of a dispatched task, reads whose tools have failed are not stored
+# Alignments are stored relative to the target genome and without the read id and qualities
+def store_rescue_results(cache, task_keys, results):
+    start, keys = task_keys
+    outcomes = {unmapped_name: [] for unmapped_name in keys}
+
+    for result in results:
+        if len(result) == 2:
+            outcomes.pop(result[0], None)
+        elif result[0] in outcomes:
+            outcomes[result[0]].append((result[1], result[3] - start) + tuple(result[4:10]) + (result[11],))
+
+    cache.put_many((keys[unmapped_name], outcome) for unmapped_name, outcome in outcomes.items())
+
+
+# Returns the info of a new alignment from a cached outcome, with the qualities of the unmapped read
+def make_cached_rescue_result(unmapped_name, cached_result, unmapped_qual, ref_id, start):
+    flag, reference_start, mapping_quality, cigarstring, next_reference_id, next_reference_start, template_length, \
+        query_sequence, tags = cached_result
+    new_qualities = get_rescue_qualities(cigarstring, bool(flag & 16), unmapped_qual)
+
+    return (unmapped_name, flag, ref_id, start + reference_start, mapping_quality, cigarstring, next_reference_id,
+            next_reference_start, template_length, query_sequence, new_qualities, tags)
+
+
+# Yields the id and the sequence of each record of the genome files
+# In batch mode the records are cached, so the genome files are only parsed for the first sample
+def iterate_genome_records(genome_files):
+    from Bio import SeqIO
+
+    key = tuple(genome_files)
+    if GENOME_CACHE is not None and key in GENOME_CACHE:
+        for record in GENOME_CACHE[key]:
+            yield record
+        return
+
+    records = []
+    for genome_file in genome_files:
+        if genome_file.endswith(".gz"):
+            f = gzip.open(genome_file, "rt")
+        else:
+            f = open(genome_file, "r")
+
+        for record in SeqIO.parse(f, "fasta"):
+            if GENOME_CACHE is not None:
+                records.append((record.id, str(record.seq)))
+
+            yield record.id, record.seq
+
+        f.close()
+
+    if GENOME_CACHE is not None:
+        GENOME_CACHE[key] = records
+
+
+# Adds a result of the rescue step, which is either the info of a new alignment
+# Or the name and the sequence of an unmapped read whose tools have failed
+def add_rescue_result(result, new_aligned_names, failed_unmapped):
+    if len(result) == 2:
+        unmapped_name, unmapped_seq = result
+        failed_unmapped[unmapped_name] = unmapped_seq
+    else:
+        new_aligned_names[result[0]].append(result)
+
+
+# Returns the rescue windows of a reference as (start, end, is_spliced, windows) targets
+# Each window is the location of a mapped read extended on both sides, as (start, end, unmapped names)
+# Windows of the same type that overlap or are at most max_gap apart are merged into one target as long as it stays
+# within max_length
+def merge_windows(grouped_windows, genome_len, max_length, max_gap=0):
+    windows = []
+    for key in grouped_windows:
+        start, end, is_spliced = key
+        start = max(start - WINDOW_EXTEND_LEN, 0)
+        end = min(end + WINDOW_EXTEND_LEN, genome_len)
+        windows.append((is_spliced, start, end, grouped_windows[key]))
+
+    targets = []
+    for is_spliced, start, end, unmapped_names_list in sorted(windows, key=lambda x: x[:3]):
+        if targets:
+            target_start, target_end, target_spliced, target_windows = targets[-1]
+
+            if target_spliced == is_spliced and start <= target_end + max_gap and \
+                    max(end, target_end) - target_start <= max_length:
+                target_windows.append((start, end, unmapped_names_list))
+                targets[-1] = (target_start, max(end, target_end), target_spliced, target_windows)
+                continue
+
+        targets.append((start, end, is_spliced, [(start, end, unmapped_names_list)]))
+
+    return targets
+
+
+# Rescues the unmapped reads of a chunk of target genomes and returns a list of the results of each target
+# A result is the info of a new alignment, or the name and the sequence of an unmapped read if the tools have failed
+def rescue_reads(parser_result, items):
+    backend = aligner_backends.get_backend(parser_result.follow_up_aligner)
     output_dir = parser_result.output_dir
+    results = []
 
-    while True:
-        item = tasks.get()
+    for item in items:
+        unmapped_info, ref_id, start, is_spliced, genome_seq, read_windows = item
+        item_results = []
+        results.append(item_results)
 
-        if item is None:
-            tasks.task_done()
-            break
+        # In-process backends align against the target sequence directly without any intermediate files
+        if backend.in_process:
+            try:
+                for r in backend.align_to_target(genome_seq, unmapped_info, is_spliced,
+                                                 parser_result.blast_identity, parser_result.blast_query_coverage):
+                    item_results.extend(get_rescue_results(r, unmapped_info, ref_id, start, read_windows))
+            except RuntimeError:
+                for unmapped_name in unmapped_info:
+                    unmapped_seq = unmapped_info[unmapped_name][0]
+                    item_results.append((unmapped_name, unmapped_seq))
 
-        unmapped_info, ref_id, start, is_spliced, genome_seq = item
+            continue
 
         rescue_tmp_dir = output_dir + "/rescue_tmp"
         random_prefix = random_string(10)
         temp_dir = "%s/%s_temp" % (rescue_tmp_dir, random_prefix)
         random_output_prefix = "%s/%s" % (rescue_tmp_dir, random_prefix)
         target_sam_file = None
+        target_genome_index = None
 
-        unmapped_read_file, target_genome_file, star_index_num = \
+        unmapped_read_file, target_genome_file = \
             make_unmapped_read_target_genome(unmapped_info, ref_id, genome_seq, random_output_prefix, is_spliced)
 
         if is_spliced:
             # Rebuilds aligner index with target genome file
-            if aligner == "star":
-                parser_result.builder_extra_args = "--genomeSAindexNbases {star_index_num} " \
-                                                   "--outTmpDir {temp_dir}".format(star_index_num=star_index_num,
-                                                                                   temp_dir=temp_dir)
-            parser_result.genome_file = target_genome_file
-            parser_result.output_dir = rescue_tmp_dir
-            parser_result.prefix = random_prefix
-            parser_result.quiet = True
-            parser_result.threads = 1
+            # The tools have been checked by the main process, so the backend is called directly
             try:
-                target_genome_index = build_aligner_index.build_index(parser_result)
+                target_genome_index = backend.build_index(target_genome_file, random_output_prefix,
+                                                          extra_args=backend.rescue_index_args(len(genome_seq),
+                                                                                               temp_dir))
             except RuntimeError:
                 for unmapped_name in unmapped_info:
                     unmapped_seq = unmapped_info[unmapped_name][0]
-                    results.put((unmapped_name, unmapped_seq))
-                tasks.task_done()
+                    item_results.append((unmapped_name, unmapped_seq))
                 continue
 
             # Aligns unmapped read to target genome
-            if aligner == "star":
-                parser_result.aligner_extra_args = "--outTmpDir %s" % temp_dir
-            else:
-                parser_result.aligner_extra_args = None
-            parser_result.input = [unmapped_read_file]
-            parser_result.genome_index = target_genome_index
             if target_genome_index is not None:
                 try:
-                    target_sam_file = run_aligner.run_aligner(parser_result)
+                    target_sam_file = backend.align(target_genome_index, [unmapped_read_file], random_output_prefix,
+                                                    extra_args=backend.rescue_align_args(temp_dir))
                 except RuntimeError:
                     for unmapped_name in unmapped_info:
                         unmapped_seq = unmapped_info[unmapped_name][0]
-                        results.put((unmapped_name, unmapped_seq))
-                    tasks.task_done()
+                        item_results.append((unmapped_name, unmapped_seq))
                     continue
         else:
             target_sam_file = "%s.sam" % random_output_prefix
-            command = "blastn -query {unmapped_read} -subject {target_genome} -task megablast -perc_identity {identity} " \
-                      "-qcov_hsp_perc {coverage} -outfmt \"17 SQ SR\" -out {sam_output} -parse_deflines". \
-                format(unmapped_read=unmapped_read_file,
-                       target_genome=target_genome_file,
-                       identity=parser_result.blast_identity,
-                       coverage=parser_result.blast_query_coverage,
-                       sam_output=target_sam_file)
+            command = make_blastn_command(unmapped_read_file, target_genome_file, target_sam_file, parser_result)
 
             tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
-            tool_out, tool_err = tool_process.communicate()
+            _, tool_err = tool_process.communicate()
 
             if tool_process.returncode != 0 or "[Errno" in tool_err.decode("utf8").strip():
                 for unmapped_name in unmapped_info:
                     unmapped_seq = unmapped_info[unmapped_name][0]
-                    results.put((unmapped_name, unmapped_seq))
-                tasks.task_done()
+                    item_results.append((unmapped_name, unmapped_seq))
                 continue
 
         if os.path.exists(target_sam_file) and os.path.getsize(target_sam_file) != 0:
-            # Checks for target genome results
-            with pysam.AlignmentFile(target_sam_file) as f:
-                for r in f:
-                    if not r.is_unmapped and not r.is_secondary and not r.is_supplementary:
-                        new_start = start + r.reference_start
-                        cigarstring = r.cigarstring
-                        first_hard_clip = re.findall("^\d+H", cigarstring)
-                        first_bp = int(re.findall("\d+", first_hard_clip[0])[0]) if first_hard_clip else None
-                        last_hard_clip = re.findall("\d+H$", cigarstring)
-                        last_bp = int(re.findall("\d+", last_hard_clip[0])[0]) if last_hard_clip else None
-                        unmapped_qual = unmapped_info[r.query_name][1]
+            item_results.extend(read_rescue_results(target_sam_file, unmapped_info, ref_id, start, read_windows))
+
+        remove_rescue_files(backend, is_spliced, random_output_prefix, unmapped_read_file, target_genome_file,
+                            target_sam_file, target_genome_index, temp_dir)
+
+    return results
+
+
+# Rescues unmapped reads with asyncio tool calls from the main process, at most tool_concurrency at a time
+# Or, with adaptive concurrency, as many as the governor allows
+# Alignment files are parsed in the worker pool, under the profiler of the rescue stage if the run is profiled
+# Returns a list of the results of each target, in the order of the targets
+async def rescue_reads_async(parse_pool, rescue_tasks, backend, parser_result):
+    import asyncio
+
+    if parser_result.adaptive_concurrency:
+        semaphore = governor.AsyncTokens(governor.Governor(parser_result.tool_concurrency, True,
+                                                           get_pids=governor.get_child_pids))
+    else:
+        semaphore = asyncio.Semaphore(parser_result.tool_concurrency)
+    parse_task = profiling.pool_task(parser_result.profile_dir, "rescue", read_rescue_results)
+    futures = []
+    pending = set()
+
+    for item in rescue_tasks:
+        future = asyncio.ensure_future(rescue_target_async(item, backend, parser_result, semaphore, parse_pool,
+                                                           parse_task))
+        futures.append(future)
+        pending.add(future)
+
+        # Limits the number of targets whose input files are written ahead of their tools
+        if len(pending) >= 2 * parser_result.tool_concurrency:
+            _, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
 
-                        if r.is_reverse:
-                            new_qualities = pysam.qualitystring_to_array(unmapped_qual[::-1])
-                        else:
-                            new_qualities = pysam.qualitystring_to_array(unmapped_qual)
+    if pending:
+        await asyncio.wait(pending)
 
-                        if first_bp is not None:
-                            new_qualities = new_qualities[first_bp:]
+    return [future.result() for future in futures]
 
-                        if last_bp is not None:
-                            last_bp = len(new_qualities) - last_bp
-                            new_qualities = new_qualities[:last_bp]
 
-                        results.put((r.query_name, r.flag, ref_id, new_start, r.mapping_quality, cigarstring,
-                                     r.next_reference_id, r.next_reference_start, r.template_length,
-                                     r.query_sequence, new_qualities, r.tags))
-                        # break
+# Rescues the unmapped reads of a target genome with asyncio tool calls and returns the results
+async def rescue_target_async(item, backend, parser_result, semaphore, parse_pool, parse_task):
+    import asyncio
 
-        # Removes useless files and directories
-        os.remove(unmapped_read_file)
-        os.remove(target_genome_file)
-        if os.path.exists("%s.sam" % random_output_prefix):
-            os.remove("%s.sam" % random_output_prefix)
-        elif os.path.exists("%s.bam" % random_output_prefix):
-            os.remove("%s.bam" % random_output_prefix)
+    unmapped_info, ref_id, start, is_spliced, genome_seq, read_windows = item
+    rescue_tmp_dir = parser_result.output_dir + "/rescue_tmp"
+    random_prefix = random_string(10)
+    temp_dir = "%s/%s_temp" % (rescue_tmp_dir, random_prefix)
+    random_output_prefix = "%s/%s" % (rescue_tmp_dir, random_prefix)
+    target_sam_file = None
+    target_genome_index = None
+
+    unmapped_read_file, target_genome_file = \
+        make_unmapped_read_target_genome(unmapped_info, ref_id, genome_seq, random_output_prefix, is_spliced)
+
+    try:
+        if is_spliced:
+            target_genome_index = await backend.build_index_async(
+                target_genome_file, random_output_prefix, semaphore,
+                extra_args=backend.rescue_index_args(len(genome_seq), temp_dir))
+            target_sam_file = await backend.align_async(target_genome_index, [unmapped_read_file],
+                                                        random_output_prefix, semaphore,
+                                                        extra_args=backend.rescue_align_args(temp_dir))
+        else:
+            target_sam_file = "%s.sam" % random_output_prefix
+            command = make_blastn_command(unmapped_read_file, target_genome_file, target_sam_file, parser_result)
+            await aligner_backends.run_tool_async("BLASTN", command, None, semaphore)
 
-        if is_spliced and aligner == "star":
-            if os.path.exists("%s.Aligned.out.sam" % random_output_prefix):
-                os.remove("%s.Aligned.out.sam" % random_output_prefix)
+        if os.path.exists(target_sam_file) and os.path.getsize(target_sam_file) != 0:
+            rescue_results = await asyncio.get_running_loop().run_in_executor(
+                parse_pool, parse_task, target_sam_file, unmapped_info, ref_id, start, read_windows)
+        else:
+            rescue_results = []
+    except RuntimeError:
+        rescue_results = [(unmapped_name, unmapped_info[unmapped_name][0]) for unmapped_name in unmapped_info]
 
-            if os.path.exists("%s_star" % random_output_prefix):
-                shutil.rmtree("%s_star" % random_output_prefix)
+    remove_rescue_files(backend, is_spliced, random_output_prefix, unmapped_read_file, target_genome_file,
+                        target_sam_file, target_genome_index, temp_dir)
 
-            if os.path.exists("%s_temp" % random_output_prefix):
-                shutil.rmtree("%s_temp" % random_output_prefix)
+    return rescue_results
 
-            if os.path.exists("%s.Log.final.out" % random_output_prefix):
-                os.remove("%s.Log.final.out" % random_output_prefix)
 
-            if os.path.exists("%s.Log.out" % random_output_prefix):
-                os.remove("%s.Log.out" % random_output_prefix)
+# Returns the BLASTN command to align unmapped reads to a target genome
+def make_blastn_command(unmapped_read_file, target_genome_file, sam_output, parser_result):
+    return "blastn -query {unmapped_read} -subject {target_genome} -task megablast -perc_identity {identity} " \
+           "-qcov_hsp_perc {coverage} -outfmt \"17 SQ SR\" -out {sam_output} -parse_deflines". \
+        format(unmapped_read=unmapped_read_file,
+               target_genome=target_genome_file,
+               identity=parser_result.blast_identity,
+               coverage=parser_result.blast_query_coverage,
+               sam_output=sam_output)
 
-            if os.path.exists("%s.Log.progress.out" % random_output_prefix):
-                os.remove("%s.Log.progress.out" % random_output_prefix)
 
-            if os.path.exists("%s.SJ.out.tab" % random_output_prefix):
-                os.remove("%s.SJ.out.tab" % random_output_prefix)
+# Returns the info of the new alignments in the alignment file of a target genome
+def read_rescue_results(target_sam_file, unmapped_info, ref_id, start, read_windows):
+    import pysam
 
-        tasks.task_done()
+    rescue_results = []
+
+    with pysam.AlignmentFile(target_sam_file) as f:
+        for r in f:
+            if not r.is_unmapped and not r.is_secondary and not r.is_supplementary:
+                rescue_results.extend(get_rescue_results(r, unmapped_info, ref_id, start, read_windows))
+
+    return rescue_results
+
+
+# Removes the files and directories produced for a target genome
+def remove_rescue_files(backend, is_spliced, random_output_prefix, unmapped_read_file, target_genome_file,
+                        target_sam_file, target_genome_index, temp_dir):
+    os.remove(unmapped_read_file)
+    os.remove(target_genome_file)
+    if os.path.exists("%s.sam" % random_output_prefix):
+        os.remove("%s.sam" % random_output_prefix)
+    elif os.path.exists("%s.bam" % random_output_prefix):
+        os.remove("%s.bam" % random_output_prefix)
+
+    if is_spliced:
+        if target_sam_file is not None and os.path.exists(target_sam_file):
+            os.remove(target_sam_file)
+
+        if target_genome_index is not None:
+            backend.remove_index(target_genome_index)
+
+        if os.path.exists(temp_dir):
+            shutil.rmtree(temp_dir)
+
+        backend.clean_up(random_output_prefix)
+
+
+# Yields the info of a new alignment once for each window of the unmapped read that the alignment starts in
+# Alignments outside the windows of the read, which are only possible in merged targets, are dropped
+def get_rescue_results(r, unmapped_info, ref_id, start, read_windows):
+    unmapped_name = int(r.query_name)
+
+    for window_start, window_end in read_windows[unmapped_name]:
+        if window_start <= r.reference_start < window_end:
+            yield make_rescue_result(r, unmapped_info[unmapped_name][1], ref_id, start)
+
+
+# Returns the info of a new alignment from an alignment against a target genome
+def make_rescue_result(r, unmapped_qual, ref_id, start):
+    new_start = start + r.reference_start
+    new_qualities = get_rescue_qualities(r.cigarstring, r.is_reverse, unmapped_qual)
+
+    return (int(r.query_name), r.flag, ref_id, new_start, r.mapping_quality, r.cigarstring, r.next_reference_id,
+            r.next_reference_start, r.template_length, r.query_sequence, new_qualities, r.tags)
+
+
+# Returns the qualities of an unmapped read oriented and trimmed to match the hard clips of its new alignment
+def get_rescue_qualities(cigarstring, is_reverse, unmapped_qual):
+    import pysam
+
+    first_hard_clip = re.findall("^\d+H", cigarstring)
+    first_bp = int(re.findall("\d+", first_hard_clip[0])[0]) if first_hard_clip else None
+    last_hard_clip = re.findall("\d+H$", cigarstring)
+    last_bp = int(re.findall("\d+", last_hard_clip[0])[0]) if last_hard_clip else None
+
+    if is_reverse:
+        new_qualities = pysam.qualitystring_to_array(unmapped_qual[::-1])
+    else:
+        new_qualities = pysam.qualitystring_to_array(unmapped_qual)
+
+    if first_bp is not None:
+        new_qualities = new_qualities[first_bp:]
+
+    if last_bp is not None:
+        last_bp = len(new_qualities) - last_bp
+        new_qualities = new_qualities[:last_bp]
+
+    return new_qualities
+
+
+# Returns an AlignedSegment with the given query name from the fields of a new alignment keyed by read id
+def make_aligned_segment(alignment, query_name):
+    import pysam
+
+    aligned_segment = pysam.AlignedSegment()
+    aligned_segment.query_name = query_name
+    _, aligned_segment.flag, aligned_segment.reference_id, \
+        aligned_segment.reference_start, aligned_segment.mapping_quality, aligned_segment.cigarstring, \
+        aligned_segment.next_reference_id, aligned_segment.next_reference_start, \
+        aligned_segment.template_length, aligned_segment.query_sequence, aligned_segment.query_qualities, \
+        aligned_segment.tags = alignment
+
+    return aligned_segment
 
 
 # Makes the unmapped read file in fastq if spliced else in fasta
 # And creates a target genome fasta file where the mapped read was mapped
 # Returns the filename of the unmapped read and target genome files
-# And a number for star index generation
 def make_unmapped_read_target_genome(unmapped_info, ref_id, genome_seq,
                                      random_output_prefix, is_spliced):
     if is_spliced:
@@ -924,12 +2035,7 @@ def make_unmapped_read_target_genome(unmapped_info, ref_id, genome_seq,
     with open(target_genome_file, "w") as f:
         f.write(">%s\n%s\n" % (ref_id, genome_seq))
 
-    if len(genome_seq) <= 1000:
-        star_index_num = 1
-    else:
-        star_index_num = min(14, round(math.log(len(genome_seq), 2) / 2 - 1))
-
-    return unmapped_read_file, target_genome_file, star_index_num
+    return unmapped_read_file, target_genome_file
 
 ####################
 # Helper functions #
@@ -955,6 +2061,42 @@ def log_rescued_info(total_unmapped_reads, count_mapped_unmapped, count_unique,
         LOGGER.info("Percent all can map: %f" % (count_all / total_unmapped_reads * 100))
 
 
+# Opens an alignment file for reading, CRAM files are decoded with the reference FASTA
+def open_alignment_file(align_file, reference=None):
+    import pysam
+
+    if align_file.endswith(".cram"):
+        return pysam.AlignmentFile(align_file, "rc", reference_filename=reference)
+
+    return pysam.AlignmentFile(align_file)
+
+
+# Opens an alignment file for writing with the header of the template
+# The format follows the extension (.sam, .bam or .cram), CRAM files are encoded with the reference FASTA
+def open_output_alignment_file(align_file, template, reference=None):
+    import pysam
+
+    if align_file.endswith(".cram"):
+        return pysam.AlignmentFile(align_file, "wc", template=template, reference_filename=reference)
+    elif align_file.endswith(".bam"):
+        return pysam.AlignmentFile(align_file, "wb", template=template)
+
+    return pysam.AlignmentFile(align_file, "wh", template=template)
+
+
+# Yields the read id and the record of each record in an alignment file
+# Read ids are the positions of the primary records, secondary and supplementary records get None
+def iterate_read_ids(f):
+    read_id = 0
+
+    for r in f:
+        if r.is_secondary or r.is_supplementary:
+            yield None, r
+        else:
+            yield read_id, r
+            read_id += 1
+
+
 # Returns a new filename attached with the given keyword
 def get_file_new_name(file_name, output, keyword):
     new_name = "rescue_data/"
@@ -972,27 +2114,127 @@ def random_string(length):
     return "".join(random.choice(string.ascii_letters) for _ in range(length))
 
 
-def get_new_unmapped_reads(grouped_unmapped_reads, unmapped_info, repeat_db, output_prefix):
+# Removes the unmapped reads that align to the repeat database from the grouped unmapped reads
+# The names of the removed reads are written to <output_prefix>_filtered_ids.txt
+def get_new_unmapped_reads(grouped_unmapped_reads, unmapped_info, parser_result, output_prefix, read_name_table):
+    global LOGGER
+
     unmapped_names = set()
     for ref_id in grouped_unmapped_reads:
         for loc in grouped_unmapped_reads[ref_id]:
             unmapped_names.update(set(grouped_unmapped_reads[ref_id][loc]))
 
-    input_entries = []
+    # Each unique sequence is screened once
+    seq_names = defaultdict(list)
     for unmapped_name in unmapped_names:
-        unmapped_seq = unmapped_info[unmapped_name][0]
-        input_entries.append(">%s\n%s\n" % (unmapped_name, unmapped_seq))
+        seq_names[unmapped_info[unmapped_name][0]].append(unmapped_name)
+    unique_seqs = list(seq_names.keys())
+
+    repeat_seqs = get_repeat_seqs(unique_seqs, parser_result)
+    filtered_ids = set()
+    for unmapped_seq in repeat_seqs:
+        filtered_ids.update(seq_names[unmapped_seq])
+    LOGGER.info("Repeat filter: %s of %s unique unmapped sequences (%s reads) align to the repeat database" %
+                (format(len(repeat_seqs), ",d"), format(len(unique_seqs), ",d"), format(len(filtered_ids), ",d")))
+
+    with open("{}_filtered_ids.txt".format(output_prefix), "w") as f:
+        for filtered_id in sorted(filtered_ids):
+            f.write(read_name_table[filtered_id] + "\n")
+
+    new_grouped_unmapped_reads = defaultdict(dict)
+    for ref_id in grouped_unmapped_reads:
+        for loc in grouped_unmapped_reads[ref_id]:
+            for unmapped_name in grouped_unmapped_reads[ref_id][loc]:
+                if unmapped_name not in filtered_ids:
+                    if loc in new_grouped_unmapped_reads[ref_id]:
+                        new_grouped_unmapped_reads[ref_id][loc].append(unmapped_name)
+                    else:
+                        new_grouped_unmapped_reads[ref_id][loc] = [unmapped_name]
+
+    return new_grouped_unmapped_reads
+
+
+# Removes the unique unmapped sequences that align to the repeat database before the follow-up alignment
+# The names of all the reads of the removed sequences are written to <output_prefix>_filtered_ids.txt
+def remove_repeat_reads(unmapped_reads, parser_result, output_prefix, read_name_table):
+    global LOGGER
+
+    unique_seqs = list(unmapped_reads.keys())
+    repeat_seqs = get_repeat_seqs(unique_seqs, parser_result)
+
+    filtered_ids = []
+    for unmapped_seq in repeat_seqs:
+        filtered_ids.extend(unmapped_reads[unmapped_seq])
+        del unmapped_reads[unmapped_seq]
+    LOGGER.info("Early repeat filter: %s of %s unique unmapped sequences (%s reads) align to the repeat database" %
+                (format(len(repeat_seqs), ",d"), format(len(unique_seqs), ",d"), format(len(filtered_ids), ",d")))
+
+    with open("{}_filtered_ids.txt".format(output_prefix), "w") as f:
+        for filtered_id in sorted(filtered_ids):
+            f.write(read_name_table[filtered_id] + "\n")
+
+
+# Returns the set of the sequences that align to the repeat database
+# Sequences are screened in chunks in the worker pool, and verdicts are cached if a repeat cache is given
+def get_repeat_seqs(sequences, parser_result):
+    global LOGGER
+
+    repeat_seqs = set()
+    cache = None
+    if parser_result.repeat_cache is not None:
+        cache = rescue_cache.RescueCache(parser_result.repeat_cache, "repeat")
+        db_checksum = rescue_cache.get_db_checksum(parser_result.repeat_db)
+        keys = {seq: rescue_cache.make_repeat_key(rescue_cache.hash_sequence(seq), db_checksum) for seq in sequences}
+        verdicts = cache.get_many(keys.values())
+
+        uncached_seqs = []
+        for seq in sequences:
+            if keys[seq] not in verdicts:
+                uncached_seqs.append(seq)
+            elif verdicts[keys[seq]]:
+                repeat_seqs.add(seq)
+
+        LOGGER.info("Repeat cache hits: %s of %s unique unmapped sequences" %
+                    (format(len(sequences) - len(uncached_seqs), ",d"), format(len(sequences), ",d")))
+        sequences = uncached_seqs
+
+    # Chunks run in parallel, each with repeat_threads BLAST threads
+    repeat_threads = max(1, parser_result.repeat_threads)
+    max_pending = max(1, parser_result.threads // repeat_threads)
+    chunk_size = max(1, min(NUM_REPEAT_SEQS_PER_CHUNK, -(-len(sequences) // max_pending)))
+
+    task = profiling.pool_task(parser_result.profile_dir, "repeat_filter",
+                               functools.partial(filter_repeat_reads, parser_result.repeat_db, repeat_threads))
+    pool = worker_pool.get_pool(parser_result.threads)
+    hit_indices = set(worker_pool.map_chunks(pool, task, enumerate(sequences), chunk_size, max_pending,
+                                             make_pool_governor(parser_result, max_pending)))
+
+    if cache is not None:
+        cache.put_many((keys[seq], i in hit_indices) for i, seq in enumerate(sequences))
+        cache.close()
+
+    repeat_seqs.update(sequences[i] for i in hit_indices)
+
+    return repeat_seqs
+
+
+# Aligns a chunk of (index, sequence) pairs to the repeat database and returns the indices of the sequences with a hit
+def filter_repeat_reads(repeat_db, num_threads, entries):
+    import tempfile
+    import pysam
 
     with tempfile.NamedTemporaryFile() as tmp_input, tempfile.NamedTemporaryFile() as tmp_output, \
             open(tmp_input.name, "w") as f:
-        for entry in input_entries:
-            f.write(entry)
+        for seq_index, seq in entries:
+            f.write(">%d\n%s\n" % (seq_index, seq))
 
         command = "blastn -db {repeat_db} -query {input_fa} -task megablast -perc_identity 90 " \
-                  "-qcov_hsp_perc 80 -outfmt \"17 SQ SR\" -out {sam_output} -parse_deflines -evalue 0.00001". \
+                  "-qcov_hsp_perc 80 -outfmt \"17 SQ SR\" -out {sam_output} -parse_deflines -evalue 0.00001 " \
+                  "-num_threads {num_threads}". \
             format(repeat_db=repeat_db,
                    input_fa=tmp_input.name,
-                   sam_output=tmp_output.name)
+                   sam_output=tmp_output.name,
+                   num_threads=num_threads)
 
         tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
         tool_out, tool_err = tool_process.communicate()
@@ -1000,29 +2242,20 @@ def get_new_unmapped_reads(grouped_unmapped_reads, unmapped_info, repeat_db, out
         if tool_process.returncode != 0 or "[Errno" in tool_err.decode("utf8").strip():
             raise RuntimeError("Something went wrong\nstdout:{}\nstderr:{}\n".format(tool_out, tool_err))
 
-        filtered_ids = set()
+        hit_indices = set()
         if os.path.getsize(tmp_output.name) != 0:
             with pysam.AlignmentFile(tmp_output.name) as g:
                 for r in g:
                     if not r.is_unmapped:
-                        filtered_ids.add(r.query_name)
+                        hit_indices.add(int(r.query_name))
 
-    with open("{}_filtered_ids.txt".format(output_prefix), "w") as f:
-        for filtered_id in filtered_ids:
-            f.write(filtered_id + "\n")
-
-    new_grouped_unmapped_reads = defaultdict(dict)
-    for ref_id in grouped_unmapped_reads:
-        for loc in grouped_unmapped_reads[ref_id]:
-            for unmapped_name in grouped_unmapped_reads[ref_id][loc]:
-                if unmapped_name not in filtered_ids:
-                    if loc in new_grouped_unmapped_reads[ref_id]:
-                        new_grouped_unmapped_reads[ref_id][loc].append(unmapped_name)
-                    else:
-                        new_grouped_unmapped_reads[ref_id][loc] = [unmapped_name]
-
-    return new_grouped_unmapped_reads
+    return list(hit_indices)
 
 
 if __name__ == "__main__":
-    main(mp.get_context("fork"), mp.get_context("spawn"))
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        merge_main(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == "batch":
+        batch_main(mp.get_context("fork"), sys.argv[2:])
+    else:
+        main(mp.get_context("fork"))
\ No newline at end of file
@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scavenger import MAX_WINDOW_GAP, WINDOW_EXTEND_LEN, merge_windows
+
+
+# Windows are given as the locations of mapped reads, which merge_windows extends by WINDOW_EXTEND_LEN on both sides
+def make_windows(*locations):
+    return {(start, end, is_spliced): ["read_%d" % i] for i, (start, end, is_spliced) in enumerate(locations)}
+
+
+def test_overlapping_windows_are_merged():
+    targets = merge_windows(make_windows((1000, 1100, False), (1150, 1250, False)), 10000, 5000)
+
+    assert len(targets) == 1
+    assert targets[0][:3] == (1000 - WINDOW_EXTEND_LEN, 1250 + WINDOW_EXTEND_LEN, False)
+    assert len(targets[0][3]) == 2
+
+
+def test_windows_within_gap_are_merged():
+    gap = 50
+    second_start = 1100 + 2 * WINDOW_EXTEND_LEN + gap
+    windows = make_windows((1000, 1100, False), (second_start, second_start + 100, False))
+
+    assert len(merge_windows(windows, 10000, 5000)) == 2
+    assert len(merge_windows(windows, 10000, 5000, gap - 1)) == 2
+    assert len(merge_windows(windows, 10000, 5000, gap)) == 1
+
+
+def test_gap_keeps_types_and_max_length():
+    windows = make_windows((1000, 1100, False), (1400, 1500, True), (1800, 1900, False))
+
+    assert len(merge_windows(windows, 10000, 5000, MAX_WINDOW_GAP)) == 3
+    assert len(merge_windows(make_windows((1000, 1100, False), (1400, 1500, False)), 10000, 400,
+                             MAX_WINDOW_GAP)) == 2
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+
+import os
+import pstats
+import random
+import subprocess
+import sys
+
+import pytest
+
+pysam = pytest.importorskip("pysam")
+pytest.importorskip("mappy")
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CONTIG_LENGTH = 5000
+READ_LENGTH = 100
+
+
+# Writes a genome and, for each sample, reads and a source alignment file where a few reads of each locus are unmapped
+def make_samples(tmp_path, num_samples):
+    rng = random.Random(1)
+    genome = "".join(rng.choice("ACGT") for _ in range(CONTIG_LENGTH))
+    genome_file = str(tmp_path / "genome.fa")
+    with open(genome_file, "w") as f:
+        f.write(">chr1\n%s\n" % genome)
+
+    samples = []
+    header = {"HD": {"VN": "1.4"}, "SQ": [{"SN": "chr1", "LN": CONTIG_LENGTH}]}
+    for sample_index in range(num_samples):
+        sample = "sample%d" % sample_index
+        reads_file = str(tmp_path / ("%s.fq" % sample))
+        source_file = str(tmp_path / ("%s.bam" % sample))
+
+        with open(reads_file, "w") as f, pysam.AlignmentFile(source_file, "wb", header=header) as g:
+            for locus in range(10):
+                position = rng.randint(0, CONTIG_LENGTH - 2 * READ_LENGTH)
+                for i in range(6):
+                    start = position + rng.randint(0, 20)
+                    sequence = genome[start:start + READ_LENGTH]
+                    name = "%s_%d_%d" % (sample, locus, i)
+                    f.write("@%s\n%s\n+\n%s\n" % (name, sequence, "I" * READ_LENGTH))
+
+                    r = pysam.AlignedSegment(g.header)
+                    r.query_name = name
+                    r.query_sequence = sequence
+                    r.query_qualities = pysam.qualitystring_to_array("I" * READ_LENGTH)
+                    if i < 2:
+                        r.flag = 4
+                        r.set_tag("NH", 0)
+                    else:
+                        r.reference_id, r.reference_start, r.cigarstring = 0, start, "%dM" % READ_LENGTH
+                        r.mapping_quality = 255
+                        r.set_tag("NH", 1)
+                    g.write(r)
+        samples.append((sample, reads_file, source_file))
+
+    return genome_file, samples
+
+
+def test_batch_merges_parent_stats_of_all_samples(tmp_path):
+    genome_file, samples = make_samples(tmp_path, 2)
+    manifest = str(tmp_path / "manifest.tsv")
+    with open(manifest, "w") as f:
+        for sample, reads_file, source_file in samples:
+            f.write("%s\t%s\t%s\n" % (sample, reads_file, source_file))
+
+    profile_dir = str(tmp_path / "profile")
+    subprocess.run([sys.executable, os.path.join(ROOT_DIR, "scavenger.py"), "batch", "-m", manifest,
+                    "-G", genome_file, "-at", "mappy", "-o", str(tmp_path / "out"), "-t", "1", "--bam",
+                    "--profile", profile_dir], stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=True)
+
+    raw_files = [raw_file for raw_file in os.listdir(os.path.join(profile_dir, "raw"))
+                 if raw_file.startswith("extract.parent.")]
+    assert len(raw_files) == 2
+
+    # The extraction runs once for each sample
+    stats = pstats.Stats(os.path.join(profile_dir, "extract.prof")).stats
+    num_calls = sum(stat[1] for function, stat in stats.items() if function[2] == "get_mapped_and_unmapped_reads")
+    assert num_calls == 2
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import os
+import sys
+
+import pysam
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import region_scan
+
+CONTIGS = (("chr1", 2000), ("chr2", 1000), ("chrE", 1000))
+
+
+# Writes a reference and a coordinate-sorted, indexed alignment file of reads on chr1 and chr2 and unplaced reads
+def make_alignment_file(tmp_path, mode, suffix):
+    reference = str(tmp_path / "genome.fa")
+    with open(reference, "w") as f:
+        for contig, length in CONTIGS:
+            f.write(">%s\n%s\n" % (contig, "ACGT" * (length // 4)))
+    pysam.faidx(reference)
+
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"},
+              "SQ": [{"SN": contig, "LN": length} for contig, length in CONTIGS]}
+    alignment_file = str(tmp_path / ("source.%s" % suffix))
+    with pysam.AlignmentFile(alignment_file, mode, header=header, reference_filename=reference) as f:
+        for i, (reference_id, start) in enumerate([(0, 100), (0, 1500), (1, 200), (-1, -1), (-1, -1)]):
+            r = pysam.AlignedSegment(f.header)
+            r.query_name = "read_%d" % i
+            r.query_sequence = "ACGT" * 10
+            r.query_qualities = pysam.qualitystring_to_array("I" * 40)
+            if reference_id < 0:
+                r.flag = 4
+            else:
+                r.reference_id, r.reference_start, r.cigarstring, r.mapping_quality = reference_id, start, "40M", 60
+            f.write(r)
+    pysam.index(alignment_file)
+
+    return alignment_file, reference
+
+
+def read_all_regions(alignment_file, reference, region_length):
+    with pysam.AlignmentFile(alignment_file, reference_filename=reference) as f:
+        regions = region_scan.get_regions(f, region_length)
+        names = [r.query_name for region in regions for r in region_scan.fetch_region(f, region)]
+
+    return regions, names
+
+
+def test_bam_skips_contigs_without_records(tmp_path):
+    alignment_file, reference = make_alignment_file(tmp_path, "wb", "bam")
+    regions, names = read_all_regions(alignment_file, reference, 1000)
+
+    assert [region[0] for region in regions] == ["chr1", "chr1", "chr2", region_scan.UNPLACED]
+    assert names == ["read_%d" % i for i in range(5)]
+
+
+def test_cram_scans_all_regions(tmp_path):
+    alignment_file, reference = make_alignment_file(tmp_path, "wc", "cram")
+
+    with pysam.AlignmentFile(alignment_file, reference_filename=reference) as f:
+        assert region_scan.is_region_scannable(f)
+        assert region_scan.get_index_counts(f) is None
+
+    regions, names = read_all_regions(alignment_file, reference, 1000)
+
+    assert [region[0] for region in regions] == ["chr1", "chr1", "chr2", "chrE", region_scan.UNPLACED]
+    assert names == ["read_%d" % i for i in range(5)]
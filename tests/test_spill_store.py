@@ -0,0 +1,33 @@
+#!/usr/bin/python3
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import spill_store
+
+
+def test_lists_grown_in_place_are_measured(tmp_path):
+    table = spill_store.SpillDict(100000, str(tmp_path), "lists", list)
+
+    for key in range(20):
+        for item in range(1000):
+            table[key].append(item)
+
+    table.flush()
+    assert table.spilled
+    assert table._cache_bytes <= table.max_bytes
+    assert sum(table._sizes.values()) == table._cache_bytes
+    assert all(value == list(range(1000)) for value in table.values())
+    assert len(table) == 20
+
+
+def test_values_of_spilled_entries_are_kept(tmp_path):
+    table = spill_store.SpillDict(20000, str(tmp_path), "lists", list)
+
+    for item in range(200):
+        for key in range(10):
+            table[key].extend([item, item])
+
+    assert dict(table.items()) == {key: [item for item in range(200) for _ in range(2)] for key in range(10)}
@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Modules that are only needed by some stages and must not be loaded by importing scavenger
+LAZY_MODULES = ("numpy", "pysam", "sqlite3", "tempfile")
+
+
+def test_lazy_modules_are_not_imported_at_startup():
+    # The import runs in a fresh interpreter, as pytest itself loads some of these modules
+    code = "import sys\n" \
+           "sys.path.insert(0, %r)\n" \
+           "import scavenger\n" \
+           "print(' '.join(module for module in %r if module in sys.modules))" % (ROOT_DIR, LAZY_MODULES)
+    output = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, check=True, cwd=ROOT_DIR)
+
+    assert output.stdout.decode().split() == []
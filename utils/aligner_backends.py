@@ -0,0 +1,631 @@
+#!/usr/bin/python3
+
+import io
+import math
+import os
+import re
+import shlex
+import shutil
+from collections import namedtuple
+from contextlib import contextmanager
+from subprocess import Popen, PIPE
+
+# Aligner backends keyed by the lower-case name used on the command line
+BACKENDS = {}
+# CIGAR operations and the operations that consume the reference
+CIGAR_OPS = re.compile(r"(\d+)([MIDNSHP=X])")
+REFERENCE_OPS = "MDN=X"
+
+# Minimal alignment record used when alignments are consumed as a stream instead of being read from a file
+AlignmentHit = namedtuple("AlignmentHit", ["query_name", "reference_name", "reference_start", "reference_end",
+                                           "is_reverse", "mapping_quality", "cigarstring"])
+
+
+# Alignment of a read against a single target sequence, shaped like the pysam fields used by the rescue step
+class TargetAlignment(namedtuple("TargetAlignment", ["query_name", "flag", "reference_start", "mapping_quality",
+                                                     "cigarstring", "next_reference_id", "next_reference_start",
+                                                     "template_length", "query_sequence", "tags"])):
+    __slots__ = ()
+
+    @property
+    def is_reverse(self):
+        return bool(self.flag & 16)
+
+
+# Registers an aligner backend class under its name
+def register_backend(backend_class):
+    BACKENDS[backend_class.name] = backend_class()
+    return backend_class
+
+
+# Returns the backend registered under the given name
+def get_backend(name):
+    try:
+        return BACKENDS[name.lower()]
+    except KeyError:
+        raise ValueError("Unsupported aligner: %s (supported: %s)" % (name, backend_names()))
+
+
+# Returns the display names of all the registered backends
+def backend_names():
+    return "|".join(backend.display_name for backend in BACKENDS.values())
+
+
+# Base class of the aligner backends
+# External backends only need to provide the index and align commands, in-process backends override the
+# build_index, align, align_stream and align_to_target methods instead
+class AlignerBackend(object):
+    name = None
+    display_name = None
+    index_tool = None
+    align_tool = None
+    in_process = False
+    tools_checked = False
+
+    # Checks for tools execution, once per process (forked processes inherit the result)
+    def check_tools(self):
+        if self.tools_checked:
+            return
+
+        for tool in (self.index_tool, self.align_tool):
+            try:
+                process = Popen(shlex.split(tool), stdout=PIPE, stderr=PIPE)
+                process.communicate()
+            except Exception:
+                error = "[%s] Error encountered when being called. Script will not run" % tool
+                raise RuntimeError(error)
+
+        self.tools_checked = True
+
+    # Returns the command, the genome index and one of the expected output files of the index build
+    def index_command(self, genome_file, output_prefix, threads, extra_args, annotation):
+        raise NotImplementedError
+
+    # Returns the command and the output file of the alignment
+    def align_command(self, genome_index, input_files, output_prefix, threads, extra_args, bam_output):
+        raise NotImplementedError
+
+    # Builds the index and returns its location
+    def build_index(self, genome_file, output_prefix, threads=1, extra_args="", annotation=None, logger=None):
+        command, genome_index, output_file = \
+            self.index_command(genome_file, output_prefix, threads, extra_args or "", annotation)
+        run_tool("%s-Build" % self.display_name, command, output_file, logger)
+
+        return genome_index
+
+    # Aligns the input files and returns the name of the alignment file
+    def align(self, genome_index, input_files, output_prefix, threads=1, extra_args="", bam_output=False,
+              logger=None):
+        command, output_file = \
+            self.align_command(genome_index, input_files, output_prefix, threads, extra_args or "", bam_output)
+        run_tool(self.display_name, command, output_file, logger)
+
+        return output_file
+
+    # Builds the index with an asyncio subprocess, waiting for the semaphore before the tool starts
+    async def build_index_async(self, genome_file, output_prefix, semaphore, threads=1, extra_args="",
+                                annotation=None, logger=None):
+        command, genome_index, output_file = \
+            self.index_command(genome_file, output_prefix, threads, extra_args or "", annotation)
+        await run_tool_async("%s-Build" % self.display_name, command, output_file, semaphore, logger)
+
+        return genome_index
+
+    # Aligns the input files with an asyncio subprocess, waiting for the semaphore before the tool starts
+    async def align_async(self, genome_index, input_files, output_prefix, semaphore, threads=1, extra_args="",
+                          bam_output=False, logger=None):
+        command, output_file = \
+            self.align_command(genome_index, input_files, output_prefix, threads, extra_args or "", bam_output)
+        await run_tool_async(self.display_name, command, output_file, semaphore, logger)
+
+        return output_file
+
+    # Aligns the input files and yields an AlignmentHit for each mapped record
+    def align_stream(self, genome_index, input_files, output_prefix, threads=1, extra_args="", logger=None):
+        output_file = self.align(genome_index, input_files, output_prefix, threads, extra_args, True, logger)
+
+        for hit in read_alignment_hits(output_file):
+            yield hit
+
+    # Returns the command of an alignment that writes SAM to stdout, or None if the aligner cannot
+    def stream_command(self, genome_index, input_files, output_prefix, threads, extra_args):
+        return None
+
+    # Aligns the input files with the SAM output piped from the aligner and yields an AlignmentHit for each mapped
+    # record while the aligner is still running, so no alignment file is written
+    # Falls back to align_stream if the aligner cannot write SAM to stdout
+    def align_piped(self, genome_index, input_files, output_prefix, threads=1, extra_args="", logger=None):
+        command = self.stream_command(genome_index, input_files, output_prefix, threads, extra_args or "")
+
+        if command is None:
+            for hit in self.align_stream(genome_index, input_files, output_prefix, threads, extra_args, logger):
+                yield hit
+            return
+
+        for hit in pipe_alignment_hits(self.display_name, command, logger):
+            yield hit
+
+    # Returns the extra alignment arguments that also write the unmapped reads to a FASTQ file, or None if the aligner
+    # cannot
+    def unmapped_reads_args(self):
+        return None
+
+    # Returns the FASTQ file of the unmapped reads written with unmapped_reads_args
+    def unmapped_reads_file(self, output_prefix):
+        return None
+
+    # Aligns reads against a single target sequence and yields a TargetAlignment for each primary alignment
+    # Only supported by in-process backends
+    def align_to_target(self, target_seq, reads, is_spliced, min_identity=None, min_coverage=None):
+        raise NotImplementedError("%s does not support in-process alignment" % self.display_name)
+
+    # Extra index build arguments for the follow-up genome made of padded unmapped reads
+    def follow_up_index_args(self, genome_length, num_ref):
+        return ""
+
+    # Extra alignment arguments for aligning mapped reads to the follow-up genome
+    def follow_up_align_args(self, num_ref):
+        return ""
+
+    # Extra index build arguments for a small rescue target genome
+    def rescue_index_args(self, genome_length, temp_dir):
+        return ""
+
+    # Extra alignment arguments for aligning unmapped reads to a small rescue target genome
+    def rescue_align_args(self, temp_dir):
+        return ""
+
+    # Removes the files produced by the aligner except the alignment file
+    def clean_up(self, output_prefix):
+        pass
+
+    # Removes an index built by this backend
+    def remove_index(self, genome_index):
+        pass
+
+
+@register_backend
+class StarBackend(AlignerBackend):
+    name = "star"
+    display_name = "STAR"
+    index_tool = "STAR"
+    align_tool = "STAR"
+
+    def index_command(self, genome_file, output_prefix, threads, extra_args, annotation):
+        genome_index = "%s_star" % output_prefix
+        os.mkdir(genome_index) if not os.path.exists(genome_index) else 0
+        output_file = "%s/Genome" % genome_index
+
+        command = "STAR --runThreadN {threads} --runMode genomeGenerate " \
+                  "--genomeDir {genome_index} " \
+                  "--genomeFastaFiles {genome_file} {annotation_option} " \
+                  "{extra_args}". \
+            format(threads=threads,
+                   genome_index=genome_index,
+                   genome_file=genome_file,
+                   annotation_option="--sjdbGTFfile %s" % annotation if annotation is not None else "",
+                   extra_args=extra_args)
+
+        return command, genome_index, output_file
+
+    def align_command(self, genome_index, input_files, output_prefix, threads, extra_args, bam_output):
+        if bam_output:
+            output_file = "%s.Aligned.out.bam" % output_prefix
+        else:
+            output_file = "%s.Aligned.out.sam" % output_prefix
+
+        command = "STAR --runThreadN {threads} {extra_args} " \
+                  "--genomeDir {genome_index} --readFilesIn {read_files} " \
+                  "--outFileNamePrefix {output_prefix}. {gz_option} {bam_option} " \
+                  "--outSAMunmapped Within KeepPairs". \
+            format(threads=threads,
+                   extra_args=extra_args,
+                   genome_index=genome_index,
+                   read_files=" ".join(input_files),
+                   output_prefix=output_prefix,
+                   gz_option="--readFilesCommand zcat" if input_files[0].split(",")[0].endswith("gz") else "",
+                   bam_option="--outSAMtype BAM Unsorted" if bam_output else "")
+
+        return command, output_file
+
+    def stream_command(self, genome_index, input_files, output_prefix, threads, extra_args):
+        command, _ = self.align_command(genome_index, input_files, output_prefix, threads, extra_args, False)
+
+        return "%s --outStd SAM" % command
+
+    def unmapped_reads_args(self):
+        return "--outReadsUnmapped Fastx"
+
+    def unmapped_reads_file(self, output_prefix):
+        return "%s.Unmapped.out.mate1" % output_prefix
+
+    def follow_up_index_args(self, genome_length, num_ref):
+        return "--genomeChrBinNbits %d --genomeSAindexNbases %d" % \
+               (min(18, int(math.log(genome_length / num_ref, 2))), min(14, int(math.log(genome_length, 2) / 2) - 1))
+
+    def follow_up_align_args(self, num_ref):
+        return "--outFilterMultimapNmax %d --alignIntronMax 1 --seedSearchStartLmax 30" % num_ref
+
+    def rescue_index_args(self, genome_length, temp_dir):
+        if genome_length <= 1000:
+            star_index_num = 1
+        else:
+            star_index_num = min(14, round(math.log(genome_length, 2) / 2 - 1))
+
+        return "--genomeSAindexNbases %d --outTmpDir %s" % (star_index_num, temp_dir)
+
+    def rescue_align_args(self, temp_dir):
+        return "--outTmpDir %s" % temp_dir
+
+    def clean_up(self, output_prefix):
+        for suffix in ("Log.final.out", "Log.out", "Log.progress.out", "SJ.out.tab"):
+            if os.path.exists("%s.%s" % (output_prefix, suffix)):
+                os.remove("%s.%s" % (output_prefix, suffix))
+
+    def remove_index(self, genome_index):
+        if os.path.exists(genome_index):
+            shutil.rmtree(genome_index)
+
+
+@register_backend
+class SubreadBackend(AlignerBackend):
+    name = "subread"
+    display_name = "Subread"
+    index_tool = "subread-buildindex"
+    align_tool = "subread-align"
+
+    def index_command(self, genome_file, output_prefix, threads, extra_args, annotation):
+        genome_index = "%s_subread/" % output_prefix
+        os.mkdir(genome_index) if not os.path.exists(genome_index) else 0
+        genome_index += "genome"
+        output_file = "%s.00.b.tab" % genome_index
+
+        command = "subread-buildindex -o {genome_index} " \
+                  "{extra_args} {genome_file}". \
+            format(genome_index=genome_index,
+                   extra_args=extra_args,
+                   genome_file=genome_file)
+
+        return command, genome_index, output_file
+
+    def align_command(self, genome_index, input_files, output_prefix, threads, extra_args, bam_output):
+        if len(input_files) == 2:
+            read_files = "-r %s -R %s" % (input_files[0], input_files[1])
+        else:
+            read_files = "-r %s" % " ".join(input_files)
+
+        if bam_output:
+            output_file = "%s.bam" % output_prefix
+        else:
+            output_file = "%s.sam" % output_prefix
+
+        command = "subread-align -T {threads} -t 0 {extra_args} -i " \
+                  "{genome_index} {read_files} -o {output_file} {bam_option}". \
+            format(threads=threads,
+                   extra_args=extra_args,
+                   genome_index=genome_index,
+                   read_files=read_files,
+                   output_file=output_file,
+                   bam_option="" if bam_output else "--SAMoutput")
+
+        return command, output_file
+
+    def remove_index(self, genome_index):
+        index_dir = os.path.dirname(genome_index)
+        if os.path.exists(index_dir):
+            shutil.rmtree(index_dir)
+
+
+# In-process minimap2 backend through its Python binding (mappy)
+# The extra arguments are a minimap2 preset optionally followed by key=value Aligner options (e.g. "sr best_n=20")
+@register_backend
+class MappyBackend(AlignerBackend):
+    name = "mappy"
+    display_name = "mappy"
+    in_process = True
+
+    def check_tools(self):
+        try:
+            import mappy
+        except ImportError:
+            raise RuntimeError("[mappy] Error encountered when being imported. Script will not run")
+
+    def build_index(self, genome_file, output_prefix, threads=1, extra_args="", annotation=None, logger=None):
+        import mappy
+
+        genome_index = "%s_mappy.mmi" % output_prefix
+        if logger is not None:
+            logger.info("Building mappy index %s from %s" % (genome_index, genome_file))
+
+        preset, options = parse_mappy_args(extra_args)
+        aligner = mappy.Aligner(fn_idx_in=genome_file, preset=preset, n_threads=threads, fn_idx_out=genome_index,
+                                **options)
+        if not aligner:
+            raise RuntimeError("mappy failed to build index from %s" % genome_file)
+
+        return genome_index
+
+    def align(self, genome_index, input_files, output_prefix, threads=1, extra_args="", bam_output=False,
+              logger=None):
+        import mappy
+        import pysam
+
+        if len(input_files) != 1:
+            raise RuntimeError("mappy backend does not support paired-end input")
+
+        aligner = load_mappy_index(genome_index, extra_args)
+        header = {"HD": {"VN": "1.4"},
+                  "SQ": [{"SN": name, "LN": len(aligner.seq(name))} for name in aligner.seq_names]}
+        output_file = "%s.%s" % (output_prefix, "bam" if bam_output else "sam")
+
+        if logger is not None:
+            logger.info("Aligning %s to %s using mappy" % (input_files[0], genome_index))
+
+        with pysam.AlignmentFile(output_file, "wb" if bam_output else "wh", header=header) as f:
+            for input_file in input_files[0].split(","):
+                for name, seq, qual in mappy.fastx_read(input_file):
+                    hits = [hit for hit in aligner.map(seq)]
+
+                    if not hits:
+                        r = pysam.AlignedSegment(f.header)
+                        r.query_name = name
+                        r.flag = 4
+                        r.query_sequence = seq
+                        r.query_qualities = pysam.qualitystring_to_array(qual) if qual else None
+                        f.write(r)
+                        continue
+
+                    for hit in hits:
+                        record = make_target_alignment(name, seq, qual, hit)
+                        r = pysam.AlignedSegment(f.header)
+                        r.query_name = name
+                        r.flag = record.flag if hit.is_primary else record.flag | 256
+                        r.reference_name = hit.ctg
+                        r.reference_start = record.reference_start
+                        r.mapping_quality = record.mapping_quality
+                        r.cigarstring = record.cigarstring
+                        r.query_sequence = record.query_sequence
+                        if qual:
+                            r.query_qualities = pysam.qualitystring_to_array(qual[::-1] if record.is_reverse else qual)
+                        r.tags = record.tags + [("NH", len(hits))]
+                        f.write(r)
+
+        return output_file
+
+    def align_stream(self, genome_index, input_files, output_prefix, threads=1, extra_args="", logger=None):
+        import mappy
+
+        aligner = load_mappy_index(genome_index, extra_args)
+
+        for input_file in input_files:
+            for read_file in input_file.split(","):
+                for name, seq, qual in mappy.fastx_read(read_file):
+                    for hit in aligner.map(seq):
+                        yield AlignmentHit(name, hit.ctg, hit.r_st, hit.r_en, hit.strand == -1, hit.mapq,
+                                           hit.cigar_str)
+
+    def align_to_target(self, target_seq, reads, is_spliced, min_identity=None, min_coverage=None):
+        import mappy
+
+        aligner = mappy.Aligner(seq=str(target_seq), preset="splice" if is_spliced else "sr")
+        if not aligner:
+            raise RuntimeError("mappy failed to index the target sequence")
+
+        for query_name in reads:
+            seq, qual = reads[query_name][:2]
+
+            for hit in aligner.map(seq):
+                if not hit.is_primary:
+                    continue
+
+                if not is_spliced:
+                    if min_identity is not None and hit.mlen / hit.blen * 100 < min_identity:
+                        continue
+
+                    if min_coverage is not None and (hit.q_en - hit.q_st) / len(seq) * 100 < min_coverage:
+                        continue
+
+                yield make_target_alignment(query_name, seq, qual, hit)
+
+    def follow_up_align_args(self, num_ref):
+        return "sr best_n=%d" % max(5, num_ref)
+
+    def remove_index(self, genome_index):
+        if os.path.exists(genome_index):
+            os.remove(genome_index)
+
+
+# Splits the mappy extra arguments into the preset and the Aligner options
+def parse_mappy_args(extra_args):
+    preset = "sr"
+    options = {}
+
+    for token in shlex.split(extra_args or ""):
+        if "=" in token:
+            key, value = token.split("=", 1)
+            options[key] = int(value)
+        else:
+            preset = token
+
+    return preset, options
+
+
+# Loads a mappy index
+def load_mappy_index(genome_index, extra_args):
+    import mappy
+
+    preset, options = parse_mappy_args(extra_args)
+    aligner = mappy.Aligner(fn_idx_in=genome_index, preset=preset, **options)
+    if not aligner:
+        raise RuntimeError("mappy failed to load index %s" % genome_index)
+
+    return aligner
+
+
+# Converts a mappy hit into a TargetAlignment with soft clips and the read in the aligned orientation
+def make_target_alignment(query_name, seq, qual, hit):
+    import mappy
+
+    is_reverse = hit.strand == -1
+    if is_reverse:
+        clip_start, clip_end = len(seq) - hit.q_en, hit.q_st
+        query_sequence = mappy.revcomp(seq)
+    else:
+        clip_start, clip_end = hit.q_st, len(seq) - hit.q_en
+        query_sequence = seq
+
+    cigarstring = "%s%s%s" % ("%dS" % clip_start if clip_start else "", hit.cigar_str,
+                              "%dS" % clip_end if clip_end else "")
+
+    return TargetAlignment(query_name, 16 if is_reverse else 0, hit.r_st, hit.mapq, cigarstring, -1, -1, 0,
+                           query_sequence, [("NM", hit.NM)])
+
+
+# Yields an AlignmentHit for each mapped record of an alignment file
+def read_alignment_hits(align_file):
+    import pysam
+
+    with pysam.AlignmentFile(align_file) as f:
+        for r in f:
+            if r.is_unmapped:
+                continue
+
+            yield AlignmentHit(r.query_name, r.reference_name, r.reference_start, r.reference_end, r.is_reverse,
+                               r.mapping_quality, r.cigarstring)
+
+
+# Runs an aligner that writes SAM to stdout and yields an AlignmentHit for each mapped record as it is written
+# stderr goes to a temporary file so that the aligner cannot block on it, and the aligner is killed if the
+# consumer stops early
+def pipe_alignment_hits(tool, command, logger=None):
+    import tempfile
+
+    if logger is not None:
+        logger.info("Command: %s" % command)
+
+    with tempfile.TemporaryFile() as err_file:
+        tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=err_file)
+        completed = False
+
+        try:
+            for hit in parse_sam_hits(io.TextIOWrapper(tool_process.stdout)):
+                yield hit
+            completed = True
+        finally:
+            if not completed:
+                tool_process.kill()
+            tool_process.stdout.close()
+            tool_process.wait()
+
+        err_file.seek(0)
+        check_tool_result(tool, tool_process.returncode, b"", err_file.read(), None)
+
+
+# Runs an aligner that writes SAM to stdout and opens its output as a pysam AlignmentFile
+# The aligner is checked once the stream has been read, or killed if the stream is closed early
+# The aligner is also checked if its output has no SAM header
+@contextmanager
+def open_sam_stream(tool, command, logger=None):
+    import tempfile
+
+    import pysam
+
+    if logger is not None:
+        logger.info("Command: %s" % command)
+
+    with tempfile.TemporaryFile() as err_file:
+        tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=err_file)
+        completed = False
+
+        # If the aligner fails before writing the SAM header, its error is raised instead of the error of pysam
+        try:
+            f = pysam.AlignmentFile(tool_process.stdout)
+        except (OSError, ValueError):
+            tool_process.stdout.close()
+            tool_process.wait()
+            err_file.seek(0)
+            check_tool_result(tool, tool_process.returncode, b"", err_file.read(), None)
+            raise
+
+        try:
+            with f:
+                yield f
+            completed = True
+        finally:
+            if not completed:
+                tool_process.kill()
+            tool_process.stdout.close()
+            tool_process.wait()
+
+        err_file.seek(0)
+        check_tool_result(tool, tool_process.returncode, b"", err_file.read(), None)
+
+
+# Yields an AlignmentHit for each mapped record of SAM lines
+def parse_sam_hits(lines):
+    for line in lines:
+        if line.startswith("@"):
+            continue
+
+        query_name, flag, reference_name, pos, mapq, cigarstring = line.split("\t", 6)[:6]
+        flag = int(flag)
+        if flag & 4:
+            continue
+
+        reference_start = int(pos) - 1
+        reference_length = sum(int(length) for length, op in CIGAR_OPS.findall(cigarstring) if op in REFERENCE_OPS)
+
+        yield AlignmentHit(query_name, reference_name, reference_start, reference_start + reference_length,
+                           bool(flag & 16), int(mapq), cigarstring)
+
+
+# Runs tools with the given command
+# Also checks for the existence of one of the expected output from the tools
+def run_tool(tool, command, output_file, logger=None):
+    if logger is not None:
+        logger.info("Command: %s" % command)
+
+    tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
+    tool_out, tool_err = tool_process.communicate()
+    check_tool_result(tool, tool_process.returncode, tool_out, tool_err, output_file)
+
+
+# Runs tools with the given command as an asyncio subprocess
+# At most as many tools as the semaphore allows run at the same time
+async def run_tool_async(tool, command, output_file, semaphore, logger=None):
+    import asyncio
+
+    if logger is not None:
+        logger.info("Command: %s" % command)
+
+    async with semaphore:
+        tool_process = await asyncio.create_subprocess_exec(*shlex.split(command), stdout=PIPE, stderr=PIPE)
+        tool_out, tool_err = await tool_process.communicate()
+
+    check_tool_result(tool, tool_process.returncode, tool_out, tool_err, output_file)
+
+
+# Raises a RuntimeError if a tool has failed
+# The existence of the expected output file is only checked if one is given
+def check_tool_result(tool, returncode, tool_out, tool_err, output_file):
+    if returncode != 0:
+        error = "{tool} failed to complete (non-zero return code)!\n" \
+                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
+            format(tool=tool,
+                   out=tool_out.decode("utf8"),
+                   err=tool_err.decode("utf8"))
+        raise RuntimeError(error)
+    elif output_file is not None and not os.path.exists(output_file):
+        error = "{tool} failed to complete (no output file is found)!\n" \
+                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
+            format(tool=tool,
+                   out=tool_out.decode("utf8"),
+                   err=tool_err.decode("utf8"))
+        raise RuntimeError(error)
+    elif "[Errno" in tool_err.decode("utf8").strip():
+        error = "{tool} failed to complete (error)!\n" \
+                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
+            format(tool=tool,
+                   out=tool_out.decode("utf8"),
+                   err=tool_err.decode("utf8"))
+        raise RuntimeError(error)
@@ -3,10 +3,12 @@
 import argparse
 import logging
 import os
-import re
-import shlex
 import sys
-from subprocess import Popen, PIPE
+
+try:
+    from utils import aligner_backends
+except ImportError:
+    import aligner_backends
 
 
 # Main function
@@ -15,7 +17,8 @@ def build_index(parser_result):
     global quiet
     quiet = parser_result.quiet
 
-    check_tools(aligner)
+    backend = aligner_backends.get_backend(aligner)
+    backend.check_tools()
 
     if not quiet:
         log_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", datefmt='%Y-%m-%d %I:%M:%S %p')
@@ -55,17 +58,14 @@ def build_index(parser_result):
         console_handler.setFormatter(log_formatter)
         root_logger.addHandler(console_handler)
 
-    tools_names = {"star": "STAR", "subread": "Subread"}
-
     if not quiet:
-        root_logger.info("Building index for %s..." % tools_names[aligner])
+        root_logger.info("Building index for %s..." % backend.display_name)
 
-    if aligner == "star":
-        genome_index = build_star(parser_result, output_prefix)
-    elif aligner == "subread":
-        genome_index = build_subread(parser_result, output_prefix)
-    else:
-        genome_index = None
+    genome_index = backend.build_index(parser_result.genome_file, output_prefix,
+                                       threads=parser_result.threads,
+                                       extra_args=parser_result.builder_extra_args,
+                                       annotation=parser_result.annotation,
+                                       logger=None if quiet else root_logger)
 
     if not quiet:
         root_logger.info("Completed building index")
@@ -84,7 +84,7 @@ def add_args(parser, required_args):
                                dest="aligner",
                                required=True,
                                type=aligner_string,
-                               help="Aligner to build index (STAR|Subread)")
+                               help="Aligner to build index (%s)" % aligner_backends.backend_names())
     parser.add_argument("--builder_extra_args", "-be",
                         dest="builder_extra_args",
                         default="",
@@ -114,10 +114,9 @@ def add_args(parser, required_args):
 # Checks for valid aligner
 def aligner_string(s):
     s = s.lower()
-    regex = "star|subread"
 
-    if not re.match(regex, s):
-        error = "Aligner to be used (STAR|Subread)"
+    if s not in aligner_backends.BACKENDS:
+        error = "Aligner to be used (%s)" % aligner_backends.backend_names()
         raise argparse.ArgumentTypeError(error)
     else:
         return s
@@ -125,85 +124,7 @@ def aligner_string(s):
 
 # Checks for tools execution
 def check_tools(aligner):
-    tools_dir = {"star": "STAR", "subread": "subread-buildindex"}
-    try:
-        build = Popen(shlex.split(tools_dir[aligner]), stdout=PIPE, stderr=PIPE)
-        build.communicate()
-    except:
-        error = "[%s] Error encountered when being called. Script will not run." % tools_dir[aligner]
-        raise RuntimeError(error)
-
-
-# Builds STAR index
-def build_star(parser_result, output_prefix):
-    genome_index = "%s_star" % output_prefix
-    os.mkdir(genome_index) if not os.path.exists(genome_index) else 0
-    output_file = "%s/Genome" % genome_index
-
-    command = "STAR --runThreadN {threads} --runMode genomeGenerate " \
-              "--genomeDir {genome_index} " \
-              "--genomeFastaFiles {genome_file} {annotation_option} " \
-              "{builder_extra_args}". \
-        format(threads=parser_result.threads,
-               genome_index=genome_index,
-               genome_file=parser_result.genome_file,
-               annotation_option="--sjdbGTFfile %s" % parser_result.annotation
-               if parser_result.annotation is not None else "",
-               builder_extra_args=parser_result.builder_extra_args)
-
-    run_tool("STAR", command, output_file)
-
-    return genome_index
-
-
-# Builds Subread index
-def build_subread(parser_result, output_prefix):
-    genome_index = "%s_subread/" % output_prefix
-    os.mkdir(genome_index) if not os.path.exists(genome_index) else 0
-    genome_index += "genome"
-    output_file = "%s.00.b.tab" % genome_index
-
-    command = "subread-buildindex -o {genome_index} " \
-              "{builder_extra_args} {genome_file}". \
-        format(genome_index=genome_index,
-               builder_extra_args=parser_result.builder_extra_args,
-               genome_file=parser_result.genome_file)
-
-    run_tool("Subread-Build", command, output_file)
-
-    return genome_index
-
-
-# Runs tools with the given command
-# Also checks for the existence of one of the expected output from the tools
-def run_tool(tool, command, output_file):
-    if not quiet:
-        root_logger.info("Command: %s" % command)
-
-    tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
-    tool_out, tool_err = tool_process.communicate()
-
-    if tool_process.returncode != 0:
-        error = "{tool} failed to complete (non-zero return code)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
-    elif not os.path.exists(output_file):
-        error = "{tool} failed to complete (no output file is found)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
-    elif "[Errno" in tool_err.decode("utf8").strip():
-        error = "{tool} failed to complete (error)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
+    aligner_backends.get_backend(aligner).check_tools()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,211 @@
+#!/usr/bin/python3
+
+from collections import defaultdict
+
+import numpy as np
+
+try:
+    from utils.aligner_backends import AlignmentHit
+except ImportError:
+    from aligner_backends import AlignmentHit
+
+KMER_SIZE = 15
+WINDOW_SIZE = 5
+# Minimizers found more often than this in the unmapped sequences are not used as seeds
+MAX_OCCURRENCES = 1000
+# Mirrors the STAR defaults used by the follow-up alignment (outFilterMatchNminOverLread and outFilterMismatchNmax)
+MIN_MATCH_FRACTION = 0.66
+MAX_MISMATCHES = 10
+NUM_READS_PER_BATCH = 20000
+NUM_CANDIDATES_PER_CHUNK = 200000
+# Minimizer occurrences expanded into candidates at a time
+NUM_PAIRS_PER_CHUNK = 1000000
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+    for base in bases:
+        BASE_CODES[ord(base)] = code
+INVALID_HASH = np.iinfo(np.uint64).max
+
+
+# Encodes sequences of the same length into a 2D array of base codes (A=0, C=1, G=2, T=3, others=4)
+def encode_sequences(sequences):
+    length = len(sequences[0]) if sequences else 0
+    data = np.frombuffer("".join(sequences).encode(), dtype=np.uint8)
+
+    return BASE_CODES[data].reshape(len(sequences), length)
+
+
+# Returns the reverse complements of a 2D array of base codes
+def reverse_complement(codes):
+    reverse = codes[:, ::-1]
+
+    return np.where(reverse < 4, 3 - reverse, 4).astype(np.uint8)
+
+
+# Returns the minimizers of each row of a 2D array of base codes
+# As three flat arrays: the row, the hash and the position of each minimizer
+def get_minimizers(codes, k=KMER_SIZE, w=WINDOW_SIZE):
+    num_rows, length = codes.shape
+    if length < k + w - 1:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+
+    kmers = np.lib.stride_tricks.sliding_window_view(codes, k, axis=1)
+    weights = (np.uint64(1) << (np.arange(k - 1, -1, -1, dtype=np.uint64) * np.uint64(2)))
+    kmer_codes = (np.minimum(kmers, 3).astype(np.uint64) * weights).sum(axis=2, dtype=np.uint64)
+
+    # Scrambles the k-mer codes so that minimizers are not biased towards poly-A
+    hashes = kmer_codes * np.uint64(0x9E3779B97F4A7C15)
+    hashes ^= hashes >> np.uint64(29)
+    hashes[(kmers == 4).any(axis=2)] = INVALID_HASH
+
+    windows = np.lib.stride_tricks.sliding_window_view(hashes, w, axis=1)
+    positions = windows.argmin(axis=2) + np.arange(windows.shape[1])
+    rows = np.repeat(np.arange(num_rows), positions.shape[1])
+    positions = positions.ravel()
+
+    keys = np.unique(rows * (length + 1) + positions)
+    rows, positions = keys // (length + 1), keys % (length + 1)
+    minimizer_hashes = hashes[rows, positions]
+    valid = minimizer_hashes != INVALID_HASH
+
+    return rows[valid], minimizer_hashes[valid], positions[valid]
+
+
+# Minimizer index of the unique unmapped sequences, which are given in the order of the artificial genome
+class MinimizerIndex(object):
+    def __init__(self, sequences):
+        self.lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+        self.bases = BASE_CODES[np.frombuffer("".join(sequences).encode(), dtype=np.uint8)]
+
+        by_length = defaultdict(list)
+        for seq_index, sequence in enumerate(sequences):
+            by_length[len(sequence)].append(seq_index)
+
+        seq_indices, hashes, positions = [], [], []
+        for length, indices in by_length.items():
+            indices = np.array(indices, dtype=np.int64)
+            rows, row_hashes, row_positions = get_minimizers(encode_sequences([sequences[i] for i in indices]))
+            seq_indices.append(indices[rows])
+            hashes.append(row_hashes)
+            positions.append(row_positions)
+
+        hashes = np.concatenate(hashes) if hashes else np.empty(0, dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        self.hashes = hashes[order]
+        self.seq_indices = np.concatenate(seq_indices)[order] if seq_indices else np.empty(0, dtype=np.int64)
+        self.positions = np.concatenate(positions)[order] if positions else np.empty(0, dtype=np.int64)
+
+    # Yields the candidate matches of the query minimizers in chunks of arrays of query rows, sequence indices and
+    # diagonals, the rows must be sorted
+    # Chunks end at row boundaries with about NUM_PAIRS_PER_CHUNK minimizer occurrences each, so the candidates of a
+    # query are deduplicated together without expanding the occurrences of all the queries at once
+    def get_candidates(self, rows, hashes, positions):
+        starts = np.searchsorted(self.hashes, hashes, side="left")
+        ends = np.searchsorted(self.hashes, hashes, side="right")
+        counts = ends - starts
+        counts[counts > MAX_OCCURRENCES] = 0
+        cumulative_counts = np.cumsum(counts)
+
+        chunk_start = 0
+        while chunk_start < len(hashes):
+            done = cumulative_counts[chunk_start - 1] if chunk_start > 0 else 0
+            chunk_end = max(int(np.searchsorted(cumulative_counts, done + NUM_PAIRS_PER_CHUNK, side="right")),
+                            chunk_start + 1)
+            chunk_end = int(np.searchsorted(rows, rows[chunk_end - 1], side="right"))
+
+            chunk_counts = counts[chunk_start:chunk_end]
+            total = int(chunk_counts.sum())
+            if total > 0:
+                query = chunk_start + np.repeat(np.arange(len(chunk_counts)), chunk_counts)
+                index = np.repeat(starts[chunk_start:chunk_end] - np.cumsum(chunk_counts) + chunk_counts,
+                                  chunk_counts) + np.arange(total)
+                candidates = np.unique(np.stack((rows[query], self.seq_indices[index],
+                                                 self.positions[index] - positions[query]), axis=1), axis=0)
+                yield candidates[:, 0], candidates[:, 1], candidates[:, 2]
+
+            chunk_start = chunk_end
+
+
+# Returns the reads of a FASTQ file in batches of names and sequences of the same length
+def read_fastq_batches(fastq_file):
+    batches = defaultdict(lambda: ([], []))
+
+    with open(fastq_file) as f:
+        while True:
+            header = f.readline()
+            if not header:
+                break
+
+            sequence = f.readline().strip()
+            f.readline()
+            f.readline()
+
+            names, sequences = batches[len(sequence)]
+            names.append(header[1:].split()[0])
+            sequences.append(sequence)
+
+            if len(names) == NUM_READS_PER_BATCH:
+                yield batches.pop(len(sequence))
+
+    for batch in batches.values():
+        yield batch
+
+
+# Matches the mapped reads in the FASTQ files against the unmapped sequences without an aligner
+# Yields an AlignmentHit in the coordinates of the artificial genome (see make_new_genome) for each verified match
+# A match is an ungapped overlap of a read, on either strand, with enough matching bases and few mismatches
+def match_reads(unmapped_sequences, fastq_files, bin_size, num_read_per_chr):
+    index = MinimizerIndex(unmapped_sequences)
+
+    for fastq_file in fastq_files:
+        for read_file in fastq_file.split(","):
+            for names, sequences in read_fastq_batches(read_file):
+                if not sequences or len(sequences[0]) < KMER_SIZE + WINDOW_SIZE - 1:
+                    continue
+
+                forward = encode_sequences(sequences)
+                matched = set()
+
+                for is_reverse, codes in ((False, forward), (True, reverse_complement(forward))):
+                    for row, seq_index, start, end in verify_candidates(index, codes):
+                        if (row, seq_index) in matched:
+                            continue
+
+                        matched.add((row, seq_index))
+                        chr_num, chr_bin = divmod(seq_index, num_read_per_chr) if num_read_per_chr > 0 \
+                            else (0, seq_index)
+                        ref_start = chr_bin * bin_size + start
+                        yield AlignmentHit(names[row], "ART_CHR_%d" % chr_num, ref_start, chr_bin * bin_size + end,
+                                           is_reverse, 255, "%dM" % (end - start))
+
+
+# Yields the row, the sequence index and the overlap on the unmapped sequence of each verified candidate
+def verify_candidates(index, codes):
+    num_reads, length = codes.shape
+    min_matches = int(np.ceil(MIN_MATCH_FRACTION * length))
+    read_positions = np.arange(length)
+
+    for rows, seq_indices, diagonals in index.get_candidates(*get_minimizers(codes)):
+        for i in range(0, len(rows), NUM_CANDIDATES_PER_CHUNK):
+            chunk_rows = rows[i:i + NUM_CANDIDATES_PER_CHUNK]
+            chunk_seqs = seq_indices[i:i + NUM_CANDIDATES_PER_CHUNK]
+            chunk_diagonals = diagonals[i:i + NUM_CANDIDATES_PER_CHUNK]
+
+            # Positions of the read bases on the unmapped sequences
+            unmapped_positions = chunk_diagonals[:, None] + read_positions[None, :]
+            inside = (unmapped_positions >= 0) & (unmapped_positions < index.lengths[chunk_seqs][:, None])
+            unmapped_bases = index.bases[np.where(inside, index.offsets[chunk_seqs][:, None] + unmapped_positions,
+                                                  0)]
+            read_bases = codes[chunk_rows]
+
+            matches = inside & (read_bases == unmapped_bases) & (read_bases < 4)
+            num_matches = matches.sum(axis=1)
+            num_mismatches = inside.sum(axis=1) - num_matches
+            passed = (num_matches >= min_matches) & (num_mismatches <= MAX_MISMATCHES)
+
+            for row, seq_index, diagonal, length_inside in zip(chunk_rows[passed], chunk_seqs[passed],
+                                                               chunk_diagonals[passed], inside[passed].sum(axis=1)):
+                start = max(int(diagonal), 0)
+                yield int(row), int(seq_index), start, start + int(length_inside)
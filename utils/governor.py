@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+import os
+import time
+
+# Seconds between two reads of the CPU and memory usage
+CHECK_INTERVAL = 1.0
+# Seconds between two checks of a waiting token holder
+POLL_INTERVAL = 0.1
+# Fraction of the total memory that is kept free
+MEMORY_RESERVE_FRACTION = 0.1
+# Seconds over which read_idle_cpus measures the idle CPUs
+IDLE_SAMPLE_INTERVAL = 0.2
+
+
+# Returns the busy and total CPU time of the node in clock ticks from /proc/stat, or None if it cannot be read
+def read_cpu_times():
+    try:
+        with open("/proc/stat") as f:
+            values = [int(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+
+    # idle and iowait are the fourth and fifth fields
+    idle = sum(values[3:5])
+
+    return sum(values) - idle, sum(values)
+
+
+# Returns the number of idle CPUs of the node over IDLE_SAMPLE_INTERVAL seconds
+# Or an estimate from the load average if /proc/stat cannot be read
+def read_idle_cpus():
+    first_cpu_times = read_cpu_times()
+    time.sleep(IDLE_SAMPLE_INTERVAL)
+    cpu_times = read_cpu_times()
+
+    if first_cpu_times is None or cpu_times is None or cpu_times[1] == first_cpu_times[1]:
+        return max(os.cpu_count() - os.getloadavg()[0], 0)
+
+    busy = (cpu_times[0] - first_cpu_times[0]) / (cpu_times[1] - first_cpu_times[1])
+
+    return (1 - busy) * os.cpu_count()
+
+
+# Returns the total and available memory of the node in bytes from /proc/meminfo, or None if it cannot be read
+def read_memory():
+    meminfo = {}
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                key, value = line.split(":", 1)
+                meminfo[key] = int(value.split()[0]) * 1024
+    except (OSError, ValueError):
+        return None
+
+    if "MemTotal" not in meminfo or "MemAvailable" not in meminfo:
+        return None
+
+    return meminfo["MemTotal"], meminfo["MemAvailable"]
+
+
+# Returns the resident set size of a process in bytes, or 0 if it has exited
+def read_rss(pid):
+    try:
+        with open("/proc/%d/statm" % pid) as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+# Returns the ids of the child processes of a process, the current process by default
+def get_child_pids(pid="self"):
+    pids = []
+
+    try:
+        for tid in os.listdir("/proc/%s/task" % pid):
+            with open("/proc/%s/task/%s/children" % (pid, tid)) as f:
+                pids.extend(int(child_pid) for child_pid in f.read().split())
+    except OSError:
+        pass
+
+    return pids
+
+
+# Returns the resident set size of a process and its children in bytes, e.g. a pool worker and its tool
+def read_tree_rss(pid):
+    return read_rss(pid) + sum(read_rss(child_pid) for child_pid in get_child_pids(pid))
+
+
+# Gives out tokens for the tasks of a stage, between min_tokens and max_tokens
+# A fixed governor always gives out max_tokens
+# An adaptive governor checks the node at most every CHECK_INTERVAL seconds while the stage runs, it grows by the idle
+# CPUs and shrinks when the CPUs are oversubscribed, and it keeps room for the RSS of one more task per token above
+# in_use while MEMORY_RESERVE_FRACTION of the memory is left free, shrinking when the reserve is reached
+# get_pids returns the processes that run the tasks, whose largest RSS with their children is the memory cost of a task
+class Governor(object):
+    def __init__(self, max_tokens, adaptive=False, min_tokens=1, get_pids=None):
+        self.max_tokens = max(max_tokens, 1)
+        self.min_tokens = max(min(min_tokens, self.max_tokens), 1)
+        self.adaptive = adaptive
+        self.get_pids = get_pids
+        self.tokens = self.max_tokens
+        self._checked = None
+        self._cpu_times = read_cpu_times() if adaptive else None
+
+    # Returns the number of tasks that may be in flight, given the number of tasks in flight
+    def limit(self, in_use):
+        if not self.adaptive:
+            return self.max_tokens
+
+        now = time.monotonic()
+        if self._checked is None or now - self._checked >= CHECK_INTERVAL:
+            self._checked = now
+            self.tokens = max(self.min_tokens, min(self.max_tokens, self._get_cpu_tokens(in_use),
+                                                   self._get_memory_tokens(in_use)))
+
+        return self.tokens
+
+    def _get_cpu_tokens(self, in_use):
+        cpu_times = read_cpu_times()
+
+        if cpu_times is None or self._cpu_times is None or cpu_times[1] == self._cpu_times[1]:
+            idle_cpus = os.cpu_count() - os.getloadavg()[0]
+        else:
+            busy = (cpu_times[0] - self._cpu_times[0]) / (cpu_times[1] - self._cpu_times[1])
+            idle_cpus = (1 - busy) * os.cpu_count()
+        self._cpu_times = cpu_times
+
+        if idle_cpus >= 1:
+            return max(self.tokens, in_use + int(idle_cpus))
+        elif idle_cpus < 0.5 and os.getloadavg()[0] > os.cpu_count():
+            return max(in_use - 1, 0)
+
+        return self.tokens
+
+    def _get_memory_tokens(self, in_use):
+        memory = read_memory()
+        if memory is None:
+            return self.max_tokens
+
+        total, available = memory
+        free = available - total * MEMORY_RESERVE_FRACTION
+        if free <= 0:
+            return max(in_use - 1, 0)
+
+        task_rss = 0
+        if self.get_pids is not None:
+            task_rss = max([read_tree_rss(pid) for pid in self.get_pids()] or [0])
+
+        if task_rss == 0:
+            return self.max_tokens
+
+        return in_use + int(free // task_rss)
+
+
+# Asyncio tokens of a governor, used in place of an asyncio.Semaphore to bound the running tools
+class AsyncTokens(object):
+    def __init__(self, governor):
+        self.governor = governor
+        self.in_use = 0
+
+    async def __aenter__(self):
+        import asyncio
+
+        while self.in_use >= self.governor.limit(self.in_use):
+            await asyncio.sleep(POLL_INTERVAL)
+        self.in_use += 1
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_use -= 1
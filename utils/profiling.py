@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+import cProfile
+import functools
+import glob
+import io
+import multiprocessing.util
+import os
+import pstats
+import shutil
+from collections import defaultdict
+from contextlib import contextmanager
+
+RAW_DIR = "raw"
+
+# Profilers of the current pool worker by profile directory and stage
+_worker_profilers = {}
+# Number of times each stage has been profiled in the current process, e.g. once per sample of a batch
+_stage_calls = defaultdict(int)
+
+
+# Creates the profile directory and removes the raw stats left by previous runs
+def prepare_profile_dir(profile_dir):
+    profile_dir = os.path.abspath(profile_dir)
+    os.makedirs(profile_dir, exist_ok=True)
+    shutil.rmtree(os.path.join(profile_dir, RAW_DIR), ignore_errors=True)
+
+    return profile_dir
+
+
+# Profiles the enclosed stage of the current process if a profile directory is given
+# Each time a stage is profiled its stats go to a new raw file, so that they are all merged
+@contextmanager
+def profile_stage(profile_dir, stage):
+    if profile_dir is None:
+        yield
+        return
+
+    _stage_calls[stage] += 1
+    raw_file = get_raw_file(profile_dir, stage, "parent", _stage_calls[stage])
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(raw_file)
+
+
+# Returns the target and the arguments of a worker process, wrapped with a profiler if a profile directory is given
+def worker_target(profile_dir, stage, target, args):
+    if profile_dir is None:
+        return target, args
+
+    return profiled_worker, (profile_dir, stage, target) + tuple(args)
+
+
+# Runs the target of a worker process under its own profiler and stores the stats when the worker finishes
+def profiled_worker(profile_dir, stage, target, *args):
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+    try:
+        target(*args)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(get_raw_file(profile_dir, stage, "worker"))
+
+
+# Returns the function to be called by a pool worker, wrapped with a profiler if a profile directory is given
+def pool_task(profile_dir, stage, func):
+    if profile_dir is None:
+        return func
+
+    return functools.partial(profiled_call, profile_dir, stage, func)
+
+
+# Runs a function in a pool worker under the profiler of its stage
+# Each worker keeps one profiler per stage across calls and writes their raw stats files once when it exits
+def profiled_call(profile_dir, stage, func, *args):
+    if not _worker_profilers:
+        # Finalizers with an exit priority are run by multiprocessing when a worker process exits, unlike atexit
+        multiprocessing.util.Finalize(None, dump_worker_profiles, exitpriority=10)
+
+    profiler = _worker_profilers.setdefault((profile_dir, stage), cProfile.Profile())
+    profiler.enable()
+
+    try:
+        return func(*args)
+    finally:
+        profiler.disable()
+
+
+# Writes the raw stats files of the profilers of the current pool worker
+def dump_worker_profiles():
+    for (profile_dir, stage), profiler in _worker_profilers.items():
+        profiler.dump_stats(get_raw_file(profile_dir, stage, "worker"))
+    _worker_profilers.clear()
+
+
+# Returns the name of the raw stats file of the current process for a stage, numbered if it is profiled more than once
+def get_raw_file(profile_dir, stage, role, call=None):
+    raw_dir = os.path.join(profile_dir, RAW_DIR)
+    os.makedirs(raw_dir, exist_ok=True)
+
+    if call is None:
+        return os.path.join(raw_dir, "%s.%s.%d.prof" % (stage, role, os.getpid()))
+
+    return os.path.join(raw_dir, "%s.%s.%d.%d.prof" % (stage, role, os.getpid(), call))
+
+
+# Merges the raw stats of each stage across processes
+# Writes <stage>.prof and a top-N text summary <stage>.txt for each stage and returns the summary file names
+def merge_stage_profiles(profile_dir, top_n=30):
+    stage_files = defaultdict(list)
+
+    for raw_file in sorted(glob.glob(os.path.join(profile_dir, RAW_DIR, "*.prof"))):
+        stage = os.path.basename(raw_file).split(".")[0]
+        stage_files[stage].append(raw_file)
+
+    summary_files = []
+    for stage, raw_files in sorted(stage_files.items()):
+        stats = pstats.Stats(*raw_files)
+        stats.dump_stats(os.path.join(profile_dir, "%s.prof" % stage))
+
+        role_times = defaultdict(float)
+        role_pids = defaultdict(set)
+        for raw_file in raw_files:
+            role, pid = os.path.basename(raw_file).split(".")[1:3]
+            role_times[role] += pstats.Stats(raw_file).total_tt
+            role_pids[role].add(pid)
+
+        report = io.StringIO()
+        report.write("Stage: %s\n" % stage)
+        for role in sorted(role_times.keys()):
+            report.write("%s processes: %d, total time: %.3f s\n" % (role.capitalize(), len(role_pids[role]),
+                                                                    role_times[role]))
+        report.write("\n")
+
+        for sort_key in ("cumulative", "tottime"):
+            stats.stream = report
+            stats.sort_stats(sort_key).print_stats(top_n)
+
+        summary_file = os.path.join(profile_dir, "%s.txt" % stage)
+        with open(summary_file, "w") as f:
+            f.write(report.getvalue())
+        summary_files.append(summary_file)
+
+    return summary_files
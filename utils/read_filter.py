@@ -0,0 +1,109 @@
+#!/usr/bin/python3
+
+NUM_SEQS_PER_BATCH = 10000
+# Reasons are checked in this order and a sequence is reported with the first one it fails
+REASONS = ("length", "n_fraction", "quality", "low_complexity")
+PAD_CODE = 5
+
+# NumPy is imported on first use so that it does not slow down the startup, the base codes are built with it
+_base_codes = None
+
+
+# Returns the base code of each byte value (A=0, C=1, G=2, T=3, others=4)
+def get_base_codes():
+    global _base_codes
+    import numpy as np
+
+    if _base_codes is None:
+        _base_codes = np.full(256, 4, dtype=np.uint8)
+        for code, bases in enumerate(("Aa", "Cc", "Gg", "Tt")):
+            for base in bases:
+                _base_codes[ord(base)] = code
+
+    return _base_codes
+
+
+# Packs sequences into a 2D array of base codes (A=0, C=1, G=2, T=3, others=4), padded with PAD_CODE
+def pack_sequences(sequences, lengths):
+    import numpy as np
+
+    codes = np.full((len(sequences), int(lengths.max()) if len(sequences) else 0), PAD_CODE, dtype=np.uint8)
+    data = get_base_codes()[np.frombuffer("".join(sequences).encode(), dtype=np.uint8)]
+    rows = np.repeat(np.arange(len(sequences)), lengths)
+    columns = np.arange(len(data)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    codes[rows, columns] = data
+
+    return codes
+
+
+# Returns the DUST score of each row of a 2D array of base codes
+# The score is the sum of c * (c - 1) / 2 over the counts c of each triplet, divided by the number of triplets - 1
+# Random sequences score below 1 and homopolymers score about half their length
+def get_dust_scores(codes):
+    import numpy as np
+
+    num_rows = codes.shape[0]
+    if codes.shape[1] < 3:
+        return np.zeros(num_rows)
+
+    first, second, third = codes[:, :-2], codes[:, 1:-1], codes[:, 2:]
+    valid = (first < 4) & (second < 4) & (third < 4)
+    triplets = first.astype(np.int64) * 16 + second * 4 + third
+    rows = np.broadcast_to(np.arange(num_rows)[:, None], triplets.shape)
+
+    counts = np.bincount(rows[valid] * 64 + triplets[valid], minlength=num_rows * 64).reshape(num_rows, 64)
+    num_triplets = valid.sum(axis=1)
+
+    return (counts * (counts - 1) // 2).sum(axis=1) / np.maximum(num_triplets - 1, 1)
+
+
+# Prefilter of low-complexity and low-quality unmapped sequences
+# Thresholds that are not given are not checked
+class ReadFilter(object):
+    def __init__(self, min_length=None, max_n_fraction=None, min_mean_quality=None, max_dust=None):
+        self.min_length = min_length
+        self.max_n_fraction = max_n_fraction
+        self.min_mean_quality = min_mean_quality
+        self.max_dust = max_dust
+
+    @property
+    def enabled(self):
+        return any(threshold is not None for threshold in (self.min_length, self.max_n_fraction,
+                                                           self.min_mean_quality, self.max_dust))
+
+    # Returns the reason each sequence is filtered out, or None for the sequences that pass
+    # Mean qualities are the mean Phred scores of the sequences
+    def get_reasons(self, sequences, mean_qualities):
+        import numpy as np
+
+        reasons = [None] * len(sequences)
+        lengths = np.fromiter((len(sequence) for sequence in sequences), dtype=np.int64, count=len(sequences))
+        mean_qualities = np.asarray(mean_qualities, dtype=np.float64)
+
+        # Sequences of similar lengths are packed together to limit the padding
+        order = np.argsort(lengths, kind="stable")
+        for i in range(0, len(order), NUM_SEQS_PER_BATCH):
+            batch = order[i:i + NUM_SEQS_PER_BATCH]
+            codes = pack_sequences([sequences[j] for j in batch], lengths[batch])
+            failed = np.full(len(batch), -1, dtype=np.int64)
+
+            checks = {}
+            if self.min_length is not None:
+                checks["length"] = lengths[batch] < self.min_length
+            if self.max_n_fraction is not None:
+                checks["n_fraction"] = (codes == 4).sum(axis=1) > self.max_n_fraction * lengths[batch]
+            if self.min_mean_quality is not None:
+                checks["quality"] = mean_qualities[batch] < self.min_mean_quality
+            if self.max_dust is not None:
+                checks["low_complexity"] = get_dust_scores(codes) > self.max_dust
+
+            # Later reasons are overwritten by earlier ones
+            for reason_index in range(len(REASONS) - 1, -1, -1):
+                if REASONS[reason_index] in checks:
+                    failed[checks[REASONS[reason_index]]] = reason_index
+
+            for j, reason_index in zip(batch, failed):
+                if reason_index >= 0:
+                    reasons[j] = REASONS[reason_index]
+
+        return reasons
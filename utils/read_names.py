@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import bisect
+import hashlib
+from array import array
+
+
+# Returns a 64-bit hash of a read name that is stable across processes and runs
+def hash_name(name):
+    return int.from_bytes(hashlib.blake2b(name.encode(), digest_size=8).digest(), "little")
+
+
+# Index from read names to read ids stored as sorted NumPy arrays of 64-bit name hashes and ids
+# Names are added to compact buffers and the index must be frozen before it is queried
+# With 64-bit hashes, the chance of any false positive among 100M names is below 0.1%
+# NumPy is imported on first use so that it does not slow down the startup
+class HashedNameIndex(object):
+    def __init__(self):
+        import numpy as np
+
+        self._pending_hashes = array("Q")
+        self._pending_ids = array("Q")
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._ids = np.empty(0, dtype=np.uint64)
+
+    def add(self, name, read_id):
+        self._pending_hashes.append(hash_name(name))
+        self._pending_ids.append(read_id)
+
+    # Adds names by their hashes (see hash_name), e.g. hashed in other processes
+    def add_hashes(self, hashes, read_ids):
+        import numpy as np
+
+        self._pending_hashes.frombytes(np.asarray(hashes, dtype=np.uint64).tobytes())
+        self._pending_ids.frombytes(np.asarray(read_ids, dtype=np.uint64).tobytes())
+
+    # Sorts the added hashes so the index can be queried
+    def freeze(self):
+        import numpy as np
+
+        if self._pending_hashes:
+            hashes = np.concatenate((self._hashes, np.frombuffer(self._pending_hashes, dtype=np.uint64)))
+            ids = np.concatenate((self._ids, np.frombuffer(self._pending_ids, dtype=np.uint64)))
+            order = np.argsort(hashes, kind="stable")
+            self._hashes = hashes[order]
+            self._ids = ids[order]
+            self._pending_hashes = array("Q")
+            self._pending_ids = array("Q")
+
+        return self
+
+    # Returns an array with the read id of each of the names, or -1 for names that are not in the index
+    def lookup_many(self, names):
+        import numpy as np
+
+        hashes = np.fromiter((hash_name(name) for name in names), dtype=np.uint64, count=len(names))
+        read_ids = np.full(len(hashes), -1, dtype=np.int64)
+
+        if len(self._hashes) == 0:
+            return read_ids
+
+        index = np.searchsorted(self._hashes, hashes)
+        index[index == len(self._hashes)] = 0
+        found = self._hashes[index] == hashes
+        read_ids[found] = self._ids[index[found]]
+
+        return read_ids
+
+    # Returns a boolean array telling which of the names are in the index
+    def contains_many(self, names):
+        return self.lookup_many(names) >= 0
+
+    def clear(self):
+        self.__init__()
+
+    def __contains__(self, name):
+        return bool(self.contains_many([name])[0])
+
+    def __len__(self):
+        return len(self._hashes) + len(self._pending_hashes)
+
+
+# Names of reads packed into a single buffer, looked up by read id
+# Read ids must be added in increasing order
+class NameTable(object):
+    def __init__(self):
+        self._ids = array("Q")
+        self._offsets = array("Q", [0])
+        self._data = bytearray()
+
+    def add(self, read_id, name):
+        if self._ids and read_id <= self._ids[-1]:
+            raise ValueError("Read ids must be added in increasing order (%d after %d)" % (read_id, self._ids[-1]))
+
+        self._ids.append(read_id)
+        self._data += name.encode()
+        self._offsets.append(len(self._data))
+
+    def get(self, read_id, default=None):
+        i = bisect.bisect_left(self._ids, read_id)
+
+        if i == len(self._ids) or self._ids[i] != read_id:
+            return default
+
+        return self._data[self._offsets[i]:self._offsets[i + 1]].decode()
+
+    def clear(self):
+        self.__init__()
+
+    def __getitem__(self, read_id):
+        name = self.get(read_id)
+
+        if name is None:
+            raise KeyError(read_id)
+
+        return name
+
+    def __contains__(self, read_id):
+        return self.get(read_id) is not None
+
+    def __len__(self):
+        return len(self._ids)
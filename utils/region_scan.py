@@ -0,0 +1,67 @@
+#!/usr/bin/python3
+
+# Length of the reference ranges scanned by each task, so that long contigs are split across workers
+# And that the ranges without wanted reads can be skipped
+REGION_LENGTH = 5000000
+# Contig name of the unplaced records at the end of a coordinate-sorted file
+UNPLACED = "*"
+
+
+# Returns whether an alignment file is coordinate-sorted and indexed, so that it can be scanned by region
+def is_region_scannable(f):
+    return f.header.to_dict().get("HD", {}).get("SO") == "coordinate" and f.has_index()
+
+
+# Returns the number of records of each contig and the number of unplaced records from the index statistics
+# Or None if the index has no statistics, e.g. CRAM indices, for which pysam reports zero records everywhere
+def get_index_counts(f):
+    if not f.is_bam:
+        return None
+
+    try:
+        contig_counts = {stats.contig: stats.total for stats in f.get_index_statistics()}
+        num_unplaced = f.nocoordinate
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+    # Statistics that count no records at all are missing rather than those of an empty file
+    if not num_unplaced and not any(contig_counts.values()):
+        return None
+
+    return contig_counts, num_unplaced
+
+
+# Returns the regions of a coordinate-sorted file as (contig, start, end), in file order
+# The unplaced records come last as (UNPLACED, 0, 0)
+# Contigs without records and an empty unplaced tail are left out if the index has statistics
+def get_regions(f, region_length=None):
+    region_length = region_length or REGION_LENGTH
+    index_counts = get_index_counts(f)
+    regions = []
+
+    for contig, length in zip(f.references, f.lengths):
+        if index_counts is not None and not index_counts[0].get(contig, 0):
+            continue
+
+        for start in range(0, length, region_length):
+            regions.append((contig, start, min(start + region_length, length)))
+
+    if index_counts is None or index_counts[1]:
+        regions.append((UNPLACED, 0, 0))
+
+    return regions
+
+
+# Yields the records of a region in file order
+# Records that overlap the region but start before it belong to the previous region and are skipped
+def fetch_region(f, region):
+    contig, start, end = region
+
+    if contig == UNPLACED:
+        for r in f.fetch(UNPLACED):
+            yield r
+        return
+
+    for r in f.fetch(contig, start, end):
+        if r.reference_start >= start:
+            yield r
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import glob
+import hashlib
+import os
+import pickle
+
+# Bumped whenever the rescue step changes in a way that makes cached outcomes stale
+CACHE_VERSION = 1
+BATCH_SIZE = 10000
+CHECKSUM_BLOCK_SIZE = 1 << 20
+
+# Checksums of files by path, size and modification time
+_file_checksums = {}
+
+
+# Returns a 128-bit digest of a sequence, used to fingerprint reads and target genomes
+def hash_sequence(seq):
+    return hashlib.blake2b(str(seq).encode(), digest_size=16).digest()
+
+
+# Returns the key of the rescue outcome of a read against a target genome
+# The target is fingerprinted by its sequence as well as its location, and the settings include the tool and
+# the thresholds that affect the outcome
+def make_key(read_hash, target_hash, reference_name, start, end, is_spliced, read_windows, settings):
+    key = (CACHE_VERSION, read_hash, target_hash, reference_name, start, end, is_spliced, tuple(read_windows),
+           settings)
+
+    return hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+
+
+# Returns the key of the repeat verdict of a sequence against a repeat database
+def make_repeat_key(seq_hash, db_checksum):
+    return hashlib.blake2b(repr((CACHE_VERSION, seq_hash, db_checksum)).encode(), digest_size=16).digest()
+
+
+# Returns a checksum of the contents of the files of a BLAST database, e.g. repeat_db.nhr, repeat_db.nsq
+# Checksums are computed once per process for files that have not changed
+def get_db_checksum(db_prefix):
+    db_files = sorted(f for f in glob.glob(db_prefix + ".*") if os.path.isfile(f))
+
+    if not db_files:
+        raise FileNotFoundError("No database files found for %s" % db_prefix)
+
+    digest = hashlib.blake2b(digest_size=16)
+    for db_file in db_files:
+        stat = os.stat(db_file)
+        file_key = (os.path.abspath(db_file), stat.st_size, stat.st_mtime_ns)
+
+        if file_key not in _file_checksums:
+            file_digest = hashlib.blake2b(digest_size=16)
+            with open(db_file, "rb") as f:
+                for block in iter(lambda: f.read(CHECKSUM_BLOCK_SIZE), b""):
+                    file_digest.update(block)
+            _file_checksums[file_key] = file_digest.digest()
+
+        digest.update(os.path.basename(db_file).encode())
+        digest.update(_file_checksums[file_key])
+
+    return digest.hexdigest()
+
+
+# Persistent cache of outcomes stored in a table of an SQLite file, shared across samples and runs
+# The rescue table maps a read and its target genome to the list of alignments of the read relative to the target,
+# an empty list means no hit. The repeat table maps a sequence and a repeat database to whether the sequence has a hit
+class RescueCache(object):
+    def __init__(self, path, table="rescue"):
+        self.path = path
+        self.table = table
+        self.hits = 0
+        self.misses = 0
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        import sqlite3
+
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS %s (k BLOB PRIMARY KEY, v BLOB)" % table)
+        self._conn.commit()
+
+    # Returns a dict of the cached outcomes of the given keys, keys that are not cached are left out
+    def get_many(self, keys):
+        outcomes = {}
+        keys = list(keys)
+
+        for i in range(0, len(keys), BATCH_SIZE):
+            batch = keys[i:i + BATCH_SIZE]
+            query = "SELECT k, v FROM %s WHERE k IN (%s)" % (self.table, ",".join("?" * len(batch)))
+
+            for key, value in self._conn.execute(query, batch):
+                outcomes[key] = pickle.loads(value)
+
+        self.hits += len(outcomes)
+        self.misses += len(keys) - len(outcomes)
+
+        return outcomes
+
+    # Stores the outcomes of (key, outcome) pairs
+    def put_many(self, items):
+        self._conn.executemany("INSERT OR REPLACE INTO %s (k, v) VALUES (?, ?)" % self.table,
+                               [(key, pickle.dumps(outcome, pickle.HIGHEST_PROTOCOL)) for key, outcome in items])
+        self._conn.commit()
+
+    def close(self):
+        self._conn.close()
@@ -3,10 +3,12 @@
 import argparse
 import logging
 import os
-import re
-import shlex
 import sys
-from subprocess import Popen, PIPE
+
+try:
+    from utils import aligner_backends
+except ImportError:
+    import aligner_backends
 
 
 # Main function
@@ -30,7 +32,8 @@ def run_aligner(parser_result):
                 "You input: %s" % " ".join(parser_result.input)
         raise argparse.ArgumentTypeError(error)
 
-    check_tools(aligner)
+    backend = aligner_backends.get_backend(aligner)
+    backend.check_tools()
 
     if not quiet:
         log_formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] %(message)s", datefmt='%Y-%m-%d %I:%M:%S %p')
@@ -38,11 +41,7 @@ def run_aligner(parser_result):
         root_logger = logging.getLogger()
         root_logger.setLevel("INFO")
 
-    if parser_result.prefix is None:
-        prefix = os.path.splitext(os.path.basename(parser_result.input[0].split(",")[0]))[0].\
-            rstrip(".fastq").rstrip(".fq")
-    else:
-        prefix = parser_result.prefix
+    prefix = get_prefix(parser_result.prefix, parser_result.input)
 
     if parser_result.output_dir is None:
         output_prefix = prefix
@@ -69,17 +68,17 @@ def run_aligner(parser_result):
         console_handler.setFormatter(log_formatter)
         root_logger.addHandler(console_handler)
 
-    tools_names = {"star": "STAR", "subread": "Subread"}
-
     if not quiet:
-        root_logger.info("Aligning reads using %s..." % tools_names[aligner])
+        root_logger.info("Aligning reads using %s..." % backend.display_name)
 
-    if aligner == "star":
-        out_sam_file = run_star(parser_result, output_prefix)
-    elif aligner == "subread":
-        out_sam_file = run_subread(parser_result, output_prefix)
-    else:
-        out_sam_file = None
+    out_sam_file = backend.align(parser_result.genome_index, parser_result.input, output_prefix,
+                                 threads=parser_result.threads,
+                                 extra_args=parser_result.aligner_extra_args,
+                                 bam_output=parser_result.bam_output,
+                                 logger=None if quiet else root_logger)
+
+    if parser_result.clean_files:
+        backend.clean_up(output_prefix)
 
     if not quiet:
         root_logger.info("Completed reads alignment")
@@ -88,6 +87,14 @@ def run_aligner(parser_result):
     return out_sam_file
 
 
+# Returns the prefix of the files written by the aligner, the name of the first read file by default
+def get_prefix(prefix, input_files):
+    if prefix is None:
+        return os.path.splitext(os.path.basename(input_files[0].split(",")[0]))[0].rstrip(".fastq").rstrip(".fq")
+
+    return prefix
+
+
 # Adds arguments for the argument parser
 def add_args(parser, required_args):
     required_args.add_argument("--input", "-i",
@@ -99,7 +106,7 @@ def add_args(parser, required_args):
                                dest="aligner",
                                required=True,
                                type=aligner_string,
-                               help="Aligner to be used (STAR|Subread)")
+                               help="Aligner to be used (%s)" % aligner_backends.backend_names())
     parser.add_argument("--aligner_extra_args", "-ae",
                         dest="aligner_extra_args",
                         default="",
@@ -134,8 +141,8 @@ def add_args(parser, required_args):
 # Checks for valid aligner
 def aligner_string(s):
     s = s.lower()
-    if not re.match("star|subread", s):
-        error = "Supported aligners (STAR|Subread)"
+    if s not in aligner_backends.BACKENDS:
+        error = "Supported aligners (%s)" % aligner_backends.backend_names()
         raise argparse.ArgumentTypeError(error)
     else:
         return s
@@ -143,100 +150,7 @@ def aligner_string(s):
 
 # Checks for tools execution
 def check_tools(aligner):
-    aligner_execs = {"star": "STAR", "subread": "subread-align"}
-    try:
-        align = Popen(shlex.split(aligner_execs[aligner]), stdout=PIPE, stderr=PIPE)
-        align.communicate()
-    except:
-        error = "[%s] Error encountered when being called. Script will not run" % aligner_execs[aligner]
-        raise RuntimeError(error)
-
-
-# Runs STAR
-def run_star(parser_result, output_prefix):
-    if parser_result.bam_output:
-        output_file = "%s.Aligned.out.bam" % output_prefix
-    else:
-        output_file = "%s.Aligned.out.sam" % output_prefix
-
-    command = "STAR --runThreadN {threads} {aligner_extra_args} " \
-              "--genomeDir {genome_index} --readFilesIn {read_files} " \
-              "--outFileNamePrefix {output_prefix}\. {gz_option} {bam_option} " \
-              "--outSAMunmapped Within KeepPairs". \
-        format(threads=parser_result.threads,
-               aligner_extra_args=parser_result.aligner_extra_args,
-               genome_index=parser_result.genome_index,
-               read_files=" ".join(parser_result.input),
-               output_prefix=output_prefix,
-               gz_option="--readFilesCommand zcat" if parser_result.input[0].split(",")[0].endswith("gz") else "",
-               bam_option="--outSAMtype BAM Unsorted" if parser_result.bam_output else "")
-
-    run_tool("STAR", command, output_file)
-
-    if parser_result.clean_files:
-        os.remove("%s.Log.final.out" % output_prefix)
-        os.remove("%s.Log.out" % output_prefix)
-        os.remove("%s.Log.progress.out" % output_prefix)
-        os.remove("%s.SJ.out.tab" % output_prefix)
-
-    return output_file
-
-
-# Runs Subread
-def run_subread(parser_result, output_prefix):
-    if len(parser_result.input) == 2:
-        read_files = "-r %s -R %s" % (parser_result.input[0], parser_result.input[1])
-    else:
-        read_files = "-r %s" % " ".join(parser_result.input)
-
-    if parser_result.bam_output:
-        output_file = "%s.bam" % output_prefix
-    else:
-        output_file = "%s.sam" % output_prefix
-
-    command = "subread-align -T {threads} -t 0 {aligner_extra_args} -i " \
-              "{genome_index} {read_files} -o {output_file} {bam_option}". \
-        format(threads=parser_result.threads,
-               aligner_extra_args=parser_result.aligner_extra_args,
-               genome_index=parser_result.genome_index,
-               read_files=read_files,
-               output_file=output_file,
-               bam_option="" if parser_result.bam_output else "--SAMoutput")
-
-    run_tool("Subread", command, output_file)
-
-    return output_file
-
-# Runs tools with the given command
-# Also checks for the existence of one of the expected output from the tools
-def run_tool(tool, command, output_file):
-    if not quiet:
-        root_logger.info("Command: %s" % command)
-
-    tool_process = Popen(shlex.split(command), stdout=PIPE, stderr=PIPE)
-    tool_out, tool_err = tool_process.communicate()
-
-    if tool_process.returncode != 0:
-        error = "{tool} failed to complete (non-zero return code)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
-    elif not os.path.exists(output_file):
-        error = "{tool} failed to complete (no output file is found)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
-    elif "[Errno" in tool_err.decode("utf8").strip():
-        error = "{tool} failed to complete (error)!\n" \
-                "{tool} stdout: {out}\n{tool} stderr: {err}\n". \
-            format(tool=tool,
-                   out=tool_out.decode("utf8"),
-                   err=tool_err.decode("utf8"))
-        raise RuntimeError(error)
+    aligner_backends.get_backend(aligner).check_tools()
 
 
 if __name__ == "__main__":
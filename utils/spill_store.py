@@ -0,0 +1,321 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import pickle
+import re
+import sys
+from collections import OrderedDict, defaultdict
+from collections.abc import MutableMapping
+
+# Number of tables that are expected to be large at the same time, each of them gets this share of the budget
+TABLE_SHARE = 4
+BATCH_SIZE = 10000
+MEMORY_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+# Values that can be updated in place after they are handed out by a SpillDict
+MUTABLE_TYPES = (list, set, dict)
+# Marks that no value has been handed out for in-place updates
+_NOT_LENT = object()
+
+
+# Converts a memory size such as 512M or 16G into bytes, used as an argparse type
+def memory_size(s):
+    match = re.match(r"^(\d+(?:\.\d+)?)\s*([KMGT]?)B?$", s.strip().upper())
+
+    if not match:
+        error = "Invalid memory size: %s (Example: 512M, 16G)" % s
+        raise argparse.ArgumentTypeError(error)
+
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2)])
+
+
+# Creates the tables of the pipeline
+# Tables are plain dicts and sets unless a memory budget is configured, in which case they are SpillDict and SpillSet
+class TableFactory(object):
+    def __init__(self):
+        self.max_bytes = None
+        self.spill_dir = None
+
+    def configure(self, max_bytes, spill_dir):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+
+        if spill_dir is not None:
+            os.makedirs(spill_dir, exist_ok=True)
+
+    def dict(self, name, default_factory=None):
+        if self.max_bytes is None:
+            return defaultdict(default_factory) if default_factory is not None else {}
+
+        return SpillDict(self.max_bytes // TABLE_SHARE, self.spill_dir, name, default_factory)
+
+    def set(self, name):
+        if self.max_bytes is None:
+            return set()
+
+        return SpillSet(self.max_bytes // TABLE_SHARE, self.spill_dir, name)
+
+
+# Writes the in-memory entries of a table to disk so that forked processes can read all of them
+def flush(table):
+    if isinstance(table, (SpillDict, SpillSet)):
+        table.flush()
+
+
+# Rough number of bytes used by a key or a value
+def estimate_size(obj):
+    size = sys.getsizeof(obj)
+
+    if isinstance(obj, (list, tuple, set)) and obj:
+        size += len(obj) * estimate_size(next(iter(obj)))
+
+    return size
+
+
+# A dict that keeps its entries in memory until the budget is reached
+# From then on, the least recently used entries are written to an SQLite file and loaded back on access
+# Values are cached as live objects, so in-place updates such as d[k].append(v) are kept when they are written back
+# The last mutable value handed out is measured again on the next access, so the budget follows in-place growth
+class SpillDict(MutableMapping):
+    def __init__(self, max_bytes, spill_dir, name, default_factory=None):
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir
+        self.name = name
+        self.default_factory = default_factory
+        self._cache = OrderedDict()
+        self._sizes = {}
+        self._cache_bytes = 0
+        self._lent_key = _NOT_LENT
+        self._path = None
+        self._conn = None
+        self._owner_pid = os.getpid()
+        self._conn_pid = None
+
+    @property
+    def spilled(self):
+        return self._path is not None
+
+    def __getitem__(self, key):
+        self._measure_lent()
+
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._lend(key, self._cache[key])
+
+        if self.spilled:
+            row = self._db().execute("SELECT v FROM t WHERE k = ?", (key,)).fetchone()
+
+            if row is not None:
+                value = pickle.loads(row[0])
+                self._cache_put(key, value)
+                return self._lend(key, value)
+
+        if self.default_factory is None:
+            raise KeyError(key)
+
+        value = self.default_factory()
+        self._cache_put(key, value)
+
+        return self._lend(key, value)
+
+    def __setitem__(self, key, value):
+        self._measure_lent()
+        self._cache_put(key, value)
+
+    def __delitem__(self, key):
+        self._measure_lent()
+        found = key in self._cache
+
+        if found:
+            self._cache_bytes -= self._sizes.pop(key)
+            del self._cache[key]
+
+        if self.spilled:
+            found = self._db().execute("DELETE FROM t WHERE k = ?", (key,)).rowcount > 0 or found
+
+        if not found:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._cache:
+            return True
+
+        if self.spilled:
+            return self._db().execute("SELECT 1 FROM t WHERE k = ?", (key,)).fetchone() is not None
+
+        return False
+
+    def __len__(self):
+        self._measure_lent()
+
+        if not self.spilled:
+            return len(self._cache)
+
+        self.flush()
+
+        return self._db().execute("SELECT COUNT(*) FROM t").fetchone()[0]
+
+    def __iter__(self):
+        for key, _ in self._iter_rows(False):
+            yield key
+
+    def items(self):
+        return self._iter_rows(True)
+
+    def values(self):
+        return (value for _, value in self._iter_rows(True))
+
+    def clear(self):
+        self._cache.clear()
+        self._sizes.clear()
+        self._cache_bytes = 0
+        self._lent_key = _NOT_LENT
+
+        if self.spilled and os.getpid() == self._owner_pid:
+            self._db().close()
+            self._conn = None
+            os.remove(self._path)
+            self._path = None
+
+    # Writes all cached entries to disk, the entries are kept in the cache
+    def flush(self):
+        self._measure_lent()
+
+        if self.spilled and os.getpid() == self._owner_pid:
+            self._write(list(self._cache.items()))
+
+    # Yields the keys (and values) of the cached entries, or of all the entries on disk once spilled
+    # Rows are read in rowid batches as entries may be written back to disk during the iteration
+    def _iter_rows(self, with_values):
+        self._measure_lent()
+
+        if not self.spilled:
+            for key in list(self._cache.keys()):
+                yield (key, self._cache[key]) if with_values else (key, None)
+            return
+
+        self.flush()
+        last_rowid = -1
+
+        while True:
+            rows = self._db().execute("SELECT rowid, k, v FROM t WHERE rowid > ? ORDER BY rowid LIMIT ?",
+                                      (last_rowid, BATCH_SIZE)).fetchall()
+
+            if not rows:
+                break
+
+            for rowid, key, value in rows:
+                if with_values:
+                    value = self._cache[key] if key in self._cache else pickle.loads(value)
+
+                yield key, value
+            last_rowid = rows[-1][0]
+
+    # Returns a value handed out by __getitem__ and remembers its key if the value can grow in place
+    def _lend(self, key, value):
+        if isinstance(value, MUTABLE_TYPES):
+            self._lent_key = key
+
+        return value
+
+    # Measures the last value handed out again, since the caller may have updated it in place, and evicts if the
+    # budget is exceeded
+    def _measure_lent(self):
+        key, self._lent_key = self._lent_key, _NOT_LENT
+
+        if key is _NOT_LENT or key not in self._cache:
+            return
+
+        size = estimate_size(key) + estimate_size(self._cache[key])
+        self._cache_bytes += size - self._sizes[key]
+        self._sizes[key] = size
+
+        if self._cache_bytes > self.max_bytes:
+            self._evict()
+
+    def _cache_put(self, key, value):
+        if key in self._cache:
+            self._cache_bytes -= self._sizes[key]
+
+        size = estimate_size(key) + estimate_size(value)
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        self._sizes[key] = size
+        self._cache_bytes += size
+
+        if self._cache_bytes > self.max_bytes:
+            self._evict()
+
+    # Moves the least recently used half of the budget to disk
+    # The most recently used entry is kept, as it may be a value that is being handed out
+    def _evict(self):
+        evicted = []
+
+        while len(self._cache) > 1 and self._cache_bytes > self.max_bytes // 2:
+            key, value = self._cache.popitem(last=False)
+            self._cache_bytes -= self._sizes.pop(key)
+            evicted.append((key, value))
+
+        # Forked readers rely on the owner having flushed before the fork and only drop the entries
+        if os.getpid() == self._owner_pid:
+            self._write(evicted)
+
+    def _write(self, entries):
+        db = self._db()
+
+        for i in range(0, len(entries), BATCH_SIZE):
+            db.executemany("INSERT INTO t (k, v) VALUES (?, ?) ON CONFLICT (k) DO UPDATE SET v = excluded.v",
+                           [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                            for key, value in entries[i:i + BATCH_SIZE]])
+        db.commit()
+
+    # Returns the SQLite connection of the current process, creating the spill file on first use
+    def _db(self):
+        import sqlite3
+        import tempfile
+
+        if self._path is None:
+            fd, self._path = tempfile.mkstemp(prefix="%s_" % self.name, suffix=".sqlite", dir=self.spill_dir)
+            os.close(fd)
+
+        if self._conn is None or self._conn_pid != os.getpid():
+            self._conn = sqlite3.connect(self._path)
+            self._conn_pid = os.getpid()
+            self._conn.execute("PRAGMA journal_mode = OFF")
+            self._conn.execute("PRAGMA synchronous = OFF")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS t (k PRIMARY KEY, v BLOB)")
+
+        return self._conn
+
+
+# A set with the same spilling behaviour as SpillDict
+class SpillSet(object):
+    def __init__(self, max_bytes, spill_dir, name):
+        self._dict = SpillDict(max_bytes, spill_dir, name)
+
+    def add(self, key):
+        if key not in self._dict:
+            self._dict[key] = None
+
+    def update(self, keys):
+        for key in keys:
+            self.add(key)
+
+    def discard(self, key):
+        if key in self._dict:
+            del self._dict[key]
+
+    def flush(self):
+        self._dict.flush()
+
+    def clear(self):
+        self._dict.clear()
+
+    def __contains__(self, key):
+        return key in self._dict
+
+    def __iter__(self):
+        return iter(self._dict)
+
+    def __len__(self):
+        return len(self._dict)
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+
+import itertools
+import multiprocessing as mp
+from collections import deque
+
+# Modules imported once by the forkserver, workers forked from it start with them already imported
+PRELOAD_MODULES = ["__main__", "numpy", "pysam", "Bio.SeqIO", "intervaltree"]
+
+_pool = None
+_pool_size = None
+
+
+# Returns the worker pool of the run, which is created on first use and reused by all stages and samples
+# Workers are forked from a forkserver with preloaded modules, so worker startup is a one-off cost
+def get_pool(num_workers):
+    global _pool, _pool_size
+    from concurrent.futures import ProcessPoolExecutor
+
+    if _pool is None or _pool_size != num_workers:
+        shutdown_pool()
+        context = mp.get_context("forkserver")
+        context.set_forkserver_preload(PRELOAD_MODULES)
+        _pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=context)
+        _pool_size = num_workers
+
+    return _pool
+
+
+# Shuts down the worker pool if it has been created
+def shutdown_pool():
+    global _pool, _pool_size
+
+    if _pool is not None:
+        _pool.shutdown()
+        _pool, _pool_size = None, None
+
+
+# Returns the process ids of the workers of the pool
+def get_worker_pids():
+    if _pool is None:
+        return []
+
+    return list(getattr(_pool, "_processes", None) or {})
+
+
+# Calls func on chunks of the items in the pool and yields the results of all chunks, in order
+# func takes a list of items and returns a list of results
+# Items are read in the calling process and at most max_pending chunks are in flight at a time
+# Or, if a governor is given, at most as many chunks as it allows, which may change while the chunks run
+def map_chunks(pool, func, items, chunk_size, max_pending, governor=None):
+    items = iter(items)
+    pending = deque()
+
+    while True:
+        limit = max_pending if governor is None else governor.limit(len(pending))
+        while pending and len(pending) >= limit:
+            for result in pending.popleft().result():
+                yield result
+
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        pending.append(pool.submit(func, chunk))
+
+    while pending:
+        for result in pending.popleft().result():
+            yield result